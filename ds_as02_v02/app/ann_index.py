@@ -0,0 +1,212 @@
+import itertools
+import numpy as np
+
+
+def _nearest(vectors, centroids, count=1):
+    sq_dist = (
+        np.einsum('ij,ij->i', vectors, vectors)[:, None]
+        - 2.0 * (vectors @ centroids.T)
+        + np.einsum('ij,ij->i', centroids, centroids)[None, :]
+    )
+    if count == 1:
+        return np.argmin(sq_dist, axis=1)
+    count = min(count, len(centroids))
+    return np.argpartition(sq_dist, count - 1, axis=1)[:, :count]
+
+
+class ExactIndex:
+    """Brute-force backend: every lookup scans the whole gallery."""
+
+    trained = True
+
+    def add(self, row, vector):
+        pass
+
+    def add_many(self, rows, vectors):
+        pass
+
+    def remove(self, row):
+        pass
+
+    def move(self, old_row, new_row):
+        pass
+
+    def needs_training(self, size):
+        return False
+
+    def candidates(self, query):
+        # None tells the gallery to scan every row
+        return None
+
+
+class IVFIndex:
+    """Inverted-file index over the gallery rows.
+
+    Rows are bucketed by their nearest k-means centroid. A lookup only
+    scans the rows in the nprobe closest buckets, so nprobe is the
+    recall/latency knob: nprobe == nlist is an exact search.
+    """
+
+    def __init__(self, nlist=256, nprobe=8, min_train_size=4096,
+                 max_train_points=50000, kmeans_iterations=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = max(min_train_size, nlist)
+        self.max_train_points = max_train_points
+        self.kmeans_iterations = kmeans_iterations
+        self._rng = np.random.default_rng(seed)
+
+        self.centroids = None
+        self.trained_size = 0
+        self._lists = []
+        self._assignment = {}
+        # rows changed while a retrain runs; None when none is running
+        self._dirty = None
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    @property
+    def training(self):
+        return self._dirty is not None
+
+    def _nearest_centroids(self, vectors, count=1):
+        return _nearest(vectors, self.centroids, count)
+
+    def needs_training(self, size):
+        """Due once the gallery is big enough, and again each time it doubles."""
+        if self.training or size < self.min_train_size:
+            return False
+        return not self.trained or size >= 2 * self.trained_size
+
+    def fit(self, matrix):
+        """Run k-means on (a sample of) matrix; return (centroids, row labels).
+
+        Leaves the index untouched, so it can run outside the gallery lock
+        while lookups keep using the current centroids.
+        """
+        size = len(matrix)
+        nlist = min(self.nlist, size)
+
+        sample = matrix
+        if size > self.max_train_points:
+            sample = matrix[self._rng.choice(size, self.max_train_points, replace=False)]
+
+        centroids = sample[self._rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = _nearest(sample, centroids)
+            order = np.argsort(labels, kind='stable')
+            counts = np.bincount(labels, minlength=nlist)
+            filled = np.flatnonzero(counts)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            centroids[filled] = sums / counts[filled, None]
+
+        return centroids, _nearest(matrix, centroids)
+
+    def begin_training(self):
+        """Start recording the rows that change while fit() runs."""
+        self._dirty = set()
+
+    def cancel_training(self):
+        self._dirty = None
+
+    def install(self, centroids, labels, matrix):
+        """Swap in a fitted model and re-bucket every row of matrix.
+
+        Rows added after the fitted snapshot, or changed since
+        begin_training(), are bucketed again against the new centroids.
+        """
+        size = len(matrix)
+        fitted = min(len(labels), size)
+        labels = np.concatenate((labels[:fitted], np.zeros(size - fitted, dtype=labels.dtype)))
+        stale = set(range(fitted, size))
+        stale.update(row for row in self._dirty or () if row < fitted)
+        if stale:
+            stale = np.fromiter(stale, dtype=np.int64)
+            labels[stale] = _nearest(matrix[stale], centroids)
+
+        lists = [set() for _ in range(len(centroids))]
+        assignment = {}
+        for row, label in enumerate(labels.tolist()):
+            lists[label].add(row)
+            assignment[row] = label
+
+        self.centroids, self._lists, self._assignment = centroids, lists, assignment
+        self.trained_size = size
+        self._dirty = None
+        print(f"Trained IVF index: {len(centroids)} lists over {size} faces")
+
+    def _touch(self, rows):
+        if self._dirty is not None:
+            self._dirty.update(rows)
+
+    def add(self, row, vector):
+        self._touch((row,))
+        if not self.trained:
+            return
+        old_label = self._assignment.get(row)
+        if old_label is not None:
+            self._lists[old_label].discard(row)
+        label = int(self._nearest_centroids(vector[None, :])[0])
+        self._lists[label].add(row)
+        self._assignment[row] = label
+
+    def add_many(self, rows, vectors):
+        self._touch(rows)
+        if not self.trained:
+            return
+        labels = self._nearest_centroids(vectors)
+        for row, label in zip(rows, labels.tolist()):
+            self.remove(row)
+            self._lists[label].add(row)
+            self._assignment[row] = label
+
+    def remove(self, row):
+        self._touch((row,))
+        label = self._assignment.pop(row, None)
+        if label is not None:
+            self._lists[label].discard(row)
+
+    def move(self, old_row, new_row):
+        self._touch((old_row, new_row))
+        label = self._assignment.pop(old_row, None)
+        if label is not None:
+            self._lists[label].discard(old_row)
+            self._lists[label].add(new_row)
+            self._assignment[new_row] = label
+
+    def candidates(self, query):
+        if not self.trained or self.nprobe >= len(self.centroids):
+            return None
+
+        # one row of labels, also when nprobe is 1 and argmin gives a scalar per row
+        probe = self._nearest_centroids(query[None, :], self.nprobe).reshape(-1)
+        rows = itertools.chain.from_iterable(self._lists[label] for label in probe)
+        return np.fromiter(rows, dtype=np.int64)
+
+
+def create_index(kind='exact', **options):
+    if kind == 'exact':
+        return ExactIndex()
+    if kind == 'ivf':
+        return IVFIndex(**options)
+    raise ValueError(f"Unknown gallery index: {kind}")
+
+
+def measure_recall(gallery, queries, reference=None):
+    """Fraction of queries where the gallery's index returns the exact nearest face.
+
+    reference defaults to a brute-force scan of the same gallery, so the
+    recall of an approximate index can be read off the live data.
+    """
+    hits = 0
+    for query in queries:
+        approx_id, _ = gallery.best_match(query)
+        if reference is not None:
+            exact_id, _ = reference.best_match(query)
+        else:
+            exact_id, _ = gallery.best_match(query, exact=True)
+        hits += approx_id == exact_id
+    return hits / len(queries) if len(queries) else 1.0
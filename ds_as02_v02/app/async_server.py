@@ -0,0 +1,83 @@
+"""
+Asyncio serving mode for the Coffeehouse Face Recognition System
+
+The recognition and order endpoints are served by native async handlers:
+face detection/encoding runs in a process pool and Mongo/MinIO calls run in
+worker threads, so one slow backend no longer holds up other requests.
+Every other route is the unchanged Flask app, mounted through a WSGI adapter.
+
+Run:
+    python3 async_server.py
+    (or: uvicorn --factory async_server:create_app --port 5002)
+"""
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+import metrics
+
+# the Flask module, imported by create_app() only: pool workers started with
+# spawn re-import this module and must not load it (and build a backend)
+main = None
+cpu_executor = None
+
+async def capture_face(request):
+    """Capture and process face from camera"""
+    current_time = time.time()
+    if not main.claim_capture(current_time):
+        return JSONResponse(main.cooldown_response())
+
+    with metrics.span('capture_request'):
+        rgb_frame, face_hints = await asyncio.to_thread(main.read_capture_frame, current_time)
+        if rgb_frame is None:
+            return JSONResponse(main.capture_failed_response())
+
+        response = await main.get_backend().process_face_recognition_request_async(
+            rgb_frame,
+            main.BRANCH_NAME,
+            face_hints,
+            cpu_executor
+        )
+        with metrics.span('serialize'):
+            return JSONResponse(response)
+
+async def place_order(request):
+    """Place order for customer"""
+    data = await request.json()
+    return JSONResponse(await asyncio.to_thread(main.submit_order, data))
+
+def startup():
+    global cpu_executor
+    main.get_backend()
+    workers = int(os.getenv('ASYNC_CPU_WORKERS', '0')) or os.cpu_count() or 1
+    # the backend is already running threads, which a forked child could
+    # inherit mid-lock; spawned workers start from a clean interpreter
+    cpu_executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    print(f"Async server: {workers} face recognition processes")
+
+def shutdown():
+    if cpu_executor is not None:
+        cpu_executor.shutdown(wait=False, cancel_futures=True)
+
+def create_app():
+    global main
+    import main
+    
+    return Starlette(
+        routes=[
+            Route('/api/capture_face', capture_face, methods=['POST']),
+            Route('/api/place_order', place_order, methods=['POST']),
+            Mount('/', app=WSGIMiddleware(main.app))
+        ],
+        on_startup=[startup],
+        on_shutdown=[shutdown]
+    )
+
+if __name__ == '__main__':
+    uvicorn.run(create_app(), host='0.0.0.0', port=int(os.getenv('ASYNC_PORT', '5002')))
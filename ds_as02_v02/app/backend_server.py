@@ -1,96 +1,401 @@
+import asyncio
+import os
+from contextlib import nullcontext
 import uuid
 from datetime import datetime
+from pathlib import Path
 from database_manager import DatabaseManager
 from storage_manager import StorageManager
-from face_recognition_service import FaceRecognitionService
+from face_recognition_service import FaceRecognitionService, analyze_face_in_worker
+from face_gallery import FaceGallery, encoding_to_bytes, encoding_from_bytes
+from shared_gallery import SharedFaceGallery
+from quantized_gallery import QuantizedFaceGallery
+from ann_index import create_index
+from gallery_warmup import GalleryWarmup
+from event_bus import EventBus, ChangeStreamRelay, MenuPoller
+from write_queue import WriteBehindQueue
+from image_cache import FaceImageCache
+from matching_client import MatchingClient, MatchingServiceError
+import metrics
+
+# the shop this process serves; new customers are enrolled in its gallery shard
+BRANCH_NAME = os.getenv('BRANCH_NAME', 'Downtown Branch')
+
+DEFAULT_WRITE_QUEUE_PATH = Path(__file__).resolve().parent.parent / "data" / "write_queue.db"
+DEFAULT_IMAGE_CACHE_DIR = Path(__file__).resolve().parent.parent / "data" / "image_cache"
+DEFAULT_GALLERY_SPILL_DIR = Path(__file__).resolve().parent.parent / "data"
 
 class BackendServer:
     def __init__(self):
         self.db_manager = DatabaseManager()
         self.storage_manager = StorageManager()
-        self.face_service = FaceRecognitionService()
-        self.customer_encodings = {}
-        self._load_customer_encodings()
+        self.face_service = FaceRecognitionService(
+            detection_scale=float(os.getenv('DETECTION_SCALE', '1.0')),
+            upsample=int(os.getenv('DETECTION_UPSAMPLE', '1')),
+            detection_model=os.getenv('DETECTION_MODEL', 'hog')
+        )
+        
+        self.image_cache = FaceImageCache(
+            self.storage_manager,
+            os.getenv('IMAGE_CACHE_DIR', str(DEFAULT_IMAGE_CACHE_DIR)),
+            max_bytes=int(os.getenv('IMAGE_CACHE_MAX_MB', '256')) * 1024 * 1024,
+            etag_ttl=float(os.getenv('IMAGE_ETAG_TTL', '60')),
+            miss_ttl=float(os.getenv('IMAGE_MISS_TTL', '5'))
+        )
+        
+        # customer, visit, order and image writes are journaled locally and
+        # stored in the background, off the response path
+        self.write_queue = WriteBehindQueue(
+            self.db_manager,
+            self.storage_manager,
+            os.getenv('WRITE_QUEUE_PATH', str(DEFAULT_WRITE_QUEUE_PATH)),
+            batch_size=int(os.getenv('WRITE_QUEUE_BATCH_SIZE', '500')),
+            on_face_image_stored=self.image_cache.invalidate
+        ).start()
+        
+        # live updates for client and staff screens
+        self.event_bus = EventBus()
+        if os.getenv('EVENTS_FROM_CHANGE_STREAMS', '0') == '1':
+            ChangeStreamRelay(self.db_manager, self.event_bus, self.format_customer_summary).start()
+        # menu edits happen outside the app; change streams need a replica set
+        menu_poll_interval = float(os.getenv('MENU_POLL_INTERVAL', '10'))
+        if menu_poll_interval > 0:
+            MenuPoller(self.db_manager, self.event_bus, menu_poll_interval).start()
+        
+        # a branch kiosk can leave the gallery to the central matching service
+        matching_url = os.getenv('MATCHING_SERVICE_URL')
+        shared_dir = os.getenv('GALLERY_SHARED_DIR')
+        self._check_gallery_settings(matching_url, shared_dir)
+        self.shared_gallery = False
+        if matching_url:
+            self.customer_encodings = MatchingClient(matching_url, BRANCH_NAME)
+            self.gallery_warmup = None
+        elif shared_dir:
+            # one gallery in memory for all worker processes on this host;
+            # a new model version starts a new file
+            self.customer_encodings = SharedFaceGallery(
+                os.path.join(shared_dir, f"gallery_{self.face_service.model_version}")
+            )
+            self.shared_gallery = True
+            self._load_customer_encodings()
+        elif os.getenv('GALLERY_PRECISION', 'float32') == 'int8':
+            # int8 codes in memory, float32 encodings in a scratch file for re-ranking
+            self.customer_encodings = QuantizedFaceGallery(
+                shortlist=int(os.getenv('GALLERY_SHORTLIST', '32')),
+                spill_dir=os.getenv('GALLERY_SPILL_DIR', str(DEFAULT_GALLERY_SPILL_DIR))
+            )
+            self._load_customer_encodings()
+        else:
+            self.customer_encodings = FaceGallery(index=self._create_gallery_index())
+            self._load_customer_encodings()
+        
+        self._register_metrics()
+        if os.getenv('PROFILER_ENABLED', '0') == '1':
+            metrics.profiler.enable()
+    
+    def _register_metrics(self):
+        """Expose state kept elsewhere on /metrics, read when scraped"""
+        def cache_samples(field):
+            samples = [({'cache': name}, stats[field]) for name, stats in self.db_manager.cache_stats().items()]
+            samples.append(({'cache': 'image_etag'}, self.image_cache.etags.stats()[field]))
+            samples.append(({'cache': 'image_missing'}, self.image_cache.missing.stats()[field]))
+            samples.append(({'cache': 'image_file'}, getattr(self.image_cache, field)))
+            return samples
+        
+        if not isinstance(self.customer_encodings, MatchingClient):
+            metrics.CallbackMetric('gallery_size', 'Faces in the matching gallery', lambda: len(self.customer_encodings))
+        metrics.CallbackMetric('cache_hits_total', 'Cache hits', lambda: cache_samples('hits'), kind='counter')
+        metrics.CallbackMetric('cache_misses_total', 'Cache misses', lambda: cache_samples('misses'), kind='counter')
+        metrics.CallbackMetric('write_queue_pending', 'Writes journaled but not yet stored', self.write_queue.pending)
+        metrics.CallbackMetric('write_queue_dead_letters', 'Writes given up on until the next start', self.write_queue.dead_letters)
+        metrics.CallbackMetric('gallery_warmup_running', '1 while stale encodings are being rebuilt', lambda: int(self._gallery_loading()))
+    
+    def _check_gallery_settings(self, matching_url, shared_dir):
+        """Refuse gallery settings that the gallery in use would silently ignore"""
+        index = os.getenv('GALLERY_INDEX', 'exact')
+        precision = os.getenv('GALLERY_PRECISION', 'float32')
+        chosen = [setting for setting, is_set in (
+            ('MATCHING_SERVICE_URL', bool(matching_url)),
+            ('GALLERY_SHARED_DIR', bool(shared_dir)),
+            (f'GALLERY_PRECISION={precision}', precision != 'float32'),
+            (f'GALLERY_INDEX={index}', index != 'exact')
+        ) if is_set]
+        if len(chosen) > 1:
+            raise ValueError(f"Conflicting gallery settings {', '.join(chosen)}: each picks a different gallery, set only one")
+    
+    def _create_gallery_index(self):
+        kind = os.getenv('GALLERY_INDEX', 'exact')
+        if kind == 'ivf':
+            return create_index(
+                'ivf',
+                nlist=int(os.getenv('IVF_NLIST', '256')),
+                nprobe=int(os.getenv('IVF_NPROBE', '8')),
+                min_train_size=int(os.getenv('IVF_MIN_TRAIN_SIZE', '4096'))
+            )
+        return create_index(kind)
     
     def _load_customer_encodings(self):
-        customers = self.db_manager.get_all_customers()
+        model_version = self.face_service.model_version
+        customer_ids = []
+        encodings = []
         
-        for customer in customers:
-            customer_id = customer['customer_id']
-            face_image_data = self.storage_manager.download_face_image(customer_id)
+        # stored encodings are bulk-loaded; customers without one for the
+        # current model are re-encoded from their images in the background.
+        # With a shared gallery the first worker loads and the others only
+        # add what is still missing once it is done
+        with self.customer_encodings.exclusive() if self.shared_gallery else nullcontext():
+            # customers still journaled may be stored while MongoDB is being
+            # read, so the journal is read first: a customer the drain stores
+            # in the meantime is then in MongoDB by the time it is queried
+            journaled = self.write_queue.pending_customers(model_version)
+            for customer in self.db_manager.get_customer_encodings(model_version):
+                if self.shared_gallery and customer['customer_id'] in self.customer_encodings:
+                    continue
+                customer_ids.append(customer['customer_id'])
+                encodings.append(encoding_from_bytes(customer['face_encoding']))
             
-            if face_image_data:
-                encoding = self.face_service.encode_face(face_image_data)
-                if encoding is not None:
-                    self.customer_encodings[customer_id] = encoding
+            stored_count = len(customer_ids)
+            loaded = set(customer_ids)
+            for customer_id, face_encoding in journaled:
+                if customer_id in loaded or (self.shared_gallery and customer_id in self.customer_encodings):
+                    continue
+                loaded.add(customer_id)
+                customer_ids.append(customer_id)
+                encodings.append(encoding_from_bytes(face_encoding))
             
-    def process_face_recognition_request(self, image_data, branch_name):        
-        # encode face
-        captured_encoding = self.face_service.encode_face(image_data)
+            self.customer_encodings.add_many(customer_ids, encodings)
+        print(f"Loaded {stored_count} stored and {len(customer_ids) - stored_count} journaled face encodings")
         
-        if captured_encoding is None:
+        on_finished = None
+        if self.shared_gallery:
+            if not self.customer_encodings.claim_warmup():
+                # another worker is rebuilding stale encodings
+                self.gallery_warmup = None
+                return
+            on_finished = self.customer_encodings.release_warmup
+        
+        self.gallery_warmup = GalleryWarmup(
+            self.db_manager,
+            self.storage_manager,
+            self.customer_encodings,
+            model_version,
+            fetch_workers=int(os.getenv('WARMUP_FETCH_WORKERS', '8')),
+            encode_workers=int(os.getenv('WARMUP_ENCODE_WORKERS', '0')) or None,
+            on_finished=on_finished
+        )
+        self.gallery_warmup.start()
+            
+    def process_face_recognition_request(self, image_data, branch_name, face_hints=None, record_visit=True):        
+        with metrics.span('recognition_request'):
+            # detect, encode and crop in a single pass
+            with metrics.span('analyze'):
+                analysis = self.face_service.analyze_face(image_data, face_hints)
+            
+            return self.process_face_analysis(analysis, branch_name, record_visit)
+    
+    def process_face_analysis(self, analysis, branch_name, record_visit=True):
+        """Match an analysed face, enrolling it as a new customer if unknown.
+        
+        analysis is None when no face was found in the frame.
+        record_visit=False looks the customer up without counting a visit,
+        e.g. when re-verifying a face that is already being tracked.
+        """
+        if analysis is None:
+            metrics.recognitions.inc(status='no_face')
             return {
                 'status': 'error',
                 'message': 'No face detected in image'
             }
         
         # find 
-        matched_customer_id = self.face_service.find_matching_customer(
-            captured_encoding, 
-            self.customer_encodings
-        )
+        try:
+            matched_customer_id, match_distance = self.face_service.find_matching_customer(
+                analysis.encoding, 
+                self.customer_encodings
+            )
+        except MatchingServiceError as e:
+            print(f"Error matching face: {e}")
+            metrics.recognitions.inc(status='matching_unavailable')
+            return self._matching_unavailable_response()
         
-        if matched_customer_id:            
-            customer = self.db_manager.get_customer(matched_customer_id)
+        return self.process_face_match(analysis, matched_customer_id, match_distance, branch_name, record_visit)
+    
+    def process_faces_request(self, image_data, branch_name, face_hints=None, record_visit=True):
+        """Recognize every face in the frame; returns one result per face.
+        
+        The faces are encoded in one pass and matched against the gallery
+        in one batch.
+        """
+        with metrics.span('faces_request'):
+            with metrics.span('analyze'):
+                analyses = self.face_service.analyze_faces(image_data, face_hints)
             
-            # get orders
-            latest_order = self.db_manager.get_latest_order(matched_customer_id)
+            if not analyses:
+                metrics.recognitions.inc(status='no_face')
+                return {
+                    'status': 'error',
+                    'message': 'No face detected in image'
+                }
             
-            # get history
-            order_history = self.db_manager.get_customer_order_history(matched_customer_id, limit=5)
+            try:
+                matches = self.match_faces([analysis.encoding for analysis in analyses])
+            except MatchingServiceError as e:
+                print(f"Error matching faces: {e}")
+                metrics.recognitions.inc(len(analyses), status='matching_unavailable')
+                return self._matching_unavailable_response()
             
-            self.db_manager.update_customer_visit(matched_customer_id)
+            # process_face_match counts each face's outcome and times its
+            # lookup or enrollment
+            faces = []
+            for analysis, (matched_customer_id, match_distance) in zip(analyses, matches):
+                result = self.process_face_match(analysis, matched_customer_id, match_distance, branch_name, record_visit)
+                top, right, bottom, left = analysis.location
+                result['location'] = {'top': top, 'right': right, 'bottom': bottom, 'left': left}
+                faces.append(result)
             
-            response = {
-                'status': 'recognized',
-                'customer_id': matched_customer_id,
-                'customer_name': customer.get('name', 'Unknown'),
-                'total_visits': customer.get('total_visits', 0),
-                'last_visit': customer.get('last_visit', datetime.now()).strftime('%Y-%m-%d %H:%M:%S'),
-                'latest_order': self._format_order(latest_order) if latest_order else None,
-                'order_history': [self._format_order(order) for order in order_history]
+            return {
+                'status': 'success',
+                'faces': faces
             }
+    
+    def match_faces(self, encodings):
+        """(customer_id, distance) per encoding from one batched gallery lookup"""
+        return self.face_service.find_matching_customers(encodings, self.customer_encodings)
+    
+    def process_face_match(self, analysis, matched_customer_id, match_distance, branch_name, record_visit=True):
+        """Build the response for an already matched face, enrolling it if matched_customer_id is None"""
+        if matched_customer_id:            
+            metrics.recognitions.inc(status='recognized')
+            with metrics.span('customer_lookup'):
+                if record_visit:
+                    customer = self._record_visit(matched_customer_id)
+                    self._publish_visit(customer)
+                else:
+                    customer = self.db_manager.get_customer(matched_customer_id)
+                
+                order_history = self.db_manager.get_customer_order_history(matched_customer_id, limit=5)
             
-            return response
+            return self._recognized_response(matched_customer_id, match_distance, customer, order_history)
+        elif self._gallery_loading():
+            metrics.recognitions.inc(status='gallery_loading')
+            return self._gallery_loading_response()
         else:
+            metrics.recognitions.inc(status='new_customer')
             customer_id = str(uuid.uuid4())
             
-            # save face
-            face_image = self.face_service.extract_face_from_image(image_data)
-            if face_image:
-                image_path = self.storage_manager.upload_face_image(customer_id, face_image)
-            else:
-                image_path = self.storage_manager.upload_face_image(customer_id, image_data)
-            
-            
-            self.db_manager.create_customer(
-                customer_id=customer_id,
-                name=f"Customer_{customer_id[:8]}",
-                face_image_path=image_path
-            )
-            
-            
-            self.customer_encodings[customer_id] = captured_encoding
-            
-            response = {
-                'status': 'new_customer',
-                'customer_id': customer_id,
-                'customer_name': f"Customer_{customer_id[:8]}",
-                'message': 'New customer registered successfully',
-                'total_visits': 1
-            }
+            with metrics.span('enroll'):
+                self._store_new_customer(customer_id, analysis, branch_name)
+                return self._enroll_customer(customer_id, analysis.encoding)
+    
+    async def process_face_recognition_request_async(self, image_data, branch_name, face_hints=None, cpu_executor=None):
+        """Asyncio variant of process_face_recognition_request.
+        
+        Detection and encoding run in cpu_executor (a process pool); the
+        match and the customer lookup or enrollment run in a thread, through
+        the same process_face_analysis as the synchronous path.
+        """
+        loop = asyncio.get_running_loop()
+        with metrics.span('recognition_request'):
+            # the worker times decode/detect/encode/crop and hands the timings
+            # back; analyze is the wall time the request waited for them
+            with metrics.span('analyze'):
+                analysis, timings = await loop.run_in_executor(
+                    cpu_executor,
+                    analyze_face_in_worker,
+                    image_data,
+                    face_hints,
+                    self.face_service.detection_settings()
+                )
+            metrics.record_spans(timings)
+            if analysis is None:
+                # counted in the worker, whose registry is never scraped
+                metrics.no_face_frames.inc()
             
-            return response
+            return await asyncio.to_thread(self.process_face_analysis, analysis, branch_name)
+    
+    def _record_visit(self, customer_id):
+        """Queue a visit and return the customer as it was before it"""
+        customer = self.db_manager.get_customer(customer_id)
+        self.write_queue.record_visit(customer_id)
+        return customer
+    
+    def _recognized_response(self, customer_id, match_distance, customer, order_history):
+        customer = customer or {}
+        # history is newest first, so it already holds the latest order
+        latest_order = order_history[0] if order_history else None
+        
+        return {
+            'status': 'recognized',
+            'customer_id': customer_id,
+            'customer_name': customer.get('name', 'Unknown'),
+            'match_distance': round(match_distance, 4),
+            'total_visits': customer.get('total_visits', 0),
+            'last_visit': customer.get('last_visit', datetime.now()).strftime('%Y-%m-%d %H:%M:%S'),
+            'latest_order': self._format_order(latest_order) if latest_order else None,
+            'order_history': [self._format_order(order) for order in order_history]
+        }
+    
+    def _gallery_loading(self):
+        if self.shared_gallery and self.customer_encodings.warmup_running_elsewhere():
+            return True
+        return self.gallery_warmup is not None and self.gallery_warmup.running
+    
+    def _matching_unavailable_response(self):
+        # unmatched faces must not be enrolled while matching is down,
+        # or every returning customer would be registered again
+        return {
+            'status': 'error',
+            'message': 'Face matching is unavailable, please try again'
+        }
+    
+    def _gallery_loading_response(self):
+        # the face may belong to a customer whose encoding is still
+        # being rebuilt, so hold off enrolling rather than duplicate them
+        return {
+            'status': 'error',
+            'message': 'Customer gallery is still loading, please try again'
+        }
+    
+    def _store_new_customer(self, customer_id, analysis, branch_name):
+        # save face
+        image_path = self.save_face_image(customer_id, analysis.face_image)
+        
+        self.write_queue.create_customer(
+            customer_id=customer_id,
+            name=f"Customer_{customer_id[:8]}",
+            face_image_path=image_path,
+            face_encoding=encoding_to_bytes(analysis.encoding),
+            encoding_model=self.face_service.model_version,
+            branch=branch_name
+        )
+    
+    def save_face_image(self, customer_id, face_image):
+        return self.write_queue.upload_face_image(customer_id, face_image)
+    
+    def _enroll_customer(self, customer_id, encoding):
+        """Make a newly stored customer matchable and announce them"""
+        try:
+            self.customer_encodings[customer_id] = encoding
+        except MatchingServiceError as e:
+            # stored in MongoDB, so the matching service picks it up on restart
+            print(f"Error enrolling customer {customer_id}: {e}")
+        
+        now = datetime.now()
+        self.event_bus.publish('customer_created', self.format_customer_summary({
+            'customer_id': customer_id,
+            'name': f"Customer_{customer_id[:8]}",
+            'total_visits': 1,
+            'last_visit': now,
+            'created_at': now
+        }))
+        
+        return {
+            'status': 'new_customer',
+            'customer_id': customer_id,
+            'customer_name': f"Customer_{customer_id[:8]}",
+            'message': 'New customer registered successfully',
+            'total_visits': 1
+        }
     
     def _format_order(self, order):
         if not order:
@@ -103,9 +408,38 @@ class BackendServer:
             'branch': order.get('branch', 'Unknown')
         }
     
+    def format_customer_summary(self, customer):
+        return {
+            'customer_id': customer['customer_id'],
+            'name': customer['name'],
+            'total_visits': customer.get('total_visits', 0),
+            'last_visit': customer.get('last_visit').strftime('%Y-%m-%d %H:%M:%S') if customer.get('last_visit') else 'N/A',
+            'created_at': customer.get('created_at').strftime('%Y-%m-%d %H:%M:%S') if customer.get('created_at') else 'N/A'
+        }
+    
+    def _publish_visit(self, customer_before):
+        if not customer_before:
+            return
+        
+        # the visit is counted on a copy of the customer from before it
+        customer = dict(customer_before)
+        customer['total_visits'] = customer.get('total_visits', 0) + 1
+        customer['last_visit'] = datetime.now()
+        self.event_bus.publish('visit_recorded', self.format_customer_summary(customer))
+    
+    def record_customer_visit(self, customer_id):
+        self._publish_visit(self._record_visit(customer_id))
+    
     def add_order_for_customer(self, customer_id, items, total_price, branch):
-        order_id = self.db_manager.add_order(customer_id, items, total_price, branch)
+        order_id = self.write_queue.add_order(customer_id, items, total_price, branch)
+        self.event_bus.publish('order_placed', {
+            'customer_id': customer_id,
+            'order_id': order_id,
+            'total_price': total_price,
+            'branch': branch
+        })
         return {'status': 'success', 'order_id': order_id}
     
     def close(self):
+        self.write_queue.stop()
         self.db_manager.close()
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""
+Detection Benchmark
+Compare accuracy and latency of FaceRecognitionService detection settings
+
+Usage:
+    python3 benchmark_detection.py <image_dir> [--repeat 3] [--cnn]
+
+Every image is first analysed with the reference setting (full resolution,
+HOG, one upsample). Each other setting is then scored on latency and on how
+often it finds the same face, i.e. its encoding lies within the matching
+tolerance of the reference encoding.
+"""
+import argparse
+import itertools
+import time
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from face_recognition_service import FaceRecognitionService
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+
+def load_images(image_dir):
+    images = []
+    for path in sorted(Path(image_dir).iterdir()):
+        if path.suffix.lower() in IMAGE_SUFFIXES:
+            images.append(np.asarray(Image.open(path).convert('RGB')))
+    return images
+
+def run_setting(service, images, repeat):
+    """Return (per-image encodings, mean latency in ms)"""
+    encodings = []
+    elapsed = 0.0
+    for image in images:
+        analysis = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            analysis = service.analyze_face(image)
+            elapsed += time.perf_counter() - start
+        encodings.append(analysis.encoding if analysis else None)
+    return encodings, 1000.0 * elapsed / (len(images) * repeat)
+
+def benchmark(image_dir, repeat=3, include_cnn=False):
+    images = load_images(image_dir)
+    if not images:
+        print(f"No images found in {image_dir}")
+        return []
+
+    reference_service = FaceRecognitionService()
+    reference, reference_ms = run_setting(reference_service, images, repeat)
+    found = [encoding is not None for encoding in reference]
+    print(f"Reference (scale=1.0, upsample=1, hog): {sum(found)}/{len(images)} faces, {reference_ms:.1f} ms/frame")
+
+    models = ['hog', 'cnn'] if include_cnn else ['hog']
+    results = []
+    for scale, upsample, model in itertools.product([1.0, 0.5, 0.25], [0, 1, 2], models):
+        service = FaceRecognitionService(detection_scale=scale, upsample=upsample, detection_model=model)
+        encodings, mean_ms = run_setting(service, images, repeat)
+
+        matched = 0
+        distances = []
+        for ref, encoding in zip(reference, encodings):
+            if ref is None or encoding is None:
+                continue
+            distance = float(np.linalg.norm(ref - encoding))
+            distances.append(distance)
+            matched += distance <= service.tolerance
+
+        results.append({
+            'scale': scale,
+            'upsample': upsample,
+            'model': model,
+            'ms_per_frame': round(mean_ms, 2),
+            'speedup': round(reference_ms / mean_ms, 2) if mean_ms else None,
+            'detected': sum(encoding is not None for encoding in encodings),
+            'agreement': round(matched / max(1, sum(found)), 3),
+            'mean_distance': round(float(np.mean(distances)), 4) if distances else None
+        })
+
+    print(f"\n{'scale':>6} {'up':>3} {'model':>5} {'ms/frame':>9} {'speedup':>8} {'detected':>9} {'agree':>6} {'dist':>7}")
+    for r in results:
+        print(f"{r['scale']:>6} {r['upsample']:>3} {r['model']:>5} {r['ms_per_frame']:>9} "
+              f"{r['speedup']:>8} {r['detected']:>9} {r['agreement']:>6} {r['mean_distance']!s:>7}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir', help='directory of sample frames (jpg/png)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per image')
+    parser.add_argument('--cnn', action='store_true', help='also benchmark the CNN detector on CPU')
+    args = parser.parse_args()
+
+    benchmark(args.image_dir, args.repeat, args.cnn)
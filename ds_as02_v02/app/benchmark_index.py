@@ -0,0 +1,117 @@
+"""
+Index Benchmark
+Measure the recall and lookup latency of the IVF gallery index against an
+exact scan
+
+Usage:
+    python3 benchmark_index.py [--faces 65536] [--queries 500]
+        [--nlist 256] [--nprobe 4 8 16 32] [--from-db]
+
+Recall is the fraction of lookups where the IVF index returns the same
+customer as a brute-force scan. Probes are enrolled faces re-captured with
+some noise (also reported on their own as "returning"), plus strangers. The gallery is synthetic (clustered random
+encodings) unless --from-db is given, in which case the stored encodings of
+the current model are loaded from MongoDB. Also reports how long the add()
+that triggers a retrain takes; the k-means itself runs in the background.
+"""
+import argparse
+import time
+import numpy as np
+from ann_index import IVFIndex, measure_recall
+from face_gallery import FaceGallery, ENCODING_SIZE, encoding_from_bytes
+
+
+def synthetic_encodings(count, rng, clusters=2000, spread=0.05):
+    centres = rng.normal(0.0, 0.09, (clusters, ENCODING_SIZE))
+    return (centres[rng.integers(clusters, size=count)]
+            + rng.normal(0.0, spread, (count, ENCODING_SIZE))).astype(np.float32)
+
+
+def stored_encodings():
+    from database_manager import DatabaseManager
+    from face_recognition_service import ENCODING_MODEL_VERSION
+    customers = DatabaseManager().get_customer_encodings(ENCODING_MODEL_VERSION)
+    return np.array([encoding_from_bytes(customer['face_encoding']) for customer in customers], dtype=np.float32)
+
+
+def probes_for(encodings, rng, count, noise=0.02):
+    returning = count // 2
+    return np.vstack([
+        encodings[rng.integers(len(encodings), size=returning)] + rng.normal(0.0, noise, (returning, ENCODING_SIZE)),
+        rng.normal(0.0, 0.09, (count - returning, ENCODING_SIZE))
+    ]).astype(np.float32)
+
+
+def mean_lookup_ms(gallery, probes, exact=False):
+    start = time.perf_counter()
+    for probe in probes:
+        gallery.best_match(probe, exact=exact)
+    return 1000.0 * (time.perf_counter() - start) / len(probes)
+
+
+def wait_for_training(index):
+    while index.training:
+        time.sleep(0.05)
+
+
+def retrain_add_ms(encodings, nlist):
+    """Latency of the add() that doubles a trained gallery, i.e. starts a retrain"""
+    half = len(encodings) // 2
+    index = IVFIndex(nlist=nlist, min_train_size=nlist)
+    gallery = FaceGallery(index=index)
+    ids = [f"bench-{i:08d}" for i in range(len(encodings))]
+    gallery.add_many(ids[:half], encodings[:half])
+    wait_for_training(index)
+
+    gallery.add_many(ids[half:-1], encodings[half:-1])
+    start = time.perf_counter()
+    gallery.add(ids[-1], encodings[-1])
+    return 1000.0 * (time.perf_counter() - start)
+
+
+def benchmark(faces=65536, queries=500, nlist=256, nprobes=(4, 8, 16, 32), from_db=False, seed=0):
+    rng = np.random.default_rng(seed)
+    encodings = stored_encodings() if from_db else synthetic_encodings(faces, rng)
+    if len(encodings) < nlist:
+        print(f"Need at least {nlist} faces, got {len(encodings)}")
+        return []
+
+    ids = [f"bench-{i:08d}" for i in range(len(encodings))]
+    index = IVFIndex(nlist=nlist)
+    gallery = FaceGallery(index=index)
+    gallery.add_many(ids, encodings)
+    wait_for_training(index)
+
+    probes = probes_for(encodings, rng, queries)
+    exact_ms = mean_lookup_ms(gallery, probes, exact=True)
+    print(f"{len(gallery)} faces, {queries} probes, exact scan {exact_ms:.3f} ms/lookup")
+
+    results = []
+    for nprobe in nprobes:
+        index.nprobe = nprobe
+        lookup_ms = mean_lookup_ms(gallery, probes)
+        results.append({
+            'nprobe': nprobe,
+            'recall': round(measure_recall(gallery, probes), 4),
+            'recall_returning': round(measure_recall(gallery, probes[:queries // 2]), 4),
+            'ms_per_lookup': round(lookup_ms, 3),
+            'speedup': round(exact_ms / lookup_ms, 2) if lookup_ms else None
+        })
+
+    print(f"\n{'nprobe':>7} {'recall':>7} {'returning':>10} {'ms/lookup':>10} {'speedup':>8}")
+    for r in results:
+        print(f"{r['nprobe']:>7} {r['recall']:>7} {r['recall_returning']:>10} {r['ms_per_lookup']:>10} {r['speedup']!s:>8}")
+    print(f"\nadd() that starts a retrain: {retrain_add_ms(encodings, nlist):.2f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--faces', type=int, default=65536, help='synthetic gallery size')
+    parser.add_argument('--queries', type=int, default=500, help='probe lookups per setting')
+    parser.add_argument('--nlist', type=int, default=256, help='k-means buckets')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32], help='buckets scanned per lookup')
+    parser.add_argument('--from-db', action='store_true', help='use the stored encodings instead of a synthetic gallery')
+    args = parser.parse_args()
+
+    benchmark(args.faces, args.queries, args.nlist, args.nprobe, args.from_db)
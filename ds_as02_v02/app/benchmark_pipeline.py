@@ -0,0 +1,355 @@
+"""
+Pipeline Benchmark
+Measure gallery warm-up, per-stage capture latency and capture throughput
+offline, against mongomock and an in-memory MinIO stand-in
+
+Usage:
+    python3 benchmark_pipeline.py [--customers 10000] [--stale 0.01]
+        [--image-dir <dir>] [--requests 200] [--concurrency 4]
+        [--output result.json] [--compare previous.json]
+
+The synthetic gallery holds random 128-d encodings and a generated JPEG
+per customer; --stale is the fraction stored without an encoding, which
+the warm-up has to rebuild from the images. The same encodings are also
+matched with the int8 gallery (GALLERY_PRECISION=int8) and the float32
+one, to check the int8 results agree and compare memory and latency. Capture stages run on the
+frames in --image-dir (real faces are needed for detect/encode to do real
+work); without it a synthetic frame is used and match/DB use a random
+encoding. Throughput is measured on BackendServer's capture path, i.e.
+/api/capture_face without the camera; benchmark_serving.py drives the
+real HTTP route.
+
+The result is printed as JSON (and written to --output); --compare prints
+the relative change of every number against an earlier result.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+
+
+class _FakeObject:
+    def __init__(self, data, etag):
+        self._data = data
+        self.headers = {'ETag': f'"{etag}"'}
+
+    def read(self):
+        return self._data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class _FakeStat:
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class FakeMinio:
+    """The subset of the Minio client StorageManager uses, kept in memory"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def _missing(self, object_name):
+        from minio.error import S3Error
+        return S3Error('NoSuchKey', 'Object does not exist', object_name, None, None, None)
+
+    def bucket_exists(self, bucket_name):
+        return True
+
+    def make_bucket(self, bucket_name):
+        pass
+
+    def put_object(self, bucket_name, object_name, data, length, content_type=None):
+        payload = data.read(length)
+        self.objects[object_name] = (payload, hashlib.md5(payload).hexdigest())
+
+    def get_object(self, bucket_name, object_name):
+        if object_name not in self.objects:
+            raise self._missing(object_name)
+        return _FakeObject(*self.objects[object_name])
+
+    def stat_object(self, bucket_name, object_name):
+        if object_name not in self.objects:
+            raise self._missing(object_name)
+        return _FakeStat(self.objects[object_name][1])
+
+    def remove_object(self, bucket_name, object_name):
+        self.objects.pop(object_name, None)
+
+
+def install_fakes(workdir):
+    """Point the shared clients and local state at mongomock, FakeMinio and workdir"""
+    import mongomock
+    import clients
+
+    os.environ.setdefault('MONGO_DB', 'benchmark')
+    os.environ['WRITE_QUEUE_PATH'] = str(Path(workdir) / 'write_queue.db')
+    os.environ['IMAGE_CACHE_DIR'] = str(Path(workdir) / 'image_cache')
+    clients._mongo_client = mongomock.MongoClient()
+    clients._minio_client = FakeMinio()
+
+
+def synthetic_jpeg(rng, size=160):
+    image = Image.fromarray(rng.integers(0, 255, (size, size, 3), dtype=np.uint8))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def populate(customers, stale, model_version, seed=0):
+    """Fill the fake stores with a synthetic gallery; returns the encodings"""
+    from database_manager import DatabaseManager
+    from storage_manager import StorageManager
+    from face_gallery import encoding_to_bytes
+
+    rng = np.random.default_rng(seed)
+    db_manager = DatabaseManager()
+    db_manager.create_indexes()
+    storage_manager = StorageManager()
+
+    # dlib encodings are roughly unit length with small components
+    encodings = rng.normal(0.0, 0.09, (customers, 128)).astype(np.float32)
+    image = synthetic_jpeg(rng)
+    now = datetime.now()
+    batch = []
+    for i in range(customers):
+        customer_id = f"bench-{i:08d}"
+        customer = {
+            'customer_id': customer_id,
+            'name': f"Customer_{i}",
+            'face_image_path': storage_manager.face_object_name(customer_id),
+            'branch': 'Benchmark Branch',
+            'created_at': now,
+            'last_visit': now,
+            'total_visits': 1
+        }
+        if rng.random() >= stale:
+            customer['face_encoding'] = encoding_to_bytes(encodings[i])
+            customer['encoding_model'] = model_version
+        batch.append(customer)
+        storage_manager.upload_face_image(customer_id, image)
+        if len(batch) == 5000:
+            db_manager.customers.insert_many(batch)
+            batch = []
+    if batch:
+        db_manager.customers.insert_many(batch)
+    return encodings
+
+
+def load_frames(image_dir, rng):
+    if not image_dir:
+        return [np.asarray(Image.open(io.BytesIO(synthetic_jpeg(rng, 480))).convert('RGB'))]
+    frames = []
+    for path in sorted(Path(image_dir).iterdir()):
+        if path.suffix.lower() in IMAGE_SUFFIXES:
+            frames.append(path.read_bytes())
+    return frames
+
+
+def summarize(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        'mean_ms': round(float(samples.mean()), 3),
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p95_ms': round(float(np.percentile(samples, 95)), 3),
+        'max_ms': round(float(samples.max()), 3)
+    }
+
+
+def measure_stages(backend, frames, repeat, rng):
+    """Latency of each step of a capture, run one after another"""
+    import face_recognition
+
+    service = backend.face_service
+    stages = {'decode': [], 'detect': [], 'encode': [], 'match': [], 'db': []}
+    customer_ids = backend.customer_encodings.ids()
+
+    for _ in range(repeat):
+        for frame in frames:
+            start = time.perf_counter()
+            image_np = service._to_array(frame if isinstance(frame, np.ndarray) else Image.open(io.BytesIO(frame)))
+            stages['decode'].append(1000 * (time.perf_counter() - start))
+
+            start = time.perf_counter()
+            locations = service.detect_faces(image_np)
+            stages['detect'].append(1000 * (time.perf_counter() - start))
+
+            encoding = None
+            if locations:
+                start = time.perf_counter()
+                encoding = face_recognition.face_encodings(image_np, locations[:1])[0]
+                stages['encode'].append(1000 * (time.perf_counter() - start))
+            if encoding is None:
+                encoding = rng.normal(0.0, 0.09, 128).astype(np.float32)
+
+            start = time.perf_counter()
+            service.find_matching_customer(encoding, backend.customer_encodings)
+            stages['match'].append(1000 * (time.perf_counter() - start))
+
+            # the reads and the queued visit a recognized customer costs
+            customer_id = customer_ids[int(rng.integers(len(customer_ids)))]
+            start = time.perf_counter()
+            backend._record_visit(customer_id)
+            backend.db_manager.get_customer_order_history(customer_id, limit=5)
+            stages['db'].append(1000 * (time.perf_counter() - start))
+
+    return {name: summarize(samples) for name, samples in stages.items() if samples}
+
+
+def measure_quantization(encodings, rng, queries=200, noise=0.02):
+    """int8 gallery against the float32 one: memory, agreement and lookup latency"""
+    from face_gallery import FaceGallery, ENCODING_SIZE
+    from quantized_gallery import QuantizedFaceGallery
+    from ann_index import measure_recall
+
+    ids = [f"bench-{i:08d}" for i in range(len(encodings))]
+    reference = FaceGallery()
+    reference.add_many(ids, encodings)
+    quantized = QuantizedFaceGallery(spill_dir=tempfile.mkdtemp(prefix='coffeehouse-bench-'))
+    quantized.add_many(ids, encodings)
+
+    # returning customers, re-captured with some noise, and strangers
+    returning = queries // 2
+    probes = np.vstack([
+        encodings[rng.integers(len(encodings), size=returning)] + rng.normal(0.0, noise, (returning, ENCODING_SIZE)),
+        rng.normal(0.0, 0.09, (queries - returning, ENCODING_SIZE))
+    ]).astype(np.float32)
+
+    def lookups(gallery):
+        samples = []
+        for probe in probes:
+            start = time.perf_counter()
+            gallery.best_match(probe)
+            samples.append(1000 * (time.perf_counter() - start))
+        return summarize(samples)
+
+    distance_error = max(
+        abs(expected[1] - actual[1])
+        for expected, actual in zip(reference.best_matches(probes), quantized.best_matches(probes))
+    )
+    return {
+        'float32_bytes_per_face': ENCODING_SIZE * 4 + 4,
+        'int8_bytes_per_face': quantized.nbytes // len(quantized),
+        'agreement': measure_recall(quantized, probes, reference=reference),
+        'max_distance_error': float(distance_error),
+        'float32_match': lookups(reference),
+        'int8_match': lookups(quantized)
+    }
+
+
+def measure_throughput(backend, frames, total_requests, concurrency):
+    def capture(i):
+        frame = frames[i % len(frames)]
+        start = time.perf_counter()
+        backend.process_face_recognition_request(frame, 'Benchmark Branch')
+        return 1000 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(capture, range(total_requests)))
+    elapsed = time.perf_counter() - start
+
+    result = summarize(latencies)
+    result.update({
+        'concurrency': concurrency,
+        'requests': total_requests,
+        'requests_per_s': round(total_requests / elapsed, 2)
+    })
+    return result
+
+
+def benchmark(customers=10000, stale=0.01, image_dir=None, repeat=3, total_requests=200, concurrency=4, seed=0):
+    workdir = tempfile.mkdtemp(prefix='coffeehouse-bench-')
+    install_fakes(workdir)
+
+    from face_recognition_service import ENCODING_MODEL_VERSION
+    from backend_server import BackendServer
+
+    start = time.perf_counter()
+    encodings = populate(customers, stale, ENCODING_MODEL_VERSION, seed)
+    populate_s = time.perf_counter() - start
+
+    # the constructor bulk-loads stored encodings, then starts the warm-up
+    start = time.perf_counter()
+    backend = BackendServer()
+    load_s = time.perf_counter() - start
+    warmup = backend.gallery_warmup
+    if warmup is not None:
+        warmup.wait()
+    warmup_s = time.perf_counter() - start
+
+    rng = np.random.default_rng(seed)
+    frames = load_frames(image_dir, rng)
+    result = {
+        'config': {
+            'customers': customers,
+            'stale_fraction': stale,
+            'frames': len(frames),
+            'image_dir': str(image_dir) if image_dir else None,
+            'gallery_index': os.getenv('GALLERY_INDEX', 'exact'),
+            'detection_scale': backend.face_service.detection_scale,
+            'concurrency': concurrency
+        },
+        'startup': {
+            'populate_s': round(populate_s, 3),
+            'load_stored_encodings_s': round(load_s, 3),
+            'warmup_total_s': round(warmup_s, 3),
+            'reencoded': warmup.encoded if warmup else 0,
+            'reencode_failed': warmup.failed if warmup else 0,
+            'gallery_size': len(backend.customer_encodings)
+        },
+        'stages': measure_stages(backend, frames, repeat, rng),
+        'quantized_gallery': measure_quantization(encodings, rng),
+        'throughput': measure_throughput(backend, frames, total_requests, concurrency)
+    }
+    backend.write_queue.stop()
+    return result
+
+
+def compare(current, previous, path=''):
+    """Print the relative change of every number present in both results"""
+    for key, value in current.items():
+        old = previous.get(key) if isinstance(previous, dict) else None
+        name = f"{path}.{key}" if path else key
+        if isinstance(value, dict):
+            compare(value, old or {}, name)
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and not isinstance(value, bool):
+            change = f"{100.0 * (value - old) / old:+.1f}%" if old else 'n/a'
+            print(f"{name:<45} {old:>12} -> {value:<12} {change}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=10000, help='synthetic gallery size')
+    parser.add_argument('--stale', type=float, default=0.01, help='fraction of customers without a stored encoding')
+    parser.add_argument('--image-dir', help='frames with real faces for the capture stages')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the frames for stage timings')
+    parser.add_argument('--requests', type=int, default=200, help='captures in the throughput run')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the JSON result here')
+    parser.add_argument('--compare', help='earlier JSON result to compare against')
+    args = parser.parse_args()
+
+    result = benchmark(args.customers, args.stale, args.image_dir, args.repeat, args.requests, args.concurrency, args.seed)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+    if args.compare:
+        print()
+        compare(result, json.loads(Path(args.compare).read_text()))
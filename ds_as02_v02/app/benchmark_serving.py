@@ -0,0 +1,58 @@
+"""
+Serving Benchmark
+Drive concurrent recognition requests against a running server
+
+Usage:
+    python3 benchmark_serving.py [--url http://localhost:5001] [--concurrency 8] [--requests 200]
+
+Start the server with CAPTURE_COOLDOWN=0 so every request runs the full
+recognition path, then compare the Flask server (main.py, port 5001) with
+the async server (async_server.py, port 5002).
+"""
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+def post_capture(url):
+    """Return (latency in ms, response status)"""
+    req = urllib.request.Request(
+        f"{url}/api/capture_face",
+        data=b'{}',
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            status = json.loads(resp.read()).get('status', 'unknown')
+    except Exception as e:
+        status = f"failed: {e.__class__.__name__}"
+    return 1000.0 * (time.perf_counter() - start), status
+
+def benchmark(url, concurrency=8, total_requests=200):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(post_capture, [url] * total_requests))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results])
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print(f"{url}  concurrency={concurrency}  requests={total_requests}")
+    print(f"  throughput: {total_requests / elapsed:.1f} req/s")
+    print(f"  latency:    p50 {np.percentile(latencies, 50):.1f} ms, "
+          f"p95 {np.percentile(latencies, 95):.1f} ms, max {latencies.max():.1f} ms")
+    print(f"  responses:  {statuses}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark /api/capture_face under concurrent load')
+    parser.add_argument('--url', default='http://localhost:5001')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    benchmark(args.url.rstrip('/'), args.concurrency, args.requests)
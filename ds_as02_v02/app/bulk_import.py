@@ -0,0 +1,328 @@
+"""
+Bulk Import
+Enroll customers from a directory or archive of face photos, e.g. a loyalty
+database or another branch
+
+Usage:
+    python3 bulk_import.py <directory | .zip | .tar[.gz]> [--branch <name>]
+        [--workers 0] [--upload-workers 8] [--batch-size 500]
+        [--checkpoint <file>] [--names-from-files]
+
+Images are streamed from the source and analysed across a process pool
+(detect, crop and encode the first face). A face that matches an enrolled
+customer, or one imported earlier in the run, is skipped as a duplicate.
+Every batch uploads its face crops concurrently, then inserts the customers
+in one unordered bulk write.
+
+Progress is checkpointed per image once its batch is stored. An interrupted
+import can be resumed by running the same command again; images of a batch
+that was stored but not checkpointed come back as duplicates. Customer ids
+are derived from the image contents, so a photo is never inserted twice.
+
+Duplicates are found among customers with an encoding for the current
+model; run it after a server start has rebuilt stale encodings.
+
+Imported customers are enrolled in the gallery running servers match
+against when it lives outside them: the central matching service if
+MATCHING_SERVICE_URL is set, or the shared gallery under
+GALLERY_SHARED_DIR. A server that keeps its gallery in its own memory only
+loads customers at start, so restart those kiosks after an import or the
+imported customers are registered again on their first visit.
+"""
+import argparse
+import os
+import sqlite3
+import tarfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from pathlib import Path
+from pymongo.errors import BulkWriteError
+from database_manager import DatabaseManager
+from storage_manager import StorageManager
+from face_gallery import FaceGallery, encoding_from_bytes
+from face_recognition_service import FaceRecognitionService, import_face_in_worker
+from matching_client import MatchingClient, MatchingServiceError
+from shared_gallery import SharedFaceGallery
+from write_queue import DUPLICATE_KEY
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+DEFAULT_CHECKPOINT_DIR = Path(__file__).resolve().parent.parent / "data"
+
+
+def iter_images(source):
+    """Yield (key, image bytes) from a directory, zip or tar archive, one at a time"""
+    source = Path(source)
+    if source.is_dir():
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                path = Path(root) / name
+                if path.suffix.lower() in IMAGE_SUFFIXES:
+                    yield str(path.relative_to(source)), path.read_bytes()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and Path(info.filename).suffix.lower() in IMAGE_SUFFIXES:
+                    yield info.filename, archive.read(info)
+    elif tarfile.is_tarfile(source):
+        # stream mode reads the archive once, front to back
+        with tarfile.open(source, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and Path(member.name).suffix.lower() in IMAGE_SUFFIXES:
+                    yield member.name, archive.extractfile(member).read()
+    else:
+        raise ValueError(f"Not a directory, zip or tar archive: {source}")
+
+
+class ImportCheckpoint:
+    """SQLite record of the images an import has finished with"""
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            'key TEXT PRIMARY KEY, status TEXT NOT NULL, customer_id TEXT)'
+        )
+
+    def done_keys(self):
+        return {key for key, in self._conn.execute('SELECT key FROM images')}
+
+    def counts(self):
+        return dict(self._conn.execute('SELECT status, COUNT(*) FROM images GROUP BY status').fetchall())
+
+    def record(self, outcomes):
+        """Store (key, status, customer_id) rows in one transaction"""
+        self._conn.execute('BEGIN')
+        self._conn.executemany('INSERT OR REPLACE INTO images (key, status, customer_id) VALUES (?, ?, ?)', outcomes)
+        self._conn.execute('COMMIT')
+
+    def close(self):
+        self._conn.close()
+
+
+class BulkImporter:
+    def __init__(self, db_manager, storage_manager, face_service, checkpoint, branch,
+                 workers=None, upload_workers=8, batch_size=500, names_from_files=False,
+                 report_interval=5.0, live_gallery=None):
+        self.db_manager = db_manager
+        self.storage_manager = storage_manager
+        self.face_service = face_service
+        self.checkpoint = checkpoint
+        self.branch = branch
+        self.workers = workers or os.cpu_count() or 1
+        self.upload_workers = upload_workers
+        self.batch_size = batch_size
+        self.names_from_files = names_from_files
+        self.report_interval = report_interval
+        # gallery of the running servers, enrolled in once customers are stored
+        self.live_gallery = live_gallery
+
+        # bound the images held in memory between reading and analysis
+        self.max_in_flight = 4 * self.workers
+
+        self.imported = 0
+        self.duplicates = 0
+        self.no_face = 0
+        self.failed = 0
+        self.skipped = 0
+
+        self.gallery = FaceGallery()
+        self._batch = []
+        self._outcomes = []
+
+    def load_gallery(self):
+        """Enrolled faces to deduplicate against"""
+        customer_ids = []
+        encodings = []
+        for customer in self.db_manager.get_customer_encodings(self.face_service.model_version):
+            customer_ids.append(customer['customer_id'])
+            encodings.append(encoding_from_bytes(customer['face_encoding']))
+        self.gallery.add_many(customer_ids, encodings)
+        print(f"Loaded {len(self.gallery)} enrolled faces for deduplication")
+
+    def run(self, source):
+        started = time.time()
+        last_report = started
+        done = self.checkpoint.done_keys()
+        if done:
+            print(f"Resuming: {len(done)} images already processed")
+
+        images = iter(iter_images(source))
+        exhausted = False
+        analysing = set()
+        settings = self.face_service.detection_settings()
+
+        with ProcessPoolExecutor(self.workers) as analysers, \
+                ThreadPoolExecutor(self.upload_workers) as uploaders:
+            while True:
+                while not exhausted and len(analysing) < self.max_in_flight:
+                    image = next(images, None)
+                    if image is None:
+                        exhausted = True
+                        break
+                    key, image_data = image
+                    if key in done:
+                        self.skipped += 1
+                        continue
+                    analysing.add(analysers.submit(import_face_in_worker, key, image_data, settings))
+
+                if not analysing:
+                    break
+
+                finished, analysing = wait(analysing, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    try:
+                        self._add_result(*future.result())
+                    except Exception as e:
+                        print(f"Error analysing image: {e}")
+                        self.failed += 1
+
+                if len(self._batch) >= self.batch_size:
+                    self._flush(uploaders)
+
+                now = time.time()
+                if now - last_report >= self.report_interval:
+                    self._report(now - started)
+                    last_report = now
+
+            self._flush(uploaders)
+        self._report(time.time() - started, finished=True)
+
+    def _add_result(self, key, digest, encoded, face_jpeg):
+        if encoded is None:
+            self.no_face += 1
+            self._outcomes.append((key, 'no_face', None))
+            return
+
+        # the same photo always gets the same id, so a replayed batch is skipped
+        customer_id = str(uuid.uuid5(uuid.NAMESPACE_OID, digest))
+        encoding = encoding_from_bytes(encoded)
+        match_id, distance = self.gallery.best_match(encoding)
+        if match_id is not None and distance <= self.face_service.tolerance:
+            self.duplicates += 1
+            self._outcomes.append((key, 'duplicate', match_id))
+            return
+
+        now = datetime.now()
+        name = Path(key).stem if self.names_from_files else f"Customer_{customer_id[:8]}"
+        customer = {
+            'customer_id': customer_id,
+            'name': name,
+            'face_image_path': self.storage_manager.face_object_name(customer_id),
+            'branch': self.branch,
+            'created_at': now,
+            'last_visit': now,
+            'total_visits': 0,
+            'face_encoding': encoded,
+            'encoding_model': self.face_service.model_version
+        }
+        # later photos of the same person in this import are duplicates
+        self.gallery.add(customer_id, encoding)
+        self._batch.append((key, customer, face_jpeg))
+
+    def _flush(self, uploaders):
+        batch, self._batch = self._batch, []
+        outcomes, self._outcomes = self._outcomes, []
+
+        # images first, so no customer is stored without one
+        uploaded = list(uploaders.map(self._upload, batch))
+        stored = [item for item, ok in zip(batch, uploaded) if ok]
+        for (_, customer, _), ok in zip(batch, uploaded):
+            if not ok:
+                # not checkpointed, so a resumed import tries it again
+                self.gallery.remove(customer['customer_id'])
+                self.failed += 1
+
+        customers = [customer for _, customer, _ in stored]
+        if customers:
+            try:
+                self.db_manager.insert_customers(customers)
+            except BulkWriteError as e:
+                # customers stored by an interrupted earlier run
+                if any(error['code'] != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+                    raise
+
+        self._enroll(customers)
+        self.imported += len(customers)
+        outcomes.extend((key, 'imported', customer['customer_id']) for key, customer, _ in stored)
+        if outcomes:
+            self.checkpoint.record(outcomes)
+
+    def _enroll(self, customers):
+        if self.live_gallery is None:
+            return
+        for customer in customers:
+            try:
+                self.live_gallery[customer['customer_id']] = encoding_from_bytes(customer['face_encoding'])
+            except MatchingServiceError as e:
+                # stored in MongoDB, so the matching service picks it up on restart
+                print(f"Error enrolling customer {customer['customer_id']}: {e}")
+
+    def _upload(self, item):
+        _, customer, face_jpeg = item
+        try:
+            return self.storage_manager.upload_face_image(customer['customer_id'], face_jpeg) is not None
+        except Exception as e:
+            print(f"Error uploading face image of {customer['customer_id']}: {e}")
+            return False
+
+    def _report(self, elapsed, finished=False):
+        processed = self.imported + self.duplicates + self.no_face + self.failed
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        state = 'finished' if finished else 'running'
+        print(f"Import {state}: {self.imported} imported, {self.duplicates} duplicates, "
+              f"{self.no_face} without a face, {self.failed} failed, {self.skipped} already done, "
+              f"{rate:.1f} images/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='directory, zip or tar archive of face photos')
+    parser.add_argument('--branch', default=os.getenv('BRANCH_NAME', 'Downtown Branch'), help='branch the customers are enrolled at')
+    parser.add_argument('--workers', type=int, default=0, help='analysis processes (0 = one per CPU core)')
+    parser.add_argument('--upload-workers', type=int, default=8, help='concurrent MinIO uploads')
+    parser.add_argument('--batch-size', type=int, default=500, help='customers stored per insert_many')
+    parser.add_argument('--checkpoint', help='progress file (default: data/import_<source name>.db)')
+    parser.add_argument('--names-from-files', action='store_true', help='name customers after their image file')
+    args = parser.parse_args()
+
+    face_service = FaceRecognitionService(
+        detection_scale=float(os.getenv('DETECTION_SCALE', '1.0')),
+        upsample=int(os.getenv('DETECTION_UPSAMPLE', '1')),
+        detection_model=os.getenv('DETECTION_MODEL', 'hog')
+    )
+    live_gallery = None
+    if os.getenv('MATCHING_SERVICE_URL'):
+        live_gallery = MatchingClient(os.getenv('MATCHING_SERVICE_URL'), args.branch)
+    elif os.getenv('GALLERY_SHARED_DIR'):
+        live_gallery = SharedFaceGallery(
+            os.path.join(os.getenv('GALLERY_SHARED_DIR'), f"gallery_{face_service.model_version}")
+        )
+    else:
+        print("No MATCHING_SERVICE_URL or GALLERY_SHARED_DIR: restart running servers to match imported customers")
+
+    checkpoint_path = args.checkpoint or DEFAULT_CHECKPOINT_DIR / f"import_{Path(args.source).name}.db"
+    checkpoint = ImportCheckpoint(checkpoint_path)
+    importer = BulkImporter(
+        DatabaseManager(),
+        StorageManager(),
+        face_service,
+        checkpoint,
+        args.branch,
+        workers=args.workers or None,
+        upload_workers=args.upload_workers,
+        batch_size=args.batch_size,
+        names_from_files=args.names_from_files,
+        live_gallery=live_gallery
+    )
+    importer.load_gallery()
+    try:
+        importer.run(args.source)
+    finally:
+        print(f"Checkpoint {checkpoint_path}: {checkpoint.counts()}")
+        checkpoint.close()
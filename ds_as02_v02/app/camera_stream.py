@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import deque
+import cv2
+
+
+class CameraStream:
+    """Single reader for the camera device.
+
+    A background thread owns the cv2.VideoCapture and publishes every frame
+    into a small lock-protected ring buffer. Video viewers and API handlers
+    read from the buffer, so none of them touch the device or steal frames
+    from each other. Published frames are shared: copy before drawing on one.
+
+    After reopen_after failed reads in a row the capture is released and
+    opened again, so an unplugged or busy camera comes back on its own.
+    """
+
+    def __init__(self, source=0, api_preference=cv2.CAP_ANY, width=640, height=480,
+                 buffer_size=4, retry_delay=0.5, reopen_after=10):
+        self.source = source
+        self.api_preference = api_preference
+        self.width = width
+        self.height = height
+        self.retry_delay = retry_delay
+        self.reopen_after = reopen_after
+
+        self._frames = deque(maxlen=buffer_size)
+        self._condition = threading.Condition()
+        self._seq = 0
+        self._running = False
+        self._thread = None
+        self._capture = None
+
+    def start(self):
+        if self._running:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='camera-stream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+
+    def _open(self):
+        capture = cv2.VideoCapture(self.source, self.api_preference)
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        return capture
+
+    def _run(self):
+        self._capture = self._open()
+        failures = 0
+        while self._running:
+            success, frame = self._capture.read()
+            if not success:
+                # the device may be busy or unplugged; a capture that lost
+                # it never recovers, so start over with a fresh one
+                failures += 1
+                if failures >= self.reopen_after:
+                    print(f"Camera {self.source}: no frame in {failures} reads, reopening")
+                    self._capture.release()
+                    self._capture = self._open()
+                    failures = 0
+                time.sleep(self.retry_delay)
+                continue
+            failures = 0
+
+            with self._condition:
+                self._seq += 1
+                self._frames.append((self._seq, time.time(), frame))
+                self._condition.notify_all()
+
+    def latest(self):
+        """Return (seq, timestamp, frame) of the newest frame, or (0, 0, None)."""
+        with self._condition:
+            if not self._frames:
+                return 0, 0, None
+            return self._frames[-1]
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        """Block until a frame newer than after_seq is published.
+
+        Returns (seq, timestamp, frame), or (after_seq, 0, None) on timeout.
+        """
+        with self._condition:
+            ready = self._condition.wait_for(
+                lambda: self._frames and self._frames[-1][0] > after_seq,
+                timeout
+            )
+            if not ready:
+                return after_seq, 0, None
+            return self._frames[-1]
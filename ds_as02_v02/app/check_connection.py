@@ -19,10 +19,11 @@ def setup_system():
     print("\n[1/3] Initializing MongoDB...")
     try:
         db_manager = DatabaseManager()
+        db_manager.create_indexes()
         
         print("✓ MongoDB connected successfully")
         print(f"  - Database: {db_manager.db.name}")
-        print(f"  - Collections: customers, orders")
+        print(f"  - Collections: customers, orders, menu (indexes created)")
         
         # Check for existing customers
         customer_count = db_manager.customers.count_documents({})
@@ -36,6 +37,7 @@ def setup_system():
     print("\n[2/3] Initializing MinIO storage...")
     try:
         storage_manager = StorageManager()
+        storage_manager.create_bucket()
         print("✓ MinIO connected successfully")
         print(f"  - Endpoint: {os.getenv('MINIO_ENDPOINT', 'localhost:9000')}")
         print(f"  - Bucket: {storage_manager.bucket_name}")
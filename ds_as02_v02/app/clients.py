@@ -0,0 +1,77 @@
+"""
+Shared MongoDB and MinIO clients
+
+Both clients are thread-safe connection pools, so every manager in the
+process uses the same pair instead of opening its own connections.
+"""
+import os
+import threading
+import urllib3
+from minio import Minio
+from pymongo import MongoClient
+from dotenv import load_dotenv
+from pathlib import Path
+
+env_path = Path(__file__).resolve().parent.parent / "configs" / ".env"
+load_dotenv(dotenv_path=env_path)
+
+_lock = threading.Lock()
+_mongo_client = None
+_minio_client = None
+_minio_http = None
+
+def get_mongo_client():
+    global _mongo_client
+    with _lock:
+        if _mongo_client is None:
+            _mongo_client = MongoClient(
+                os.getenv('MONGO_URI'),
+                maxPoolSize=int(os.getenv('MONGO_MAX_POOL_SIZE', '100')),
+                minPoolSize=int(os.getenv('MONGO_MIN_POOL_SIZE', '0')),
+                connectTimeoutMS=int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000')),
+                serverSelectionTimeoutMS=int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+                socketTimeoutMS=int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '10000')),
+                retryWrites=True,
+                retryReads=True
+            )
+        return _mongo_client
+
+def get_minio_client():
+    global _minio_client, _minio_http
+    with _lock:
+        if _minio_client is None:
+            endpoint = os.getenv('MINIO_ENDPOINT')
+            print(f"Connecting to MinIO: {endpoint}")
+
+            _minio_http = urllib3.PoolManager(
+                maxsize=int(os.getenv('MINIO_POOL_SIZE', '32')),
+                block=False,
+                timeout=urllib3.Timeout(
+                    connect=float(os.getenv('MINIO_CONNECT_TIMEOUT', '5')),
+                    read=float(os.getenv('MINIO_READ_TIMEOUT', '30'))
+                ),
+                retries=urllib3.Retry(
+                    total=int(os.getenv('MINIO_RETRIES', '3')),
+                    backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504]
+                )
+            )
+            _minio_client = Minio(
+                endpoint,
+                access_key=os.getenv('MINIO_ACCESS_KEY'),
+                secret_key=os.getenv('MINIO_SECRET_KEY'),
+                secure=False,
+                http_client=_minio_http
+            )
+        return _minio_client
+
+def close_clients():
+    global _mongo_client, _minio_client, _minio_http
+    with _lock:
+        if _mongo_client is not None:
+            _mongo_client.close()
+            _mongo_client = None
+        if _minio_http is not None:
+            _minio_http.clear()
+            _minio_client = None
+            _minio_http = None
@@ -1,80 +1,230 @@
 import os
-from pymongo import MongoClient
-from datetime import datetime
+from pymongo import UpdateOne
 from dotenv import load_dotenv
 from pathlib import Path
+from ttl_cache import TTLCache
+from clients import get_mongo_client, close_clients
+from metrics import span, timed
 
 env_path = Path(__file__).resolve().parent.parent / "configs" / ".env"
 load_dotenv(dotenv_path=env_path)
 
+# Visit ids remembered per customer to skip replayed visits
+RECENT_VISIT_IDS = 100
+
+# Fields the staff dashboard lists; keeps face encodings off the wire
+CUSTOMER_SUMMARY_FIELDS = {
+    '_id': 0,
+    'customer_id': 1,
+    'name': 1,
+    'total_visits': 1,
+    'last_visit': 1,
+    'created_at': 1,
+    'changed_at': 1
+}
+
 class DatabaseManager:
     def __init__(self):
-        self.client = MongoClient(os.getenv('MONGO_URI'))
+        self.client = get_mongo_client()
         self.db = self.client[os.getenv('MONGO_DB')]
         self.customers = self.db.customers
         self.orders = self.db.orders
         self.menu = self.db.menu
         
-        # Create indexes for better performance
+        # Read-through caches, invalidated by the write methods below
+        max_entries = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))
+        self.menu_cache = TTLCache(maxsize=1, ttl=float(os.getenv('CACHE_TTL_MENU', '300')))
+        self.customer_cache = TTLCache(maxsize=max_entries, ttl=float(os.getenv('CACHE_TTL_CUSTOMER', '30')))
+        self.history_cache = TTLCache(maxsize=max_entries, ttl=float(os.getenv('CACHE_TTL_HISTORY', '30')))
+    
+    def create_indexes(self):
+        """One-time setup, run by check_connection.py rather than on every start"""
         self.customers.create_index('customer_id', unique=True)
-        self.orders.create_index('customer_id')
+        # keyset pagination on the dashboard
+        self.customers.create_index([('last_visit', -1), ('customer_id', -1)])
+        # "changed since" polls; customers stored before changed_at existed
+        # count as changed now (changed_at is server time, last_visit is not)
+        self.customers.update_many({'changed_at': {'$exists': False}}, [{'$set': {'changed_at': '$$NOW'}}])
+        self.customers.create_index([('changed_at', 1), ('customer_id', 1)])
+        # serves both the customer_id filter and the order_date sort
+        self.orders.create_index([('customer_id', 1), ('order_date', -1)])
         self.menu.create_index('item_name', unique=True)
     
-    def create_customer(self, customer_id, name, face_image_path):
-        customer = {
-            'customer_id': customer_id,
-            'name': name,
-            'face_image_path': face_image_path,
-            'created_at': datetime.now(),
-            'last_visit': datetime.now(),
-            'total_visits': 1
-        }
-        result = self.customers.insert_one(customer)
-        return str(result.inserted_id)
-    
     def get_customer(self, customer_id):
-        return self.customers.find_one({'customer_id': customer_id})
-    
-    def get_all_customers(self):
-        return list(self.customers.find())
-    
-    def update_customer_visit(self, customer_id):
-        self.customers.update_one(
-            {'customer_id': customer_id},
-            {
-                '$set': {'last_visit': datetime.now()},
-                '$inc': {'total_visits': 1}
-            }
+        return self.customer_cache.get_or_load(customer_id, lambda: self._load_customer(customer_id))
+    
+    @timed('mongo_find_customer')
+    def _load_customer(self, customer_id):
+        return self.customers.find_one({'customer_id': customer_id}, {'face_encoding': 0, 'visit_ids': 0})
+    
+    @timed('mongo_customers_page')
+    def get_customers_page(self, limit, before=None):
+        """Customers by most recent visit, continuing after the (last_visit, customer_id) key before"""
+        query = {}
+        if before is not None:
+            last_visit, customer_id = before
+            query = {'$or': [
+                {'last_visit': {'$lt': last_visit}},
+                {'last_visit': last_visit, 'customer_id': {'$lt': customer_id}}
+            ]}
+        return list(self.customers.find(query, CUSTOMER_SUMMARY_FIELDS)
+                    .sort([('last_visit', -1), ('customer_id', -1)])
+                    .limit(limit))
+    
+    @timed('mongo_customers_changed')
+    def get_customers_changed_since(self, after, limit):
+        """Customers created or visited after the (changed_at, customer_id) key, oldest change first
+
+        changed_at is stamped by the server when a write is stored, not when
+        it was queued, so a write that sat in the write-behind queue still
+        sorts after every change a dashboard has already seen.
+        """
+        changed_at, customer_id = after
+        query = {'$or': [
+            {'changed_at': {'$gt': changed_at}},
+            {'changed_at': changed_at, 'customer_id': {'$gt': customer_id}}
+        ]}
+        return list(self.customers.find(query, CUSTOMER_SUMMARY_FIELDS)
+                    .sort([('changed_at', 1), ('customer_id', 1)])
+                    .limit(limit))
+    
+    def get_latest_change(self):
+        """(changed_at, customer_id) key of the most recently stored change, or None"""
+        latest = self.customers.find_one(
+            {'changed_at': {'$exists': True}},
+            {'_id': 0, 'changed_at': 1, 'customer_id': 1},
+            sort=[('changed_at', -1), ('customer_id', -1)]
         )
+        return (latest['changed_at'], latest['customer_id']) if latest else None
     
-    def add_order(self, customer_id, items, total_price, branch):
-        order = {
-            'customer_id': customer_id,
-            'items': items,
-            'total_price': total_price,
-            'branch': branch,
-            'order_date': datetime.now()
-        }
-        result = self.orders.insert_one(order)
-        return str(result.inserted_id)
+    def get_customer_encodings(self, encoding_model):
+        """Stream stored face encodings without the rest of the customer document"""
+        return self.customers.find(
+            {'encoding_model': encoding_model, 'face_encoding': {'$exists': True}},
+            {'_id': 0, 'customer_id': 1, 'face_encoding': 1, 'branch': 1},
+            batch_size=5000
+        )
     
-    def get_latest_order(self, customer_id):
-        return self.orders.find_one(
-            {'customer_id': customer_id},
-            sort=[('order_date', -1)]
+    def get_customers_needing_encoding(self, encoding_model):
+        """Stream ids of customers whose stored encoding is missing or from another model"""
+        return self.customers.find(
+            {'$or': [
+                {'encoding_model': {'$ne': encoding_model}},
+                {'face_encoding': {'$exists': False}}
+            ]},
+            {'_id': 0, 'customer_id': 1},
+            batch_size=1000
         )
     
+    @timed('mongo_update_encodings')
+    def update_customer_encodings(self, encodings, encoding_model):
+        """Write back a batch of (customer_id, face_encoding) pairs in one round trip"""
+        if not encodings:
+            return
+        self.customers.bulk_write([
+            UpdateOne(
+                {'customer_id': customer_id},
+                {'$set': {'face_encoding': face_encoding, 'encoding_model': encoding_model}}
+            )
+            for customer_id, face_encoding in encodings
+        ], ordered=False)
+        for customer_id, _ in encodings:
+            self.customer_cache.invalidate(customer_id)
+    
+    @timed('mongo_record_visits')
+    def record_visits(self, visits):
+        """Count a batch of (customer_id, visit_id, visited_at) visits in one round trip
+        
+        Idempotent: a customer keeps the ids of their recent visits and a
+        visit whose id is among them is not counted again, so a replayed
+        batch leaves the counts alone.
+        """
+        if not visits:
+            return
+        self.customers.bulk_write([
+            UpdateOne(
+                {'customer_id': customer_id, 'visit_ids': {'$ne': visit_id}},
+                {
+                    '$max': {'last_visit': visited_at},
+                    '$inc': {'total_visits': 1},
+                    '$push': {'visit_ids': {'$each': [visit_id], '$slice': -RECENT_VISIT_IDS}},
+                    '$currentDate': {'changed_at': True}
+                }
+            )
+            for customer_id, visit_id, visited_at in visits
+        ])
+        for customer_id, _, _ in visits:
+            self.customer_cache.invalidate(customer_id)
+    
+    @timed('mongo_insert_customers')
+    def insert_customers(self, customers):
+        """Insert prebuilt customer documents; unordered, so a duplicate does not stop the rest
+
+        Upserts rather than insert_many so the server can stamp changed_at;
+        a customer that is already stored is left as it is.
+        """
+        if not customers:
+            return
+        try:
+            self.customers.bulk_write([
+                UpdateOne(
+                    {'customer_id': customer['customer_id']},
+                    {'$setOnInsert': customer, '$currentDate': {'changed_at': True}},
+                    upsert=True
+                )
+                for customer in customers
+            ], ordered=False)
+        finally:
+            for customer in customers:
+                self.customer_cache.invalidate(customer['customer_id'])
+    
+    @timed('mongo_insert_orders')
+    def insert_orders(self, orders):
+        if not orders:
+            return
+        try:
+            self.orders.insert_many(orders, ordered=False)
+        finally:
+            for order in orders:
+                self.history_cache.invalidate(order['customer_id'])
+    
     def get_customer_order_history(self, customer_id, limit=10):
-        return list(self.orders.find(
-            {'customer_id': customer_id}
-        ).sort('order_date', -1).limit(limit))
+        # one entry per customer holds the longest history fetched so far;
+        # shorter requests are served from its prefix
+        cached = self.history_cache.get(customer_id)
+        if cached is not None:
+            cached_limit, orders = cached
+            if limit <= cached_limit or len(orders) < cached_limit:
+                return orders[:limit]
+        
+        def load():
+            with span('mongo_order_history'):
+                return limit, list(self.orders.find(
+                    {'customer_id': customer_id}
+                ).sort('order_date', -1).limit(limit))
+        
+        return self.history_cache.load(customer_id, load)[1]
     
     def get_all_menu_items(self):
         """Get all menu items from database"""
+        return self.menu_cache.get_or_load('menu', self._load_menu_items)
+    
+    @timed('mongo_find_menu')
+    def _load_menu_items(self):
         menu_items = {}
         for item in self.menu.find():
             menu_items[item['item_name']] = item['price']
         return menu_items
     
+    def invalidate_menu(self):
+        self.menu_cache.clear()
+    
+    def cache_stats(self):
+        return {
+            'menu': self.menu_cache.stats(),
+            'customer': self.customer_cache.stats(),
+            'order_history': self.history_cache.stats()
+        }
+    
     def close(self):
-        self.client.close()
\ No newline at end of file
+        close_clients()
\ No newline at end of file
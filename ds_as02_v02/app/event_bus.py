@@ -0,0 +1,195 @@
+import json
+import queue
+import threading
+import time
+from pymongo.errors import OperationFailure, PyMongoError
+
+# the server cannot run change streams at all, e.g. a standalone mongod
+CHANGE_STREAMS_UNSUPPORTED = {40573}
+# the resume token is no longer in the oplog, or cannot be resumed from
+RESUME_TOKEN_LOST = {260, 280, 286}
+
+
+class EventBus:
+    """In-process publish/subscribe for live screen updates.
+
+    Publishers call publish(topic, data); every subscriber interested in the
+    topic gets the event on its own bounded queue. stream() turns a
+    subscription into Server-Sent Events. The last event of each topic is
+    kept briefly so a screen that reconnects (e.g. after a reload) does not
+    miss something that happened a moment ago.
+    """
+
+    def __init__(self, max_queued=64, replay_window=5.0):
+        self.max_queued = max_queued
+        self.replay_window = replay_window
+        self._subscribers = {}
+        self._last_events = {}
+        self._lock = threading.Lock()
+
+    def publish(self, topic, data):
+        event = (topic, data)
+        with self._lock:
+            self._last_events[topic] = (time.time(), data)
+            subscribers = [q for q, topics in self._subscribers.items() if topics is None or topic in topics]
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # a stalled screen loses old events rather than blocking publishers
+                pass
+
+    def subscribe(self, topics=None, replay=True):
+        subscriber = queue.Queue(maxsize=self.max_queued)
+        topics = set(topics) if topics else None
+        with self._lock:
+            self._subscribers[subscriber] = topics
+            if replay:
+                now = time.time()
+                for topic, (published_at, data) in self._last_events.items():
+                    if (topics is None or topic in topics) and now - published_at < self.replay_window:
+                        subscriber.put_nowait((topic, data))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def stream(self, topics=None, heartbeat=15):
+        """Generator of Server-Sent Events for one client"""
+        subscriber = self.subscribe(topics)
+        try:
+            while True:
+                try:
+                    topic, data = subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    # comment line keeps proxies from closing the stream
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {topic}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+
+class ChangeStreamRelay:
+    """Feed the bus from MongoDB change streams (replica sets only).
+
+    Picks up writes made by other processes, such as another kiosk or a
+    menu edit in mongosh, that the in-process publishers never see.
+    Events for local writes may arrive twice; screens apply them by id.
+    """
+
+    def __init__(self, db_manager, event_bus, format_customer, retry_delay=1.0, max_retry_delay=60.0):
+        self.db_manager = db_manager
+        self.event_bus = event_bus
+        self.format_customer = format_customer
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._threads = []
+
+    def start(self):
+        watchers = [
+            (self.db_manager.customers, self._on_customer_change),
+            (self.db_manager.orders, self._on_order_change),
+            (self.db_manager.menu, self._on_menu_change)
+        ]
+        for collection, handler in watchers:
+            thread = threading.Thread(
+                target=self._watch,
+                args=(collection, handler),
+                name=f"change-stream-{collection.name}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _watch(self, collection, handler):
+        """Follow one collection, resuming after the last seen change on errors"""
+        pipeline = [{'$project': {'fullDocument.face_encoding': 0}}]
+        resume_token = None
+        delay = self.retry_delay
+        while True:
+            try:
+                with collection.watch(pipeline, full_document='updateLookup', resume_after=resume_token) as stream:
+                    delay = self.retry_delay
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        try:
+                            handler(change)
+                        except Exception as e:
+                            print(f"Error relaying change on {collection.name}: {e}")
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAMS_UNSUPPORTED:
+                    print(f"Change stream on {collection.name} stopped: {e}")
+                    return
+                if e.code in RESUME_TOKEN_LOST:
+                    # changes in the gap are lost; carry on from now
+                    resume_token = None
+                print(f"Change stream on {collection.name} failed, retrying in {delay:.0f}s: {e}")
+            except PyMongoError as e:
+                print(f"Change stream on {collection.name} failed, retrying in {delay:.0f}s: {e}")
+            time.sleep(delay)
+            delay = min(2 * delay, self.max_retry_delay)
+
+    def _on_customer_change(self, change):
+        customer = change.get('fullDocument')
+        if not customer:
+            return
+        # another process may have changed a customer this process cached
+        self.db_manager.customer_cache.invalidate(customer['customer_id'])
+        if change['operationType'] == 'insert':
+            self.event_bus.publish('customer_created', self.format_customer(customer))
+        elif 'total_visits' in change.get('updateDescription', {}).get('updatedFields', {}):
+            self.event_bus.publish('visit_recorded', self.format_customer(customer))
+
+    def _on_order_change(self, change):
+        order = change.get('fullDocument')
+        if change['operationType'] == 'insert' and order:
+            self.db_manager.history_cache.invalidate(order.get('customer_id'))
+            self.event_bus.publish('order_placed', {
+                'customer_id': order.get('customer_id'),
+                'total_price': order.get('total_price', 0),
+                'branch': order.get('branch', 'Unknown')
+            })
+
+    def _on_menu_change(self, change):
+        self.db_manager.invalidate_menu()
+        self.event_bus.publish('menu_updated', {'operation': change['operationType']})
+
+
+class MenuPoller:
+    """Publish menu_updated when the stored menu changes, by polling it.
+
+    Menu edits are made outside the app (e.g. in mongosh), so without
+    change streams this is the only way kiosks hear about them. The menu
+    is a handful of documents, so a poll is one small query.
+    """
+
+    def __init__(self, db_manager, event_bus, interval=10.0):
+        self.db_manager = db_manager
+        self.event_bus = event_bus
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='menu-poller', daemon=True)
+        self._thread.start()
+        return self
+
+    def _load(self):
+        return {item['item_name']: item['price']
+                for item in self.db_manager.menu.find({}, {'_id': 0, 'item_name': 1, 'price': 1})}
+
+    def _run(self):
+        menu = None
+        while True:
+            try:
+                current = self._load()
+                if menu is not None and current != menu:
+                    self.db_manager.invalidate_menu()
+                    self.event_bus.publish('menu_updated', {'operation': 'poll'})
+                menu = current
+            except PyMongoError as e:
+                print(f"Error polling the menu: {e}")
+            time.sleep(self.interval)
@@ -0,0 +1,285 @@
+import abc
+import threading
+import numpy as np
+from ann_index import ExactIndex
+
+ENCODING_SIZE = 128
+
+
+def encoding_to_bytes(encoding):
+    """Pack an encoding as 512 bytes of float32 for storage."""
+    return np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE).tobytes()
+
+
+def encoding_from_bytes(data):
+    return np.frombuffer(data, dtype=np.float32, count=ENCODING_SIZE)
+
+
+def squared_distances(queries, matrix, sq_norms):
+    """N x K squared Euclidean distances, expanded as |q|^2 - 2 q.m + |m|^2.
+
+    One matrix product instead of N x K subtractions; it loses precision
+    for near-duplicates, so callers recompute the winner's distance directly.
+    """
+    sq_dist = sq_norms[None, :] - 2.0 * (queries @ matrix.T) + np.einsum('ij,ij->i', queries, queries)[:, None]
+    np.maximum(sq_dist, 0.0, out=sq_dist)
+    return sq_dist
+
+
+class DenseGallery(abc.ABC):
+    """Row bookkeeping shared by the in-process galleries.
+
+    Face i is row i of the per-row arrays a subclass lists in _columns,
+    next to an array of customer ids. Rows stay dense: removing a face
+    moves the last row into its place. Subclasses write a block of rows
+    in _store() and can follow changes through _stored() and _removed().
+    Access is serialized with a lock because the gallery is filled by a
+    background warm-up while request threads are matching against it.
+    """
+
+    _columns = ()
+
+    def __init__(self, initial_capacity=1024):
+        self._lock = threading.RLock()
+        self._ids = np.empty(initial_capacity, dtype=object)
+        self._rows = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, customer_id):
+        return customer_id in self._rows
+
+    def __setitem__(self, customer_id, encoding):
+        self.add(customer_id, encoding)
+
+    def __delitem__(self, customer_id):
+        if not self.remove(customer_id):
+            raise KeyError(customer_id)
+
+    def ids(self):
+        with self._lock:
+            return list(self._ids[:self._size])
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * len(self._ids))
+        for name in self._columns:
+            column = getattr(self, name)
+            grown = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            setattr(self, name, grown)
+        ids = np.empty(capacity, dtype=object)
+        ids[:self._size] = self._ids[:self._size]
+        self._ids = ids
+
+    @abc.abstractmethod
+    def _store(self, start, vectors):
+        """Write vectors into the rows from start on"""
+
+    def _stored(self, start, vectors):
+        pass
+
+    def _removed(self, row, last):
+        pass
+
+    def add(self, customer_id, encoding):
+        with self._lock:
+            vector = np.asarray(encoding, dtype=np.float32).reshape(1, ENCODING_SIZE)
+
+            # re-enrolling an existing customer overwrites their row
+            row = self._rows.get(customer_id)
+            if row is None:
+                if self._size == len(self._ids):
+                    self._grow(self._size + 1)
+                row = self._size
+                self._size += 1
+                self._rows[customer_id] = row
+                self._ids[row] = customer_id
+
+            self._store(row, vector)
+            self._stored(row, vector)
+            return row
+
+    def add_many(self, customer_ids, encodings):
+        """Bulk append, e.g. when loading the gallery at startup."""
+        with self._lock:
+            customer_ids = list(customer_ids)
+            vectors = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+            # existing customers go through add() so their rows are
+            # overwritten; a customer listed twice keeps the last encoding
+            last_positions = {customer_id: position for position, customer_id in enumerate(customer_ids)}
+            fresh = []
+            for customer_id, position in last_positions.items():
+                if customer_id in self._rows:
+                    self.add(customer_id, vectors[position])
+                else:
+                    fresh.append(position)
+            if not fresh:
+                return
+
+            start = self._size
+            end = start + len(fresh)
+            if end > len(self._ids):
+                self._grow(end)
+
+            block = vectors[fresh]
+            self._store(start, block)
+            for row, position in enumerate(fresh, start):
+                self._ids[row] = customer_ids[position]
+                self._rows[customer_ids[position]] = row
+            self._size = end
+            self._stored(start, block)
+
+    def remove(self, customer_id):
+        with self._lock:
+            row = self._rows.pop(customer_id, None)
+            if row is None:
+                return False
+
+            last = self._size - 1
+            self._removed(row, last)
+            if row != last:
+                for name in self._columns:
+                    column = getattr(self, name)
+                    column[row] = column[last]
+                moved_id = self._ids[last]
+                self._ids[row] = moved_id
+                self._rows[moved_id] = row
+
+            self._ids[last] = None
+            self._size = last
+            return True
+
+
+class FaceGallery(DenseGallery):
+    """In-memory gallery of customer face encodings.
+
+    All encodings live in one contiguous float32 matrix with a parallel
+    array of customer ids, so a lookup is a single vectorized distance
+    computation instead of one compare_faces call per customer. An
+    optional ANN index (see ann_index) narrows the scan to a candidate
+    subset for very large galleries.
+    """
+
+    _columns = ('_matrix', '_sq_norms')
+
+    def __init__(self, initial_capacity=1024, index=None):
+        super().__init__(initial_capacity)
+        self.index = index if index is not None else ExactIndex()
+        self._matrix = np.zeros((initial_capacity, ENCODING_SIZE), dtype=np.float32)
+        self._sq_norms = np.zeros(initial_capacity, dtype=np.float32)
+
+    def __getitem__(self, customer_id):
+        with self._lock:
+            return self._matrix[self._rows[customer_id]].copy()
+
+    def _store(self, start, vectors):
+        end = start + len(vectors)
+        self._matrix[start:end] = vectors
+        self._sq_norms[start:end] = np.einsum('ij,ij->i', vectors, vectors)
+
+    def _stored(self, start, vectors):
+        if len(vectors) == 1:
+            self.index.add(start, vectors[0])
+        else:
+            self.index.add_many(range(start, start + len(vectors)), vectors)
+        self._maybe_retrain()
+
+    def _removed(self, row, last):
+        self.index.remove(row)
+        if row != last:
+            self.index.move(last, row)
+
+    def _maybe_retrain(self):
+        """Retrain the index in the background when it is due; call with the lock held.
+
+        Lookups keep using the current index until the new one is swapped in.
+        """
+        if not self.index.needs_training(self._size):
+            return
+        self.index.begin_training()
+        # a view is enough: rows written from here on are re-bucketed by install()
+        snapshot = self._matrix[:self._size]
+        threading.Thread(target=self._retrain, args=(snapshot,), name='gallery-index-train', daemon=True).start()
+
+    def _retrain(self, snapshot):
+        try:
+            model = self.index.fit(snapshot)
+        except Exception as e:
+            print(f"Error training gallery index: {e}")
+            with self._lock:
+                self.index.cancel_training()
+            return
+        with self._lock:
+            self.index.install(*model, self._matrix[:self._size])
+
+    def distances(self, encoding, rows=None):
+        """Euclidean distance from encoding to every enrolled face (or to rows)."""
+        query = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        with self._lock:
+            if rows is None:
+                matrix = self._matrix[:self._size]
+                sq_norms = self._sq_norms[:self._size]
+            else:
+                matrix = self._matrix[rows]
+                sq_norms = self._sq_norms[rows]
+
+            return np.sqrt(squared_distances(query[None, :], matrix, sq_norms)[0])
+
+    def distance_matrix(self, encodings):
+        """N x K Euclidean distances from N encodings to every enrolled face."""
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self._lock:
+            return np.sqrt(squared_distances(queries, self._matrix[:self._size], self._sq_norms[:self._size]))
+
+    def _search(self, query, exact):
+        rows = None if exact else self.index.candidates(query)
+        if rows is None:
+            return int(np.argmin(self.distances(query)))
+        if len(rows) == 0:
+            return None
+        return int(rows[np.argmin(self.distances(query, rows))])
+
+    def best_match(self, encoding, exact=False, fallback_distance=None):
+        """Return (customer_id, distance) of the closest face, or (None, None).
+
+        With an approximate index, a result further away than
+        fallback_distance is double-checked with an exact scan so a
+        missed candidate never turns a known customer into a new one.
+        """
+        with self._lock:
+            if self._size == 0:
+                return None, None
+
+            query = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+            row = self._search(query, exact)
+
+            distance = None
+            if row is not None:
+                distance = float(np.linalg.norm(self._matrix[row] - query))
+
+            if not exact and fallback_distance is not None and (distance is None or distance > fallback_distance):
+                return self.best_match(query, exact=True)
+
+            if row is None:
+                return None, None
+            return self._ids[row], distance
+
+    def best_matches(self, encodings, exact=False, fallback_distance=None):
+        """best_match for N encodings at once; returns a list of (customer_id, distance).
+
+        Without an ANN index all faces are matched with one N x K distance
+        matrix instead of N separate scans.
+        """
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self._lock:
+            if self._size == 0:
+                return [(None, None)] * len(queries)
+            if not exact and not isinstance(self.index, ExactIndex):
+                return [self.best_match(query, fallback_distance=fallback_distance) for query in queries]
+
+            rows = np.argmin(self.distance_matrix(queries), axis=1)
+            distances = np.linalg.norm(self._matrix[rows] - queries, axis=1)
+            return [(self._ids[row], float(distance)) for row, distance in zip(rows, distances)]
@@ -1,35 +1,153 @@
 import face_recognition
+import cv2
 import numpy as np
 from PIL import Image
 import io
+import hashlib
+from collections import namedtuple
+from face_gallery import encoding_to_bytes
+from metrics import span, collect_spans, no_face_frames
+
+# Bump whenever a change alters the encodings (model, jitters, preprocessing)
+# so stored encodings get rebuilt from the customer images.
+ENCODING_MODEL_VERSION = 'dlib_resnet_v1'
+
+# location is (top, right, bottom, left) in image coordinates
+FaceAnalysis = namedtuple('FaceAnalysis', ['location', 'encoding', 'face_image'])
 
 class FaceRecognitionService:
-    def __init__(self):
+    def __init__(self, detection_scale=1.0, upsample=1, detection_model='hog', hint_margin=0.5):
         self.tolerance = 0.6  
+        self.model_version = ENCODING_MODEL_VERSION
+        
+        # detection runs on a copy downscaled by detection_scale; boxes are
+        # mapped back so landmarks and encodings use the full-res frame
+        self.detection_scale = detection_scale
+        self.upsample = upsample
+        self.detection_model = detection_model
+        self.hint_margin = hint_margin
     
-    def encode_face(self, image_data):
+    def detection_settings(self):
+        """Constructor arguments that reproduce this service's detection in another process"""
+        return {
+            'detection_scale': self.detection_scale,
+            'upsample': self.upsample,
+            'detection_model': self.detection_model,
+            'hint_margin': self.hint_margin
+        }
+    
+    def _to_array(self, image_data):
+        if isinstance(image_data, np.ndarray):
+            return image_data
+        if isinstance(image_data, bytes):
+            image_data = Image.open(io.BytesIO(image_data))
+        return np.asarray(image_data.convert('RGB'))
+    
+    def _hint_region(self, face_hints, shape):
+        """Union of (x, y, w, h) hint boxes, widened by hint_margin, as (top, right, bottom, left)"""
+        boxes = np.asarray(face_hints).reshape(-1, 4)
+        left = boxes[:, 0].min()
+        top = boxes[:, 1].min()
+        right = (boxes[:, 0] + boxes[:, 2]).max()
+        bottom = (boxes[:, 1] + boxes[:, 3]).max()
+        
+        margin_x = int((right - left) * self.hint_margin)
+        margin_y = int((bottom - top) * self.hint_margin)
+        return (
+            max(0, int(top) - margin_y),
+            min(shape[1], int(right) + margin_x),
+            min(shape[0], int(bottom) + margin_y),
+            max(0, int(left) - margin_x)
+        )
+    
+    def detect_faces(self, image_np, face_hints=None):
+        """Face locations in full-resolution (top, right, bottom, left) coordinates.
+        
+        face_hints are optional (x, y, w, h) boxes, e.g. from the Haar
+        cascade on the video stream; detection is limited to the region
+        around them and falls back to the whole frame if nothing is found.
+        """
+        offset_top, offset_left = 0, 0
+        region = image_np
+        if face_hints is not None and len(face_hints) > 0:
+            top, right, bottom, left = self._hint_region(face_hints, image_np.shape)
+            region = image_np[top:bottom, left:right]
+            offset_top, offset_left = top, left
+        
+        scale = self.detection_scale
+        small = region
+        if scale != 1.0:
+            small = cv2.resize(region, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
+        locations = face_recognition.face_locations(
+            small,
+            number_of_times_to_upsample=self.upsample,
+            model=self.detection_model
+        )
+        
+        if not locations and region is not image_np:
+            return self.detect_faces(image_np)
+        
+        height, width = image_np.shape[:2]
+        return [
+            (
+                max(0, int(top / scale) + offset_top),
+                min(width, int(right / scale) + offset_left),
+                min(height, int(bottom / scale) + offset_top),
+                max(0, int(left / scale) + offset_left)
+            )
+            for top, right, bottom, left in locations
+        ]
+    
+    def analyze_face(self, image_data, face_hints=None):
+        """Detect, encode and crop the first face in one detection pass.
+        
+        image_data is preferably an RGB ndarray (e.g. a camera frame);
+        JPEG bytes and PIL images are decoded once. Returns a FaceAnalysis
+        or None when no face is found.
+        """
+        analyses = self.analyze_faces(image_data, face_hints, max_faces=1)
+        return analyses[0] if analyses else None
+    
+    def analyze_faces(self, image_data, face_hints=None, max_faces=None):
+        """Detect, encode and crop every face in the frame (up to max_faces).
+        
+        All faces come from one detection pass and are encoded in a single
+        face_encodings call. Returns a list of FaceAnalysis, empty when no
+        face is found.
+        """
         try:
-            if isinstance(image_data, bytes):
-                image = Image.open(io.BytesIO(image_data))
-                image_np = np.array(image)
-            else:
-                image_np = np.array(image_data)
+            with span('decode'):
+                image_np = self._to_array(image_data)
             
-            face_locations = face_recognition.face_locations(image_np)
+            with span('detect'):
+                face_locations = self.detect_faces(image_np, face_hints)
             
             if len(face_locations) == 0:
                 print("No face detected in image")
-                return None
-            
-            face_encodings = face_recognition.face_encodings(image_np, face_locations)
+                no_face_frames.inc()
+                return []
             
-            if len(face_encodings) > 0:
-                return face_encodings[0]
+            face_locations = face_locations[:max_faces]
+            with span('encode'):
+                face_encodings = face_recognition.face_encodings(image_np, face_locations)
             
-            return None
+            with span('crop'):
+                return [
+                    FaceAnalysis(
+                        location=location,
+                        encoding=encoding,
+                        face_image=self._crop_face(image_np, location)
+                    )
+                    for location, encoding in zip(face_locations, face_encodings)
+                ]
         except Exception as e:
-            print(f"Error encoding face: {e}")
-            return None
+            print(f"Error analyzing face: {e}")
+            return []
+    
+    def encode_face(self, image_data):
+        analysis = self.analyze_face(image_data)
+        return analysis.encoding if analysis else None
     
     def compare_faces(self, known_encoding, unknown_encoding):
         if known_encoding is None or unknown_encoding is None:
@@ -43,40 +161,104 @@ class FaceRecognitionService:
         return results[0]
     
     def find_matching_customer(self, captured_face_encoding, customer_encodings):
+        """Return (customer_id, distance) of the closest enrolled face.
+
+        customer_id is None when the gallery is empty or the closest face
+        is further away than the tolerance.
+        """
         if captured_face_encoding is None:
-            return None
+            return None, None
+        
+        with span('match'):
+            customer_id, distance = customer_encodings.best_match(
+                captured_face_encoding,
+                fallback_distance=self.tolerance
+            )
+        
+        if customer_id is None or distance > self.tolerance:
+            return None, distance
         
-        for customer_id, known_encoding in customer_encodings.items():
-            if known_encoding is not None:
-                if self.compare_faces(known_encoding, captured_face_encoding):
-                    return customer_id
+        return customer_id, distance
+    
+    def find_matching_customers(self, captured_face_encodings, customer_encodings):
+        """find_matching_customer for several faces, matched in one batch"""
+        if len(captured_face_encodings) == 0:
+            return []
         
-        return None
+        with span('match_batch'):
+            matches = customer_encodings.best_matches(
+                captured_face_encodings,
+                fallback_distance=self.tolerance
+            )
+        return [
+            (customer_id, distance) if customer_id is not None and distance <= self.tolerance else (None, distance)
+            for customer_id, distance in matches
+        ]
     
-    def extract_face_from_image(self, image_data):
+    def extract_face_from_image(self, image_data, face_hints=None):
         try:
-            if isinstance(image_data, bytes):
-                image = Image.open(io.BytesIO(image_data))
-            else:
-                image = image_data
-            
-            image_np = np.array(image)
-            face_locations = face_recognition.face_locations(image_np)
+            image_np = self._to_array(image_data)
+            face_locations = self.detect_faces(image_np, face_hints)
             
             if len(face_locations) == 0:
                 return None
             
-            top, right, bottom, left = face_locations[0]
-            
-            # crop face
-            padding = 20
-            top = max(0, top - padding)
-            left = max(0, left - padding)
-            bottom = min(image_np.shape[0], bottom + padding)
-            right = min(image_np.shape[1], right + padding)
-            
-            face_image = image_np[top:bottom, left:right]
-            return Image.fromarray(face_image)
+            return self._crop_face(image_np, face_locations[0])
         except Exception as e:
             print(f"Error extracting face: {e}")
-            return None
\ No newline at end of file
+            return None
+    
+    def _crop_face(self, image_np, location):
+        top, right, bottom, left = location
+        
+        # crop face
+        padding = 20
+        top = max(0, top - padding)
+        left = max(0, left - padding)
+        bottom = min(image_np.shape[0], bottom + padding)
+        right = min(image_np.shape[1], right + padding)
+        
+        face_image = image_np[top:bottom, left:right]
+        return Image.fromarray(face_image)
+
+
+_worker_services = {}
+
+def _get_worker_service(settings=None):
+    # one service per detection configuration, reused across tasks
+    key = tuple(sorted((settings or {}).items()))
+    if key not in _worker_services:
+        _worker_services[key] = FaceRecognitionService(**(settings or {}))
+    return _worker_services[key]
+
+def encode_face_in_worker(customer_id, image_data):
+    """Process-pool entry point: encode one image, return packed float32 bytes"""
+    encoding = _get_worker_service().encode_face(image_data)
+    if encoding is None:
+        return customer_id, None
+    return customer_id, encoding_to_bytes(encoding)
+
+def analyze_face_in_worker(image_data, face_hints=None, settings=None):
+    """Process-pool entry point for FaceRecognitionService.analyze_face.
+
+    Returns (FaceAnalysis or None, stage timings); the caller records the
+    timings with metrics.record_spans.
+    """
+    with collect_spans() as timings:
+        analysis = _get_worker_service(settings).analyze_face(image_data, face_hints)
+    return analysis, timings
+
+def import_face_in_worker(key, image_data, settings=None):
+    """Process-pool entry point for bulk imports.
+
+    Returns (key, SHA-1 of the image, packed float32 encoding, JPEG of the
+    face crop); encoding and crop are None when no face is found.
+    """
+    digest = hashlib.sha1(image_data).hexdigest()
+    analysis = _get_worker_service(settings).analyze_face(image_data)
+    if analysis is None:
+        return key, digest, None, None
+    
+    buffer = io.BytesIO()
+    analysis.face_image.save(buffer, format='JPEG')
+    return key, digest, encoding_to_bytes(analysis.encoding), buffer.getvalue()
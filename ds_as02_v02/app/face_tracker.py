@@ -0,0 +1,113 @@
+import itertools
+import numpy as np
+
+
+def box_iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    inter_w = min(ax + aw, bx + bw) - max(ax, bx)
+    inter_h = min(ay + ah, by + bh) - max(ay, by)
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    return inter / float(aw * ah + bw * bh - inter)
+
+
+class FaceTrack:
+    """One face followed across consecutive frames"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, box, now):
+        self.track_id = next(self._ids)
+        self.box = box
+        self.first_seen = now
+        self.last_seen = now
+
+        self.customer_id = None
+        self.encoding = None
+        self.match_distance = None
+        self.verified_at = 0
+        self.attempted_at = None
+        self.needs_verify = False
+
+    def bind(self, customer_id, encoding, match_distance, now):
+        self.customer_id = customer_id
+        self.encoding = encoding
+        self.match_distance = match_distance
+        self.verified_at = now
+        self.needs_verify = False
+
+    def is_same_face(self, encoding, tolerance):
+        """Encoding-similarity check against the face this track was bound to"""
+        if self.encoding is None:
+            return False
+        return float(np.linalg.norm(self.encoding - encoding)) <= tolerance
+
+
+class FaceTracker:
+    """Associate Haar face boxes across frames so one visitor is recognized once.
+
+    Boxes are matched to existing tracks greedily by IoU. A track keeps its
+    recognized customer_id until it is lost for max_age seconds, its box
+    jumps (IoU below stable_iou) or a weak match is due for re-verification.
+    """
+
+    def __init__(self, iou_threshold=0.3, stable_iou=0.5, max_age=1.5,
+                 weak_match_distance=0.5, verify_interval=5.0, retry_interval=0.5):
+        self.iou_threshold = iou_threshold
+        self.stable_iou = stable_iou
+        self.max_age = max_age
+        self.weak_match_distance = weak_match_distance
+        self.verify_interval = verify_interval
+        self.retry_interval = retry_interval
+        self.tracks = []
+
+    def update(self, boxes, now):
+        """Advance the tracker by one frame; return the tracks seen in it."""
+        pairs = sorted(
+            (
+                (box_iou(track.box, box), t, b)
+                for t, track in enumerate(self.tracks)
+                for b, box in enumerate(boxes)
+            ),
+            reverse=True
+        )
+
+        used_tracks = set()
+        used_boxes = set()
+        seen = []
+        for iou, t, b in pairs:
+            if iou < self.iou_threshold:
+                break
+            if t in used_tracks or b in used_boxes:
+                continue
+            used_tracks.add(t)
+            used_boxes.add(b)
+
+            track = self.tracks[t]
+            if iou < self.stable_iou:
+                # a sudden jump may be a different person stepping in
+                track.needs_verify = True
+            track.box = boxes[b]
+            track.last_seen = now
+            seen.append(track)
+
+        for b, box in enumerate(boxes):
+            if b not in used_boxes:
+                track = FaceTrack(box, now)
+                self.tracks.append(track)
+                seen.append(track)
+
+        self.tracks = [track for track in self.tracks if now - track.last_seen <= self.max_age]
+        return seen
+
+    def needs_recognition(self, track, now):
+        # back off on faces the detector could not use (profile, blur)
+        if track.attempted_at is not None and now - track.attempted_at < self.retry_interval:
+            return False
+        if track.customer_id is None or track.needs_verify:
+            return True
+        weak = track.match_distance is not None and track.match_distance > self.weak_match_distance
+        return weak and now - track.verified_at >= self.verify_interval
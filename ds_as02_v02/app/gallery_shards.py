@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+import time
+from pathlib import Path
+import numpy as np
+from face_gallery import ENCODING_SIZE
+from shared_gallery import SharedFaceGallery, ID_BYTES
+
+# customers enrolled before galleries were split by branch
+UNASSIGNED_SHARD = '_unassigned'
+
+# how often a lookup looks for shards created by other processes
+SHARD_SCAN_INTERVAL = 1.0
+
+
+def shard_key(branch):
+    """File-system safe shard name for a branch"""
+    if not branch:
+        return UNASSIGNED_SHARD
+    return re.sub(r'[^a-z0-9]+', '_', branch.lower()).strip('_') or UNASSIGNED_SHARD
+
+
+class GalleryShard(SharedFaceGallery):
+    """One branch's face encodings, in <key>.f32 and <key>.log.
+
+    A SharedFaceGallery, so every matching-service process that opens the
+    shard maps the same pages, appends under the same flock and sees the
+    rows the others enroll.
+    """
+
+    def __init__(self, directory, key, initial_capacity=1024):
+        self.key = key
+        super().__init__(Path(directory) / key, initial_capacity)
+        self._import_ids_file()
+
+    def _import_ids_file(self):
+        # shards written before the append log kept one id per line in
+        # <key>.ids, for the same row layout of <key>.f32
+        ids_path = Path(self.path + '.ids')
+        if not ids_path.exists():
+            return
+        with self.exclusive():
+            if ids_path.exists() and self._seen == 0:
+                records = b''.join(customer_id.encode().ljust(ID_BYTES, b'\0')[:ID_BYTES]
+                                   for customer_id in ids_path.read_text().split())
+                os.write(self._log_fd, records)
+                self._refresh()
+            if ids_path.exists():
+                ids_path.unlink()
+
+
+class ShardedGallery:
+    """Face gallery split into one memory-mapped shard per branch.
+
+    A lookup from a branch searches that branch's shard first, since most
+    visitors return to the same shop, and only scans the other shards when
+    the local best match is further away than the tolerance.
+    """
+
+    def __init__(self, directory, tolerance=0.6):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.tolerance = tolerance
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._scanned_at = 0.0
+        self._scan()
+
+    def __len__(self):
+        return sum(len(shard) for _, shard in self._shard_list())
+
+    def __contains__(self, customer_id):
+        return self._owner(customer_id) is not None
+
+    def _scan(self):
+        """Open shards created since the last look, e.g. by another process"""
+        self._scanned_at = time.monotonic()
+        for path in sorted(self.directory.glob('*.log')) + sorted(self.directory.glob('*.ids')):
+            if path.stem not in self._shards:
+                self._open_shard(path.stem)
+
+    def _shard_list(self):
+        if time.monotonic() - self._scanned_at >= SHARD_SCAN_INTERVAL:
+            self._scan()
+        return list(self._shards.items())
+
+    def _open_shard(self, key):
+        with self._lock:
+            shard = self._shards.get(key)
+            if shard is None:
+                shard = GalleryShard(self.directory, key)
+                self._shards[key] = shard
+            return shard
+
+    def _owner(self, customer_id):
+        for key, shard in self._shard_list():
+            if customer_id in shard:
+                return key
+        return None
+
+    def shard_sizes(self):
+        return {key: len(shard) for key, shard in self._shard_list()}
+
+    def add(self, customer_id, encoding, branch=None):
+        # a customer stays in the shard they were first enrolled in
+        key = self._owner(customer_id) or shard_key(branch)
+        self._open_shard(key).add(customer_id, encoding)
+
+    def best_match(self, encoding, branch=None):
+        """Return (customer_id, distance, shard key); customer_id is None when nothing is close enough"""
+        return self.best_matches([encoding], branch)[0]
+
+    def best_matches(self, encodings, branch=None):
+        """best_match for N encodings, one distance matrix per shard searched"""
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        local_key = shard_key(branch)
+        shards = self._shard_list()
+
+        best_ids = [None] * len(queries)
+        best_distances = np.full(len(queries), np.inf)
+        best_keys = [None] * len(queries)
+
+        def search(key, shard, positions):
+            for position, (customer_id, distance) in zip(positions, shard.best_matches(queries[positions])):
+                if distance is not None and distance < best_distances[position]:
+                    best_ids[position], best_distances[position], best_keys[position] = customer_id, distance, key
+
+        local = dict(shards).get(local_key)
+        if local is not None:
+            search(local_key, local, np.arange(len(queries)))
+
+        # only faces without a close enough local match are searched elsewhere
+        remaining = np.flatnonzero(best_distances > self.tolerance)
+        if len(remaining):
+            for key, shard in shards:
+                if key != local_key:
+                    search(key, shard, remaining)
+
+        results = []
+        for customer_id, distance, key in zip(best_ids, best_distances.tolist(), best_keys):
+            if distance == np.inf:
+                results.append((None, None, None))
+            elif distance > self.tolerance:
+                results.append((None, distance, None))
+            else:
+                results.append((customer_id, distance, key))
+        return results
@@ -0,0 +1,183 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from face_gallery import encoding_from_bytes
+from face_recognition_service import encode_face_in_worker
+
+
+class GalleryWarmup:
+    """Rebuild stale face encodings from the customer images in the background.
+
+    Customers are streamed from a Mongo cursor, their images are fetched
+    from MinIO by a bounded thread pool and encoded across a process pool,
+    and each result is added to the live gallery as soon as it is ready so
+    the server can keep serving while the rebuild runs.
+
+    The warm-up only counts as finished once every customer is in the
+    gallery, except those that cannot be (no stored image, no face in it).
+    Faces that fail for any other reason, e.g. a network error, are tried
+    again in another pass after a back-off, so new faces stay unenrolled
+    rather than risk duplicating a customer who is not loaded yet. Encodings
+    whose write-back fails are kept and written again later.
+    """
+
+    def __init__(self, db_manager, storage_manager, gallery, model_version,
+                 fetch_workers=8, encode_workers=None, write_batch_size=500,
+                 report_interval=5.0, retry_delay=5.0, max_retry_delay=300.0,
+                 on_finished=None):
+        self.db_manager = db_manager
+        self.storage_manager = storage_manager
+        self.gallery = gallery
+        self.model_version = model_version
+        self.fetch_workers = fetch_workers
+        self.encode_workers = encode_workers or os.cpu_count() or 1
+        self.write_batch_size = write_batch_size
+        self.report_interval = report_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_finished = on_finished
+
+        # bound the images held in memory between fetch and encode
+        self.max_in_flight = 2 * (self.fetch_workers + self.encode_workers)
+
+        self.encoded = 0
+        self.failed = 0
+        self._unloadable = set()
+        self._pending_writes = []
+        self._thread = None
+        self._loaded = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._loaded.is_set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='gallery-warmup', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def wait(self, timeout=None):
+        """Wait until the gallery holds every customer that can be loaded"""
+        return self._loaded.wait(timeout)
+
+    def run(self):
+        started = time.time()
+        delay = self.retry_delay
+
+        while True:
+            try:
+                retry = self._run_pass(started)
+            except Exception as e:
+                print(f"Error rebuilding face encodings: {e}")
+                retry = True
+            if not retry:
+                break
+            print(f"Gallery warm-up incomplete, retrying in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(2 * delay, self.max_retry_delay)
+
+        self._loaded.set()
+        self._report(time.time() - started, finished=True)
+        if self.on_finished is not None:
+            self.on_finished()
+
+        # the gallery is complete; keep going until the encodings are stored
+        delay = self.retry_delay
+        while not self._write_pending():
+            time.sleep(delay)
+            delay = min(2 * delay, self.max_retry_delay)
+
+    def _run_pass(self, started):
+        """Load every stale customer once; return True if some should be tried again"""
+        last_report = time.time()
+        retry = False
+        customers = iter(self.db_manager.get_customers_needing_encoding(self.model_version))
+        exhausted = False
+        fetching = {}
+        encoding = {}
+
+        # started inside a running server; a forked encoder could inherit
+        # a lock held by one of its threads, so encoders are spawned
+        with ThreadPoolExecutor(self.fetch_workers) as fetchers, \
+                ProcessPoolExecutor(self.encode_workers, mp_context=multiprocessing.get_context('spawn')) as encoders:
+            while True:
+                while not exhausted and len(fetching) + len(encoding) < self.max_in_flight:
+                    customer = next(customers, None)
+                    if customer is None:
+                        exhausted = True
+                        break
+                    customer_id = customer['customer_id']
+                    # loaded in an earlier pass (write-back pending) or hopeless
+                    if customer_id in self._unloadable or customer_id in self.gallery:
+                        continue
+                    future = fetchers.submit(self.storage_manager.download_face_image, customer_id)
+                    fetching[future] = customer_id
+
+                if not fetching and not encoding:
+                    break
+
+                done, _ = wait(list(fetching) + list(encoding), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetching:
+                        customer_id = fetching.pop(future)
+                        try:
+                            image_data = future.result()
+                        except Exception as e:
+                            print(f"Error fetching image of {customer_id}: {e}")
+                            retry = True
+                            continue
+                        if image_data:
+                            encoding[encoders.submit(encode_face_in_worker, customer_id, image_data)] = customer_id
+                        else:
+                            self._give_up(customer_id)
+                        continue
+
+                    customer_id = encoding.pop(future)
+                    try:
+                        _, encoded = future.result()
+                    except Exception as e:
+                        print(f"Error encoding image of {customer_id}: {e}")
+                        retry = True
+                        continue
+                    if encoded is None:
+                        self._give_up(customer_id)
+                        continue
+
+                    self.gallery.add(customer_id, encoding_from_bytes(encoded))
+                    self._pending_writes.append((customer_id, encoded))
+                    self.encoded += 1
+
+                if len(self._pending_writes) >= self.write_batch_size:
+                    self._write_pending()
+
+                now = time.time()
+                if now - last_report >= self.report_interval:
+                    self._report(now - started)
+                    last_report = now
+
+        return retry
+
+    def _give_up(self, customer_id):
+        # no stored image or no face in it: another pass would not help
+        self._unloadable.add(customer_id)
+        self.failed += 1
+
+    def _write_pending(self):
+        """Store the rebuilt encodings; on failure they are kept for the next attempt"""
+        if not self._pending_writes:
+            return True
+        try:
+            self.db_manager.update_customer_encodings(self._pending_writes, self.model_version)
+        except Exception as e:
+            print(f"Error storing {len(self._pending_writes)} rebuilt encodings: {e}")
+            return False
+        self._pending_writes = []
+        return True
+
+    def _report(self, elapsed, finished=False):
+        rate = self.encoded / elapsed if elapsed > 0 else 0.0
+        state = 'finished' if finished else 'running'
+        print(f"Gallery warm-up {state}: {self.encoded} encoded, {self.failed} failed, "
+              f"{rate:.1f} faces/s, gallery size {len(self.gallery)}")
@@ -0,0 +1,136 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image
+from ttl_cache import TTLCache
+
+# thumbnail edge lengths served by /api/customer/<id>/image?size=N
+THUMBNAIL_SIZES = (64, 128, 256)
+
+
+class FaceImageCache:
+    """Local disk cache of face images and their thumbnails, keyed by ETag.
+
+    A file is named after the customer, the MinIO object's ETag and the
+    size, so a replaced image never serves a stale file. The current ETag of
+    each customer is remembered for etag_ttl seconds; within that window a
+    conditional request is answered without touching MinIO or the disk.
+    A customer without an image is remembered for miss_ttl seconds, e.g.
+    while their upload waits in the write-behind queue. Files are evicted least recently used once max_bytes is exceeded.
+    """
+
+    def __init__(self, storage_manager, cache_dir, max_bytes=256 * 1024 * 1024,
+                 etag_ttl=60.0, miss_ttl=5.0, max_entries=10000):
+        self.storage_manager = storage_manager
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.etags = TTLCache(maxsize=max_entries, ttl=etag_ttl)
+        self.missing = TTLCache(maxsize=max_entries, ttl=miss_ttl)
+        self.hits = 0
+        self.misses = 0
+
+        # file name -> size in bytes, least recently used first
+        self._files = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        for path in sorted(self.cache_dir.glob('*.jpg'), key=lambda p: p.stat().st_mtime):
+            self._files[path.name] = path.stat().st_size
+            self._total_bytes += self._files[path.name]
+        self._evict()
+
+    @staticmethod
+    def thumbnail_size(requested):
+        """Snap a requested size to the smallest fixed size that covers it (None = original)"""
+        if not requested:
+            return None
+        for size in THUMBNAIL_SIZES:
+            if requested <= size:
+                return size
+        return None
+
+    def current_etag(self, customer_id):
+        """ETag of the stored image (cached), or None if there is no image"""
+        if self.missing.get(customer_id):
+            return None
+        etag = self.etags.get_or_load(customer_id, lambda: self.storage_manager.stat_face_image(customer_id))
+        if etag is None:
+            self.missing.set(customer_id, True)
+        return etag
+
+    def invalidate(self, customer_id):
+        self.etags.invalidate(customer_id)
+        self.missing.invalidate(customer_id)
+
+    def get(self, customer_id, size=None):
+        """Return (etag, jpeg bytes) of the image at a fixed size, or (None, None)"""
+        etag = self.current_etag(customer_id)
+        if etag is None:
+            return None, None
+        data = self._read(self._file_name(customer_id, etag, size))
+        if data is not None:
+            self.hits += 1
+            return etag, data
+
+        self.misses += 1
+        # download once; the original and the thumbnail are both kept
+        original, etag = self.storage_manager.download_face_object(customer_id)
+        if original is None:
+            self.etags.invalidate(customer_id)
+            return None, None
+        self.etags.set(customer_id, etag)
+        self._write(self._file_name(customer_id, etag, None), original)
+        if size is None:
+            return etag, original
+
+        data = self._resize(original, size)
+        self._write(self._file_name(customer_id, etag, size), data)
+        return etag, data
+
+    def _file_name(self, customer_id, etag, size):
+        return f"{customer_id}-{etag}-{size or 'full'}.jpg"
+
+    def _resize(self, data, size):
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        image.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+        return buffer.getvalue()
+
+    def _read(self, name):
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        try:
+            return (self.cache_dir / name).read_bytes()
+        except OSError:
+            with self._lock:
+                self._total_bytes -= self._files.pop(name, 0)
+            return None
+
+    def _write(self, name, data):
+        # write then rename, so a reader never sees a partial file
+        path = self.cache_dir / name
+        temp_path = path.with_suffix(f'.{threading.get_ident()}.tmp')
+        try:
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Error caching image {name}: {e}")
+            return
+        with self._lock:
+            self._total_bytes += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                (self.cache_dir / name).unlink()
+            except OSError:
+                pass
@@ -3,73 +3,106 @@ Flask Web Application for Coffeehouse Face Recognition System
 Provides both client and staff interfaces
 """
 from flask import Flask, render_template, Response, jsonify, request
-from backend_server import BackendServer
-from database_manager import DatabaseManager
+from backend_server import BackendServer, BRANCH_NAME
+from camera_stream import CameraStream
+from video_broadcast import MjpegBroadcaster
+from recognition_worker import RecognitionWorker
+from image_cache import FaceImageCache
+import metrics
+from concurrent.futures import ThreadPoolExecutor
 import cv2
-import io
-from PIL import Image
+import os
+import threading
 import time
 import base64
+from datetime import datetime
 
 app = Flask(__name__)
-backend = BackendServer()
-db_manager = DatabaseManager()
 
 # Global variables
+backend = None
+backend_lock = threading.Lock()
+background_tasks = ThreadPoolExecutor(max_workers=1, thread_name_prefix='background')
 camera = None
+broadcaster = None
+recognition_worker = None
 last_capture_time = 0
-capture_cooldown = 3  # seconds between auto-captures
+capture_lock = threading.Lock()
+capture_cooldown = float(os.getenv('CAPTURE_COOLDOWN', '3'))  # seconds between auto-captures
+face_hint_max_age = 1.0  # seconds a Haar detection is trusted as a hint
 
-BRANCH_NAME = "Downtown Branch"
+# Video feed settings
+VIDEO_FPS = int(os.getenv('VIDEO_FPS', '15'))
+VIDEO_JPEG_QUALITY = int(os.getenv('VIDEO_JPEG_QUALITY', '80'))
+
+# Staff dashboard pagination
+CUSTOMER_PAGE_SIZE = 50
+MAX_CUSTOMER_PAGE_SIZE = 500
+
+# Browsers reuse a face image this long before revalidating it
+IMAGE_MAX_AGE = int(os.getenv('IMAGE_MAX_AGE', '60'))
+
+# 1x1 transparent pixel shown when a customer has no image
+PLACEHOLDER_PNG = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\nIDATx\x9cc\x00\x01\x00\x00\x05\x00\x01\r\n-\xb4\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+def get_backend():
+    """Get the backend, building it on first use
+    
+    Not built at import time: process pool workers started with spawn
+    re-import this module and must not build a backend of their own.
+    """
+    global backend
+    if backend is None:
+        with backend_lock:
+            if backend is None:
+                backend = BackendServer()
+    return backend
 
 def get_camera():
-    """Get camera instance"""
+    """Get the shared camera stream, starting its capture thread on first use"""
     global camera
     if camera is None:
-        camera = cv2.VideoCapture(0, cv2.CAP_AVFOUNDATION)
-        camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        camera = CameraStream(0, cv2.CAP_AVFOUNDATION, width=640, height=480).start()
     return camera
 
+def get_broadcaster():
+    """Get the shared annotate-and-encode stage for the video feed"""
+    global broadcaster
+    if broadcaster is None:
+        broadcaster = MjpegBroadcaster(
+            get_camera(),
+            fps=VIDEO_FPS,
+            jpeg_quality=VIDEO_JPEG_QUALITY
+        ).start()
+    return broadcaster
+
+def get_recognition_worker():
+    """Get the background recognition worker, starting it on first use"""
+    global recognition_worker
+    if recognition_worker is None:
+        recognition_worker = RecognitionWorker(
+            get_backend(),
+            get_broadcaster(),
+            BRANCH_NAME,
+            get_backend().event_bus
+        ).start()
+    return recognition_worker
+
 def generate_frames():
     """Generate video frames for streaming"""
-    global last_capture_time
-    
-    cam = get_camera()
-    face_cascade = cv2.CascadeClassifier(
-        cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-    )
-    
-    while True:
-        success, frame = cam.read()
-        if not success:
-            break
-        
-        # Detect faces
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        
-        # Draw rectangles around faces
-        for (x, y, w, h) in faces:
-            cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-        
-        # Encode frame
-        ret, buffer = cv2.imencode('.jpg', frame)
-        frame = buffer.tobytes()
-        
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    return get_broadcaster().subscribe()
 
 @app.route('/')
 def index():
     """Redirect to client interface"""
-    menu_items = db_manager.get_all_menu_items()
+    menu_items = get_backend().db_manager.get_all_menu_items()
     return render_template('client.html', menu_items=menu_items, branch_name=BRANCH_NAME)
 
 @app.route('/client')
 def client():
     """Client interface - menu and automatic face capture"""
-    menu_items = db_manager.get_all_menu_items()
+    menu_items = get_backend().db_manager.get_all_menu_items()
     return render_template('client.html', menu_items=menu_items, branch_name=BRANCH_NAME)
 
 @app.route('/staff')
@@ -83,113 +116,203 @@ def video_feed():
     return Response(generate_frames(),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
-@app.route('/api/capture_face', methods=['POST'])
-def capture_face():
-    """Capture and process face from camera"""
-    global last_capture_time
+@app.route('/api/events')
+def events():
+    """Server-Sent Events stream of live updates
     
-    current_time = time.time()
+    ?topics=recognition,customer_created,visit_recorded,order_placed,menu_updated
+    selects what to receive (default: everything).
+    """
+    topics = [topic for topic in request.args.get('topics', '').split(',') if topic]
+    if not topics or 'recognition' in topics:
+        get_recognition_worker()
     
-    # Check cooldown
-    if current_time - last_capture_time < capture_cooldown:
-        return jsonify({
-            'status': 'cooldown',
-            'message': 'Please wait before next capture'
-        })
+    return Response(get_backend().event_bus.stream(topics or None),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def claim_capture(now):
+    """Start a capture unless the cooldown since the last one is still running"""
+    global last_capture_time
+    with capture_lock:
+        if now - last_capture_time < capture_cooldown:
+            return False
+        last_capture_time = now
+        return True
+
+def cooldown_response():
+    return {
+        'status': 'cooldown',
+        'message': 'Please wait before next capture'
+    }
+
+def capture_failed_response():
+    return {
+        'status': 'error',
+        'message': 'Failed to capture image'
+    }
+
+def read_capture_frame(now):
+    """Newest processed frame as RGB and the face boxes to hint detection with
     
-    cam = get_camera()
-    success, frame = cam.read()
+    Returns (None, None) when the camera has no frame.
+    """
+    # Newest processed frame and its Haar boxes (only waits on a cold start)
+    with metrics.span('camera_read'):
+        stream = get_broadcaster()
+        _, frame_time, frame, faces = stream.wait_for_update(timeout=1)
     
-    if not success:
-        return jsonify({
-            'status': 'error',
-            'message': 'Failed to capture image'
-        })
+    if frame is None:
+        return None, None
     
-    # Convert frame to PIL Image
-    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    img = Image.fromarray(rgb_frame)
+    # Pass the RGB frame straight through, no JPEG round trip
+    with metrics.span('color_convert'):
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     
-    # Convert to bytes
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format='JPEG')
-    img_byte_arr.seek(0)
+    # Limit detection to where the stream saw a face in this frame
+    face_hints = None
+    if now - frame_time < face_hint_max_age:
+        face_hints = faces
+    return rgb_frame, face_hints
+
+@app.route('/api/capture_face', methods=['POST'])
+def capture_face():
+    """Capture and process face from camera"""
+    current_time = time.time()
     
-    # Process face recognition
-    response = backend.process_face_recognition_request(
-        img_byte_arr.getvalue(),
-        BRANCH_NAME
-    )
+    # Check cooldown
+    if not claim_capture(current_time):
+        return jsonify(cooldown_response())
     
-    last_capture_time = current_time
+    with metrics.span('capture_request'):
+        rgb_frame, face_hints = read_capture_frame(current_time)
+        if rgb_frame is None:
+            return jsonify(capture_failed_response())
+        
+        # Process face recognition
+        response = get_backend().process_face_recognition_request(
+            rgb_frame,
+            BRANCH_NAME,
+            face_hints
+        )
+        
+        with metrics.span('serialize'):
+            return jsonify(response)
+
+@app.route('/api/capture_faces', methods=['POST'])
+def capture_faces():
+    """Recognize every face in the current frame, one result per face"""
+    rgb_frame, face_hints = read_capture_frame(time.time())
+    if rgb_frame is None:
+        return jsonify(capture_failed_response())
     
-    return jsonify(response)
+    return jsonify(get_backend().process_faces_request(rgb_frame, BRANCH_NAME, face_hints))
 
 @app.route('/api/place_order', methods=['POST'])
 def place_order():
     """Place order for customer"""
-    data = request.json
-    
+    return jsonify(submit_order(request.json))
+
+def submit_order(data):
+    """Queue the order in the request body; returns the response body"""
     customer_id = data.get('customer_id')
     items = data.get('items', [])
     total_price = data.get('total_price', 0)
     recapture = data.get('recapture', False)
     
     if not customer_id or not items:
-        return jsonify({
+        return {
             'status': 'error',
             'message': 'Missing customer_id or items'
-        })
+        }
     
-    # If recapture requested for new customer
+    # If recapture requested for new customer: take the frame now, find
+    # and store the face after responding
     if recapture:
         cam = get_camera()
-        success, frame = cam.read()
+        _, _, frame = cam.wait_for_frame(timeout=1)
         
-        if success:
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            img = Image.fromarray(rgb_frame)
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='JPEG')
-            img_byte_arr.seek(0)
-            
-            # Extract and save face
-            face_image = backend.face_service.extract_face_from_image(img_byte_arr.getvalue())
-            if face_image:
-                backend.storage_manager.upload_face_image(customer_id, face_image)
-    
-    result = backend.add_order_for_customer(
+        if frame is not None:
+            background_tasks.submit(save_recaptured_face, customer_id, frame)
+    
+    return get_backend().add_order_for_customer(
         customer_id,
         items,
         total_price,
         BRANCH_NAME
     )
-    
-    return jsonify(result)
+
+def save_recaptured_face(customer_id, frame):
+    try:
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        face_image = get_backend().face_service.extract_face_from_image(rgb_frame)
+        if face_image:
+            get_backend().save_face_image(customer_id, face_image)
+    except Exception as e:
+        print(f"Error saving recaptured face of {customer_id}: {e}")
+
+def encode_customer_cursor(moment, customer_id):
+    """Opaque keyset cursor for a (last_visit or changed_at, customer_id) position"""
+    key = f"{moment.isoformat(timespec='milliseconds')}|{customer_id}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+def decode_customer_cursor(token):
+    moment, customer_id = base64.urlsafe_b64decode(token.encode()).decode().split('|', 1)
+    return datetime.fromisoformat(moment), customer_id
 
 @app.route('/api/customers', methods=['GET'])
 def get_customers():
-    """Get all customers (for staff interface)"""
-    customers = backend.db_manager.get_all_customers()
-    
-    # Convert to JSON-serializable format
-    customers_list = []
-    for customer in customers:
-        customer_dict = {
-            'customer_id': customer['customer_id'],
-            'name': customer['name'],
-            'total_visits': customer.get('total_visits', 0),
-            'last_visit': customer.get('last_visit').strftime('%Y-%m-%d %H:%M:%S') if customer.get('last_visit') else 'N/A',
-            'created_at': customer.get('created_at').strftime('%Y-%m-%d %H:%M:%S') if customer.get('created_at') else 'N/A'
-        }
-        customers_list.append(customer_dict)
+    """Get customers for staff interface, most recent visit first
+    
+    ?limit=N&cursor=<next_cursor> pages through all customers.
+    ?since=<sync_token> returns only customers created or visited since
+    the token, so the dashboard can poll for changes.
+    """
+    limit = max(1, min(request.args.get('limit', CUSTOMER_PAGE_SIZE, type=int), MAX_CUSTOMER_PAGE_SIZE))
+    since = request.args.get('since')
+    cursor = request.args.get('cursor')
+    
+    try:
+        if since:
+            customers = get_backend().db_manager.get_customers_changed_since(decode_customer_cursor(since), limit)
+            sync_token = since
+            if customers:
+                sync_token = encode_customer_cursor(customers[-1]['changed_at'], customers[-1]['customer_id'])
+            return jsonify({
+                'customers': [get_backend().format_customer_summary(customer) for customer in customers],
+                'sync_token': sync_token,
+                'has_more': len(customers) == limit
+            })
+        
+        before = decode_customer_cursor(cursor) if cursor else None
+        # taken before the page, so a change made while it loads is polled again
+        latest_change = get_backend().db_manager.get_latest_change() if before is None else None
+        customers = get_backend().db_manager.get_customers_page(limit, before)
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'Invalid cursor'
+        })
+    
+    next_cursor = None
+    if len(customers) == limit:
+        next_cursor = encode_customer_cursor(customers[-1]['last_visit'], customers[-1]['customer_id'])
+    
+    # the newest stored change; later polls only ask for what follows it
+    sync_token = None
+    if before is None:
+        sync_token = encode_customer_cursor(*(latest_change or (datetime(1970, 1, 1), '')))
     
-    return jsonify(customers_list)
+    return jsonify({
+        'customers': [get_backend().format_customer_summary(customer) for customer in customers],
+        'next_cursor': next_cursor,
+        'sync_token': sync_token
+    })
 
 @app.route('/api/customer/<customer_id>', methods=['GET'])
 def get_customer_details(customer_id):
     """Get detailed customer information"""
-    customer = backend.db_manager.get_customer(customer_id)
+    customer = get_backend().db_manager.get_customer(customer_id)
     
     if not customer:
         return jsonify({
@@ -198,7 +321,7 @@ def get_customer_details(customer_id):
         })
     
     # Get order history
-    order_history = backend.db_manager.get_customer_order_history(customer_id, limit=10)
+    order_history = get_backend().db_manager.get_customer_order_history(customer_id, limit=10)
     
     customer_data = {
         'customer_id': customer['customer_id'],
@@ -222,23 +345,58 @@ def get_customer_details(customer_id):
 
 @app.route('/api/customer/<customer_id>/image', methods=['GET'])
 def get_customer_image(customer_id):
-    """Get customer face image"""
+    """Get customer face image
+    
+    ?size=N returns a thumbnail (64, 128 or 256 px). Responses carry an
+    ETag, so a browser revalidating an unchanged image gets a 304.
+    """
     try:
-        image_data = backend.storage_manager.download_face_image(customer_id)
+        size = FaceImageCache.thumbnail_size(request.args.get('size', type=int))
+        etag = get_backend().image_cache.current_etag(customer_id)
         
-        if image_data:
-            return Response(image_data, mimetype='image/jpeg')
+        if etag is not None and request.if_none_match.contains(f"{etag}-{size or 'full'}"):
+            response = Response(status=304)
         else:
-            # Return default placeholder image (1x1 transparent pixel)
-            return Response(
-                b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\nIDATx\x9cc\x00\x01\x00\x00\x05\x00\x01\r\n-\xb4\x00\x00\x00\x00IEND\xaeB`\x82',
-                mimetype='image/png'
-            )
+            etag, image_data = get_backend().image_cache.get(customer_id, size)
+            if not image_data:
+                # Return default placeholder image
+                return Response(PLACEHOLDER_PNG, mimetype='image/png')
+            response = Response(image_data, mimetype='image/jpeg')
+        
+        response.set_etag(f"{etag}-{size or 'full'}")
+        response.headers['Cache-Control'] = f'private, max-age={IMAGE_MAX_AGE}'
+        return response
     except Exception as e:
-        return Response(
-            b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\nIDATx\x9cc\x00\x01\x00\x00\x05\x00\x01\r\n-\xb4\x00\x00\x00\x00IEND\xaeB`\x82',
-            mimetype='image/png'
-        )
+        return Response(PLACEHOLDER_PNG, mimetype='image/png')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Stage latencies, counters and gauges in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def profile():
+    """Sampling profiler: GET returns collapsed stacks for a flame graph
+    
+    POST ?enabled=1 starts sampling, ?enabled=0 stops it, ?reset=1
+    discards the samples collected so far.
+    """
+    if request.method == 'POST':
+        if request.args.get('reset') == '1':
+            metrics.profiler.reset()
+        enabled = request.args.get('enabled')
+        if enabled == '1':
+            metrics.profiler.enable()
+        elif enabled == '0':
+            metrics.profiler.disable()
+        return jsonify({
+            'status': 'success',
+            'enabled': metrics.profiler.enabled,
+            'samples': metrics.profiler.samples
+        })
+    
+    return Response(metrics.profiler.collapsed(request.args.get('limit', 200, type=int)), mimetype='text/plain')
 
 if __name__ == '__main__':
+    get_backend()
     app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,59 @@
+import json
+from urllib.parse import urlencode
+import urllib3
+from face_gallery import encoding_to_bytes
+
+
+class MatchingServiceError(RuntimeError):
+    pass
+
+
+class MatchingClient:
+    """Branch-side stand-in for FaceGallery backed by the central matching service.
+
+    Supports the two gallery operations the backend uses, best_match and
+    item assignment, so FaceRecognitionService.find_matching_customer works
+    unchanged. Each call sends one 512-byte encoding over a kept-alive
+    connection.
+    """
+
+    def __init__(self, url, branch, timeout=2.0, retries=2):
+        self.url = url.rstrip('/')
+        self.branch = branch
+        self._http = urllib3.PoolManager(
+            maxsize=8,
+            timeout=urllib3.Timeout(total=timeout),
+            retries=urllib3.Retry(total=retries, backoff_factor=0.1, allowed_methods=None)
+        )
+
+    def _post(self, path, body, fields):
+        try:
+            response = self._http.request(
+                'POST',
+                f"{self.url}{path}?{urlencode(fields)}",
+                body=body,
+                headers={'Content-Type': 'application/octet-stream'}
+            )
+        except urllib3.exceptions.HTTPError as e:
+            raise MatchingServiceError(f"Matching service unreachable: {e}")
+        if response.status != 200:
+            raise MatchingServiceError(f"Matching service returned {response.status}")
+        return json.loads(response.data)
+
+    def best_match(self, encoding, exact=False, fallback_distance=None):
+        """Return (customer_id, distance) like FaceGallery.best_match.
+
+        The service applies its own tolerance, so a customer_id of None
+        with a distance means the closest face was too far away.
+        """
+        result = self._post('/match', encoding_to_bytes(encoding), {'branch': self.branch})
+        return result['customer_id'], result['distance']
+
+    def best_matches(self, encodings, exact=False, fallback_distance=None):
+        """Match several faces in one request of 512 bytes per face"""
+        body = b''.join(encoding_to_bytes(encoding) for encoding in encodings)
+        results = self._post('/match_many', body, {'branch': self.branch})
+        return [(result['customer_id'], result['distance']) for result in results]
+
+    def __setitem__(self, customer_id, encoding):
+        self._post('/enroll', encoding_to_bytes(encoding), {'customer_id': customer_id, 'branch': self.branch})
@@ -0,0 +1,105 @@
+"""
+Central Matching Service
+Holds the face gallery for all branches and matches encodings sent by kiosks
+
+Run:
+    python3 matching_service.py
+
+Branch kiosks started with MATCHING_SERVICE_URL=http://<host>:5100 send
+each captured face as its 128-d float32 encoding (512 bytes) instead of
+keeping a gallery of their own.
+"""
+import os
+from pathlib import Path
+import numpy as np
+from flask import Flask, jsonify, request
+from database_manager import DatabaseManager
+from face_gallery import ENCODING_SIZE, encoding_from_bytes
+from face_recognition_service import ENCODING_MODEL_VERSION
+from gallery_shards import ShardedGallery
+
+DEFAULT_SHARD_DIR = Path(__file__).resolve().parent.parent / "data" / "shards"
+
+app = Flask(__name__)
+gallery = ShardedGallery(
+    os.getenv('MATCHING_SHARD_DIR', str(DEFAULT_SHARD_DIR)),
+    tolerance=float(os.getenv('MATCHING_TOLERANCE', '0.6'))
+)
+
+def sync_from_database():
+    """Add stored encodings the shards do not have yet, e.g. on first start"""
+    db_manager = DatabaseManager()
+    added = 0
+    for customer in db_manager.get_customer_encodings(ENCODING_MODEL_VERSION):
+        if customer['customer_id'] not in gallery:
+            gallery.add(customer['customer_id'], encoding_from_bytes(customer['face_encoding']), customer.get('branch'))
+            added += 1
+    print(f"Matching service: {len(gallery)} faces in {len(gallery.shard_sizes())} shards ({added} added from MongoDB)")
+
+def read_encoding():
+    data = request.get_data()
+    if len(data) != ENCODING_SIZE * 4:
+        return None
+    return encoding_from_bytes(data)
+
+@app.route('/match', methods=['POST'])
+def match():
+    """Closest customer to the float32 encoding in the body
+
+    ?branch=<name> searches that branch's shard before the others.
+    """
+    encoding = read_encoding()
+    if encoding is None:
+        return jsonify({
+            'status': 'error',
+            'message': f'Expected {ENCODING_SIZE * 4} bytes of float32 encoding'
+        }), 400
+
+    customer_id, distance, shard = gallery.best_match(encoding, request.args.get('branch'))
+    return jsonify({
+        'customer_id': customer_id,
+        'distance': distance,
+        'shard': shard
+    })
+
+@app.route('/match_many', methods=['POST'])
+def match_many():
+    """match() for a body of several concatenated encodings, e.g. every face in a frame"""
+    data = request.get_data()
+    if not data or len(data) % (ENCODING_SIZE * 4):
+        return jsonify({
+            'status': 'error',
+            'message': f'Expected a multiple of {ENCODING_SIZE * 4} bytes of float32 encodings'
+        }), 400
+
+    encodings = np.frombuffer(data, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    return jsonify([{
+        'customer_id': customer_id,
+        'distance': distance,
+        'shard': shard
+    } for customer_id, distance, shard in gallery.best_matches(encodings, request.args.get('branch'))])
+
+@app.route('/enroll', methods=['POST'])
+def enroll():
+    """Add or replace ?customer_id=<id> in the shard of ?branch=<name>"""
+    encoding = read_encoding()
+    customer_id = request.args.get('customer_id')
+    if encoding is None or not customer_id:
+        return jsonify({
+            'status': 'error',
+            'message': 'Missing customer_id or encoding'
+        }), 400
+
+    gallery.add(customer_id, encoding, request.args.get('branch'))
+    return jsonify({'status': 'success'})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'faces': len(gallery),
+        'shards': gallery.shard_sizes()
+    })
+
+if __name__ == '__main__':
+    sync_from_database()
+    app.run(host='0.0.0.0', port=int(os.getenv('MATCHING_PORT', '5100')), threaded=True)
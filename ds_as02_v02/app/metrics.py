@@ -0,0 +1,254 @@
+"""
+In-process metrics in the Prometheus text format
+
+Stage timings go into one histogram labelled by stage:
+
+    with span('detect'):
+        ...
+
+    @timed('mongo_record_visits')
+    def record_visits(...):
+
+Counters are incremented where things happen, and values that already
+live elsewhere (gallery size, cache hit counts) are read through callbacks
+when /metrics is scraped. SamplingProfiler is an optional, toggleable
+stack sampler for finding where time goes inside a stage.
+"""
+import functools
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as _Tally
+from contextlib import contextmanager
+
+PREFIX = 'coffeehouse_'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape_label_value(value):
+    # the exposition format escapes backslash, double quote and line feed
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape_label_value(value)}"' for key, value in sorted(labels.items()))
+    return '{' + pairs + '}'
+
+
+def _register(metric):
+    # a metric registered again under the same name replaces the old one
+    with _registry_lock:
+        _registry[:] = [other for other in _registry if other.name != metric.name]
+        _registry.append(metric)
+    return metric
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = PREFIX + name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = PREFIX + name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        # label key -> [bucket counts..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+        for key, series in snapshot.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+
+class CallbackMetric:
+    """A gauge or counter whose value is read from fn() at scrape time.
+
+    fn returns a number, or a list of (labels dict, number) pairs.
+    """
+
+    def __init__(self, name, help_text, fn, kind='gauge'):
+        self.name = PREFIX + name
+        self.help_text = help_text
+        self.fn = fn
+        self.kind = kind
+        _register(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Error reading metric {self.name}: {e}")
+            return lines
+        samples = value if isinstance(value, list) else [({}, value)]
+        for labels, sample in samples:
+            lines.append(f"{self.name}{_format_labels(labels)} {sample}")
+        return lines
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram('stage_seconds', 'Time spent in each stage of the capture pipeline')
+no_face_frames = Counter('no_face_frames_total', 'Frames analysed without finding a face')
+recognitions = Counter('recognitions_total', 'Faces processed, by outcome')
+
+
+_collecting = threading.local()
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        timings = getattr(_collecting, 'timings', None)
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+@contextmanager
+def collect_spans():
+    """Also hand back the spans run inside the block as (stage, seconds) pairs.
+
+    For pool workers: their registry is never scraped, so they return the
+    pairs with their result and the parent passes them to record_spans().
+    """
+    previous = getattr(_collecting, 'timings', None)
+    _collecting.timings = timings = []
+    try:
+        yield timings
+    finally:
+        _collecting.timings = previous
+
+
+def record_spans(timings):
+    for stage, seconds in timings:
+        stage_seconds.observe(seconds, stage=stage)
+
+
+def timed(stage):
+    """Decorator form of span()"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class SamplingProfiler:
+    """Periodically sample the stacks of all threads while enabled.
+
+    Samples are kept as collapsed stacks ("outer;inner;leaf count"), the
+    input format of flame graph tools. Sampling costs one stack walk per
+    thread every interval seconds, and nothing while disabled.
+    """
+
+    def __init__(self, interval=0.01, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = _Tally()
+        self._lock = threading.Lock()
+        self._enabled = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._enabled.is_set()
+
+    def enable(self):
+        self._enabled.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def disable(self):
+        self._enabled.clear()
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            self._enabled.wait()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame, limit=self.max_depth)
+                key = ';'.join(f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})" for entry in stack)
+                with self._lock:
+                    self._stacks[key] += 1
+            with self._lock:
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self, limit=200):
+        with self._lock:
+            stacks = self._stacks.most_common(limit)
+        return '\n'.join(f"{stack} {count}" for stack, count in stacks) + '\n'
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,143 @@
+import os
+import tempfile
+import numpy as np
+from face_gallery import ENCODING_SIZE, DenseGallery
+
+# float32 rounding in the expanded-norm screen, in distance units
+BOUND_SLACK = 1e-3
+
+
+class QuantizedFaceGallery(DenseGallery):
+    """Face gallery searched on int8-quantized copies of the encodings.
+
+    Each encoding is held in memory as 128 int8 codes with a per-vector
+    scale, 140 bytes with its norm and error, instead of 516 bytes of
+    float32. A lookup screens the codes block by block, so each block is
+    decoded while it is in cache, then re-ranks a shortlist
+    of the closest rows on the full-precision encodings. Those are kept
+    in a memory-mapped scratch file in spill_dir and only the shortlist's
+    pages are read.
+
+    The quantization error of every row is recorded, so every row that
+    could beat the re-ranked winner is re-ranked too. The result is the
+    same as an exact float32 scan, so it can stand in for FaceGallery.
+    """
+
+    _columns = ('_codes', '_scales', '_sq_norms', '_errors')
+
+    def __init__(self, shortlist=32, spill_dir=None, initial_capacity=1024, block_rows=1024):
+        super().__init__(initial_capacity)
+        self.shortlist = max(1, shortlist)
+        self.block_rows = block_rows
+
+        self._codes = np.zeros((initial_capacity, ENCODING_SIZE), dtype=np.int8)
+        self._scales = np.ones(initial_capacity, dtype=np.float32)
+        # squared norms of the decoded vectors and each row's decoding error
+        self._sq_norms = np.zeros(initial_capacity, dtype=np.float32)
+        self._errors = np.zeros(initial_capacity, dtype=np.float32)
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        # unlinked on close, so a crashed worker leaves nothing behind
+        self._full_file = tempfile.TemporaryFile(prefix='gallery-', suffix='.f32', dir=spill_dir)
+        self._full = None
+        self._map_full(initial_capacity)
+
+    def __getitem__(self, customer_id):
+        with self._lock:
+            return np.array(self._full[self._rows[customer_id]])
+
+    @property
+    def nbytes(self):
+        """Bytes of the in-memory search arrays (codes, scales, norms, errors)"""
+        per_row = ENCODING_SIZE + 3 * 4
+        return self._size * per_row
+
+    def _map_full(self, capacity):
+        self._full_file.truncate(capacity * ENCODING_SIZE * 4)
+        self._full = np.memmap(self._full_file, dtype=np.float32, mode='r+', shape=(capacity, ENCODING_SIZE))
+
+    def _grow(self, min_capacity):
+        super()._grow(min_capacity)
+        self._full.flush()
+        self._map_full(len(self._ids))
+
+    def _quantize(self, vectors):
+        """(codes, scales, decoded squared norms, decoding errors) of float32 rows"""
+        # symmetric per-vector scale, so the largest component maps to +-127
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+
+        decoded = codes.astype(np.float32) * scales[:, None]
+        sq_norms = np.einsum('ij,ij->i', decoded, decoded)
+        errors = np.linalg.norm(vectors - decoded, axis=1)
+        return codes, scales.astype(np.float32), sq_norms, errors
+
+    def _store(self, start, vectors):
+        end = start + len(vectors)
+        codes, scales, sq_norms, errors = self._quantize(vectors)
+        self._codes[start:end] = codes
+        self._scales[start:end] = scales
+        self._sq_norms[start:end] = sq_norms
+        self._errors[start:end] = errors
+        self._full[start:end] = vectors
+
+    def _removed(self, row, last):
+        if row != last:
+            self._full[row] = self._full[last]
+
+    def _screen(self, queries):
+        """N x K approximate distances from the int8 codes"""
+        size = self._size
+        dots = np.empty((len(queries), size), dtype=np.float32)
+        buffer = np.empty((min(self.block_rows, size), ENCODING_SIZE), dtype=np.float32)
+        for start in range(0, size, self.block_rows):
+            end = min(size, start + self.block_rows)
+            # decode into one reused buffer, so the block is still in cache for the product
+            block = buffer[:end - start]
+            np.copyto(block, self._codes[start:end], casting='unsafe')
+            dots[:, start:end] = queries @ block.T
+
+        sq_dist = self._sq_norms[:size] - 2.0 * self._scales[:size] * dots
+        sq_dist += np.einsum('ij,ij->i', queries, queries)[:, None]
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        return np.sqrt(sq_dist, out=sq_dist)
+
+    def _rerank(self, query, approx):
+        size = self._size
+        k = min(self.shortlist, size)
+        rows = np.arange(size) if k == size else np.sort(np.argpartition(approx, k - 1)[:k])
+        distances = np.linalg.norm(self._full[rows] - query, axis=1)
+        best = int(np.argmin(distances))
+        best_row, best_distance = int(rows[best]), float(distances[best])
+
+        # a row outside the shortlist can only win if its screened distance
+        # minus its quantization error is below the winner's distance
+        lower_bounds = approx - self._errors[:size] - BOUND_SLACK
+        lower_bounds[rows] = np.inf
+        others = np.flatnonzero(lower_bounds < best_distance)
+        if len(others):
+            distances = np.linalg.norm(self._full[others] - query, axis=1)
+            best = int(np.argmin(distances))
+            if distances[best] < best_distance:
+                best_row, best_distance = int(others[best]), float(distances[best])
+
+        return self._ids[best_row], best_distance
+
+    def best_match(self, encoding, exact=False, fallback_distance=None):
+        """Return (customer_id, distance) of the closest face, or (None, None).
+
+        Always exact; exact and fallback_distance are accepted for
+        compatibility with FaceGallery.
+        """
+        return self.best_matches([encoding])[0]
+
+    def best_matches(self, encodings, exact=False, fallback_distance=None):
+        """best_match for N encodings, screened together in one pass over the codes"""
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self._lock:
+            if self._size == 0:
+                return [(None, None)] * len(queries)
+            approx = self._screen(queries)
+            return [self._rerank(query, row) for query, row in zip(queries, approx)]
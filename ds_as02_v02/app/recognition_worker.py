@@ -0,0 +1,112 @@
+import threading
+import cv2
+from face_tracker import FaceTracker, box_iou
+
+
+class RecognitionWorker:
+    """Run face recognition in the background on frames that contain a face.
+
+    The worker follows the MjpegBroadcaster and only spends detection and
+    matching time on frames where the Haar cascade already found a face, so
+    an empty counter costs nothing. Faces are tracked across frames, so a
+    visitor is encoded, matched and counted once per track rather than on
+    every frame. All tracks due for recognition in a frame are handled in
+    one batch: one detection pass, one encoding call and one gallery
+    lookup, however many people are in view. Results are published on the
+    event bus as 'recognition' events instead of clients polling
+    /api/capture_face.
+    """
+
+    def __init__(self, backend, broadcaster, branch_name, event_bus, tracker=None):
+        self.backend = backend
+        self.broadcaster = broadcaster
+        self.branch_name = branch_name
+        self.event_bus = event_bus
+        self.tracker = tracker or FaceTracker()
+
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='recognition-worker', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        seq = 0
+        while self._running:
+            seq, timestamp, frame, faces = self.broadcaster.wait_for_update(seq, timeout=1)
+            if frame is None:
+                continue
+
+            tracks = self.tracker.update(faces, timestamp)
+            pending = [track for track in tracks if self.tracker.needs_recognition(track, timestamp)]
+            if not pending:
+                continue
+
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            try:
+                self._recognize_tracks(pending, rgb_frame, timestamp)
+            except Exception as e:
+                print(f"Error in recognition worker: {e}")
+
+    def _assign_faces(self, tracks, analyses):
+        """Pair each track with the detected face overlapping its box the most"""
+        pairs = []
+        unused = list(analyses)
+        for track in tracks:
+            best, best_iou = None, 0.0
+            for analysis in unused:
+                top, right, bottom, left = analysis.location
+                iou = box_iou(track.box, (left, top, right - left, bottom - top))
+                if iou > best_iou:
+                    best, best_iou = analysis, iou
+            if best is not None:
+                unused.remove(best)
+                pairs.append((track, best))
+        return pairs
+
+    def _recognize_tracks(self, tracks, rgb_frame, now):
+        face_service = self.backend.face_service
+        for track in tracks:
+            track.attempted_at = now
+
+        analyses = face_service.analyze_faces(rgb_frame, [track.box for track in tracks])
+        to_match = []
+        for track, analysis in self._assign_faces(tracks, analyses):
+            # still the same person: keep the binding, no matching or DB work
+            if track.customer_id and track.is_same_face(analysis.encoding, face_service.tolerance):
+                track.bind(track.customer_id, track.encoding, track.match_distance, now)
+            else:
+                to_match.append((track, analysis))
+        if not to_match:
+            return
+
+        matches = self.backend.match_faces([analysis.encoding for _, analysis in to_match])
+        for (track, analysis), (customer_id, distance) in zip(to_match, matches):
+            self._bind_track(track, analysis, customer_id, distance, now)
+
+    def _bind_track(self, track, analysis, customer_id, distance, now):
+        # exactly one visit per track: an unbound track counts it in the
+        # same call, a re-verified one only if it changed customer
+        first_binding = track.customer_id is None
+        result = self.backend.process_face_match(analysis, customer_id, distance, self.branch_name, record_visit=first_binding)
+        status = result.get('status')
+        if status not in ('recognized', 'new_customer'):
+            return
+
+        changed = result['customer_id'] != track.customer_id
+        if changed and status == 'recognized' and not first_binding:
+            self.backend.record_customer_visit(result['customer_id'])
+
+        track.bind(result['customer_id'], analysis.encoding, result.get('match_distance', 0.0), now)
+        if changed:
+            self.event_bus.publish('recognition', result)
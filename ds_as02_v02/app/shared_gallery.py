@@ -0,0 +1,192 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+from face_gallery import ENCODING_SIZE, squared_distances
+
+ROW_BYTES = ENCODING_SIZE * 4
+ID_BYTES = 64
+
+
+class SharedFaceGallery:
+    """Face gallery shared by several worker processes through files.
+
+    <path>.f32 holds the encodings as a memory-mapped float32 matrix and
+    <path>.log is an append log of fixed-size records, record i naming the
+    customer of row i. Every worker maps the same pages, so the gallery is
+    in memory once however many workers attach, and a worker picks up rows
+    appended by others by reading the log past the point it has seen.
+
+    Writers serialize on an flock of <path>.lock. A re-enrolled customer is
+    appended again; earlier rows of the same customer are masked out of the
+    search. Rows are never removed, so there is no remove().
+    """
+
+    def __init__(self, path, initial_capacity=1024):
+        self.path = str(path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._vectors_path = self.path + '.f32'
+        self._log_path = self.path + '.log'
+        self._initial_capacity = initial_capacity
+
+        self._lock = threading.RLock()
+        self._lock_file = open(self.path + '.lock', 'a')
+        self._lock_depth = 0
+        self._warmup_file = None
+        self._warmup_claimed = False
+        self._log_fd = os.open(self._log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+        self._vectors = None
+        self._sq_norms = np.zeros(0, dtype=np.float32)
+        self._ids = []
+        self._rows = {}
+        self._seen = 0
+        self._refresh()
+
+    def __len__(self):
+        self._refresh()
+        return len(self._rows)
+
+    def __contains__(self, customer_id):
+        self._refresh()
+        return customer_id in self._rows
+
+    def __setitem__(self, customer_id, encoding):
+        self.add(customer_id, encoding)
+
+    def __getitem__(self, customer_id):
+        self._refresh()
+        with self._lock:
+            return np.array(self._vectors[self._rows[customer_id]])
+
+    def ids(self):
+        self._refresh()
+        with self._lock:
+            return list(self._rows)
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the cross-process writer lock (re-entrant within a process)"""
+        with self._lock:
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _warmup_lock(self):
+        if self._warmup_file is None:
+            self._warmup_file = open(self.path + '.warmup.lock', 'a')
+        return self._warmup_file
+
+    def claim_warmup(self):
+        """True for the one process that should rebuild stale encodings"""
+        self._warmup_lock()
+        try:
+            fcntl.flock(self._warmup_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._warmup_claimed = True
+        return True
+
+    def release_warmup(self):
+        if self._warmup_claimed:
+            fcntl.flock(self._warmup_file, fcntl.LOCK_UN)
+            self._warmup_claimed = False
+
+    def warmup_running_elsewhere(self):
+        if self._warmup_claimed:
+            return False
+        self._warmup_lock()
+        try:
+            fcntl.flock(self._warmup_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(self._warmup_file, fcntl.LOCK_UN)
+        return False
+
+    def _map(self, rows):
+        """Make sure the mapping covers rows rows, growing the file if needed"""
+        if self._vectors is not None and len(self._vectors) >= rows:
+            return
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        if size < rows * ROW_BYTES:
+            capacity = max(rows, self._initial_capacity, 2 * (size // ROW_BYTES))
+            with open(self._vectors_path, 'ab') as f:
+                f.truncate(capacity * ROW_BYTES)
+            size = capacity * ROW_BYTES
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(size // ROW_BYTES, ENCODING_SIZE))
+
+    def _refresh(self):
+        """Take in rows other processes appended since the last look"""
+        total = os.fstat(self._log_fd).st_size // ID_BYTES
+        if total == self._seen:
+            return
+        with self._lock:
+            total = os.fstat(self._log_fd).st_size // ID_BYTES
+            if total <= self._seen:
+                return
+            records = os.pread(self._log_fd, (total - self._seen) * ID_BYTES, self._seen * ID_BYTES)
+            self._map(total)
+
+            block = self._vectors[self._seen:total]
+            sq_norms = np.concatenate([self._sq_norms, np.einsum('ij,ij->i', block, block).astype(np.float32)])
+            ids = list(self._ids)
+            for offset in range(total - self._seen):
+                row = self._seen + offset
+                customer_id = records[offset * ID_BYTES:(offset + 1) * ID_BYTES].rstrip(b'\0').decode()
+                previous = self._rows.get(customer_id)
+                if previous is not None:
+                    # superseded rows can never win a search
+                    sq_norms[previous] = np.inf
+                    ids[previous] = None
+                self._rows[customer_id] = row
+                ids.append(customer_id)
+
+            # searches read these without the lock, so replace, don't mutate
+            self._sq_norms, self._ids = sq_norms, ids
+            self._seen = total
+
+    def add(self, customer_id, encoding):
+        self.add_many([customer_id], [encoding])
+
+    def add_many(self, customer_ids, encodings):
+        customer_ids = list(customer_ids)
+        if not customer_ids:
+            return
+        vectors = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        records = b''.join(customer_id.encode().ljust(ID_BYTES, b'\0')[:ID_BYTES] for customer_id in customer_ids)
+
+        with self.exclusive():
+            self._refresh()
+            start = self._seen
+            self._map(start + len(customer_ids))
+            self._vectors[start:start + len(customer_ids)] = vectors
+            self._vectors.flush()
+            # rows are on disk before the log makes them visible
+            os.write(self._log_fd, records)
+            self._refresh()
+
+    def best_match(self, encoding, exact=False, fallback_distance=None):
+        """Return (customer_id, distance) of the closest face, or (None, None)"""
+        return self.best_matches([encoding])[0]
+
+    def best_matches(self, encodings, exact=False, fallback_distance=None):
+        """best_match for N encodings with one N x K distance computation"""
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        self._refresh()
+        with self._lock:
+            vectors, sq_norms, ids = self._vectors, self._sq_norms, self._ids
+        if not ids:
+            return [(None, None)] * len(queries)
+
+        matrix = vectors[:len(ids)]
+        rows = np.argmin(squared_distances(queries, matrix, sq_norms), axis=1)
+        distances = np.linalg.norm(matrix[rows] - queries, axis=1)
+        return [(ids[row], float(distance)) if ids[row] is not None else (None, None)
+                for row, distance in zip(rows, distances)]
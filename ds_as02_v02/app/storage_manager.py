@@ -1,32 +1,22 @@
 import os
 import io
-from minio import Minio
 from minio.error import S3Error
 from PIL import Image
 from dotenv import load_dotenv
 from pathlib import Path
+from clients import get_minio_client
+from metrics import timed
 
 env_path = Path(__file__).resolve().parent.parent / "configs" / ".env"
 load_dotenv(dotenv_path=env_path)
 
 class StorageManager:
     def __init__(self):
-        endpoint = os.getenv('MINIO_ENDPOINT')
-        access_key = os.getenv('MINIO_ACCESS_KEY')
-        secret_key = os.getenv('MINIO_SECRET_KEY')
-        
-        print(f"Connecting to MinIO: {endpoint}")
-        print(f"Access Key: {access_key}")
-        
-        self.client = Minio(
-            endpoint,
-            access_key=access_key,
-            secret_key=secret_key,
-            secure=False
-        )
+        self.client = get_minio_client()
         self.bucket_name = os.getenv('MINIO_BUCKET', 'customer-faces')
-        
-        # Create bucket if not exists
+    
+    def create_bucket(self):
+        """One-time setup, run by check_connection.py rather than on every start"""
         try:
             if not self.client.bucket_exists(self.bucket_name):
                 self.client.make_bucket(self.bucket_name)
@@ -36,9 +26,13 @@ class StorageManager:
         except Exception as e:
             print(f"Error checking/creating bucket: {e}")
     
+    def face_object_name(self, customer_id):
+        return f"{customer_id}.jpg"
+    
+    @timed('minio_put')
     def upload_face_image(self, customer_id, image_data):
         try:
-            object_name = f"{customer_id}.jpg"
+            object_name = self.face_object_name(customer_id)
             
             # Convert to bytes if PIL Image
             if isinstance(image_data, Image.Image):
@@ -63,9 +57,10 @@ class StorageManager:
             print(f"Error uploading image: {e}")
             return None
     
+    @timed('minio_get')
     def download_face_image(self, customer_id):
         try:
-            object_name = f"{customer_id}.jpg"
+            object_name = self.face_object_name(customer_id)
             response = self.client.get_object(self.bucket_name, object_name)
             image_data = response.read()
             response.close()
@@ -75,12 +70,36 @@ class StorageManager:
             print(f"Error downloading image: {e}")
             return None
     
+    @timed('minio_get')
+    def download_face_object(self, customer_id):
+        """Return (image bytes, ETag) of the stored face, or (None, None)"""
+        try:
+            object_name = self.face_object_name(customer_id)
+            response = self.client.get_object(self.bucket_name, object_name)
+            image_data = response.read()
+            etag = response.headers.get('ETag', '').strip('"')
+            response.close()
+            response.release_conn()
+            return image_data, etag
+        except S3Error as e:
+            print(f"Error downloading image: {e}")
+            return None, None
+    
+    @timed('minio_stat')
+    def stat_face_image(self, customer_id):
+        """ETag of the stored face, or None if there is none"""
+        try:
+            return self.client.stat_object(self.bucket_name, self.face_object_name(customer_id)).etag
+        except S3Error:
+            return None
+    
     def get_face_image_path(self, customer_id):
         return f"{self.bucket_name}/{customer_id}.jpg"
     
+    @timed('minio_delete')
     def delete_face_image(self, customer_id):
         try:
-            object_name = f"{customer_id}.jpg"
+            object_name = self.face_object_name(customer_id)
             self.client.remove_object(self.bucket_name, object_name)
             return True
         except S3Error as e:
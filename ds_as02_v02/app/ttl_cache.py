@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds.
+
+    Cached values are shared between callers and must be treated as
+    read-only. A value loaded while its key is invalidated is returned to
+    the caller but not cached, since it may predate the write behind the
+    invalidation.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # key -> [loads in flight, generation]; invalidate() bumps the
+        # generation so those loads know their result may be stale
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value, calling loader() on a miss.
+
+        None results are not cached so a missing record is looked up again.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.load(key, loader)
+        return value
+
+    def load(self, key, loader):
+        """Call loader() and cache its result unless key was invalidated meanwhile"""
+        with self._lock:
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+
+        value = None
+        try:
+            value = loader()
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                if loading[0] == 0:
+                    del self._loading[key]
+                if value is not None and loading[1] == generation:
+                    self._store(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._loading:
+                self._loading[key][1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for loading in self._loading.values():
+                loading[1] += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl
+        }
@@ -0,0 +1,127 @@
+import threading
+import time
+import cv2
+
+
+class MjpegBroadcaster:
+    """Annotate and JPEG-encode each camera frame once for all viewers.
+
+    A single thread pulls frames from the CameraStream at the configured
+    output rate, runs the Haar face cascade, draws the boxes and encodes
+    the JPEG. Every /video_feed subscriber receives the same bytes. A slow
+    subscriber always jumps to the newest frame, so it drops frames instead
+    of falling behind or holding up the others.
+    """
+
+    def __init__(self, camera, fps=15, jpeg_quality=80):
+        self.camera = camera
+        self.fps = fps
+        self.jpeg_quality = jpeg_quality
+
+        self.face_cascade = cv2.CascadeClassifier(
+            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        )
+
+        # (seq, timestamp, raw frame, Haar boxes, jpeg bytes or None)
+        self._latest = (0, 0, None, [], None)
+        self._condition = threading.Condition()
+        self._subscribers = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='mjpeg-broadcast', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        interval = 1.0 / self.fps if self.fps else 0
+        camera_seq = 0
+        next_due = 0
+
+        while self._running:
+            camera_seq, timestamp, frame = self.camera.wait_for_frame(camera_seq, timeout=1)
+            if frame is None:
+                continue
+
+            # throttle to the output rate by skipping camera frames
+            now = time.time()
+            if now < next_due:
+                continue
+            next_due = max(next_due + interval, now)
+
+            faces = self._detect_faces(frame)
+
+            # viewers-only work is skipped while nobody is watching
+            jpeg = None
+            if self._subscribers:
+                jpeg = self._annotate_and_encode(frame, faces)
+
+            with self._condition:
+                seq = self._latest[0] + 1
+                self._latest = (seq, timestamp, frame, faces, jpeg)
+                self._condition.notify_all()
+
+    def _detect_faces(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
+        return [tuple(int(v) for v in face) for face in faces]
+
+    def _annotate_and_encode(self, frame, faces):
+        # the camera frame is shared, draw on a copy
+        frame = frame.copy()
+        for (x, y, w, h) in faces:
+            cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+
+        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return buffer.tobytes() if ret else None
+
+    def latest(self):
+        """Return (timestamp, raw BGR frame, Haar boxes) of the newest processed frame."""
+        with self._condition:
+            _, timestamp, frame, faces, _ = self._latest
+            return timestamp, frame, faces
+
+    def wait_for_update(self, after_seq=0, timeout=None):
+        """Block until a frame newer than after_seq; return (seq, timestamp, frame, faces)."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._latest[0] > after_seq, timeout)
+            seq, timestamp, frame, faces, _ = self._latest
+            return seq, timestamp, frame, faces
+
+    def subscribe(self, keepalive=5):
+        """Generator of multipart MJPEG chunks for one viewer.
+
+        Runs until the viewer disconnects. While the camera sends nothing,
+        the last frame is sent again every keepalive seconds, so the stream
+        stays open and a closed connection is noticed on the next write.
+        """
+        with self._condition:
+            self._subscribers += 1
+        try:
+            seq = 0
+            jpeg = None
+            while True:
+                with self._condition:
+                    ready = self._condition.wait_for(
+                        lambda: self._latest[0] > seq and self._latest[4] is not None,
+                        keepalive
+                    )
+                    if ready:
+                        seq, jpeg = self._latest[0], self._latest[4]
+                if jpeg is None:
+                    continue
+
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+        finally:
+            with self._condition:
+                self._subscribers -= 1
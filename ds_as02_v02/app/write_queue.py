@@ -0,0 +1,302 @@
+import fcntl
+import io
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import bson
+from bson import ObjectId
+from PIL import Image
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+
+# applied in this order within a batch, so a customer exists before
+# anything that refers to them
+WRITE_KINDS = ('customer', 'visit', 'order', 'face_image')
+
+
+class WriteBehindQueue:
+    """Durable write-behind queue for customer, visit, order and image writes.
+
+    Callers append a write to a local SQLite journal and return right away;
+    a background thread drains the journal in batches with insert_many /
+    bulk_write for Mongo and concurrent uploads for MinIO. A write leaves the
+    journal only once it is stored, so writes made while a backend is down
+    (or before a restart) are applied when it comes back. Writes are applied
+    at least once: customers and orders carry their ids, so a replay of an
+    already stored one is skipped, and visits carry an id that
+    DatabaseManager.record_visits counts only once.
+
+    An image upload that fails is retried on its own back-off, so it does
+    not hold up the writes behind it. After max_attempts it is moved to
+    the dead_letters table, and dead letters are queued again on the next
+    start (e.g. once a missing bucket has been created).
+    """
+
+    def __init__(self, db_manager, storage_manager, path, batch_size=500,
+                 flush_interval=0.2, retry_delay=1.0, max_retry_delay=60.0,
+                 upload_workers=4, max_attempts=20, on_face_image_stored=None):
+        self.db_manager = db_manager
+        self.storage_manager = storage_manager
+        self.on_face_image_stored = on_face_image_stored
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.upload_workers = upload_workers
+        self.max_attempts = max_attempts
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        # WAL keeps appends cheap; NORMAL still survives a process crash
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS writes ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload BLOB NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, retry_at REAL NOT NULL DEFAULT 0)'
+        )
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(writes)')}
+        if 'attempts' not in columns:
+            # journal from before per-write retries
+            self._conn.execute('ALTER TABLE writes ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            self._conn.execute('ALTER TABLE writes ADD COLUMN retry_at REAL NOT NULL DEFAULT 0')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS dead_letters ('
+            'id INTEGER PRIMARY KEY, kind TEXT NOT NULL, payload BLOB NOT NULL, '
+            'attempts INTEGER NOT NULL, failed_at REAL NOT NULL)'
+        )
+        self._lock = threading.Lock()
+        # worker processes may share the journal; one drains it at a time
+        self._drain_lock = open(str(path) + '.lock', 'a')
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        requeued = self._requeue_dead_letters()
+        if requeued:
+            print(f"Write-behind queue: retrying {requeued} writes that failed in a previous run")
+        pending = self.pending()
+        if pending:
+            print(f"Write-behind queue: {pending} writes pending from a previous run")
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """Stop draining after a last flush attempt; unsent writes stay journaled"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return
+        with self._lock:
+            self._conn.close()
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM writes').fetchone()[0]
+
+    def pending_customers(self, encoding_model):
+        """(customer_id, face_encoding) of journaled customers not yet stored, for encoding_model"""
+        with self._lock:
+            payloads = self._conn.execute(
+                "SELECT payload FROM writes WHERE kind = 'customer' ORDER BY id"
+            ).fetchall()
+        customers = [bson.decode(payload) for payload, in payloads]
+        return [(c['customer_id'], c['face_encoding']) for c in customers
+                if c.get('face_encoding') is not None and c.get('encoding_model') == encoding_model]
+
+    def dead_letters(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+
+    def _requeue_dead_letters(self):
+        with self._lock:
+            self._conn.execute('BEGIN')
+            count = self._conn.execute(
+                'INSERT INTO writes (id, kind, payload) SELECT id, kind, payload FROM dead_letters'
+            ).rowcount
+            self._conn.execute('DELETE FROM dead_letters')
+            self._conn.execute('COMMIT')
+        return count
+
+    def _append(self, kind, payload):
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO writes (kind, payload) VALUES (?, ?)',
+                (kind, bson.encode(payload))
+            )
+
+    def create_customer(self, customer_id, name, face_image_path, face_encoding=None, encoding_model=None, branch=None):
+        now = datetime.now()
+        customer = {
+            '_id': ObjectId(),
+            'customer_id': customer_id,
+            'name': name,
+            'face_image_path': face_image_path,
+            'branch': branch,
+            'created_at': now,
+            'last_visit': now,
+            'total_visits': 1
+        }
+        if face_encoding is not None:
+            customer['face_encoding'] = face_encoding
+            customer['encoding_model'] = encoding_model
+        self._append('customer', customer)
+
+        # serve reads of the new customer until the insert lands
+        profile = {key: value for key, value in customer.items() if key != 'face_encoding'}
+        self.db_manager.customer_cache.set(customer_id, profile)
+        return str(customer['_id'])
+
+    def record_visit(self, customer_id):
+        self._append('visit', {'_id': ObjectId(), 'customer_id': customer_id, 'visited_at': datetime.now()})
+
+    def add_order(self, customer_id, items, total_price, branch):
+        order = {
+            '_id': ObjectId(),
+            'customer_id': customer_id,
+            'items': items,
+            'total_price': total_price,
+            'branch': branch,
+            'order_date': datetime.now()
+        }
+        self._append('order', order)
+        return str(order['_id'])
+
+    def upload_face_image(self, customer_id, image_data):
+        if isinstance(image_data, Image.Image):
+            buffer = io.BytesIO()
+            image_data.save(buffer, format='JPEG')
+            image_data = buffer.getvalue()
+        self._append('face_image', {'customer_id': customer_id, 'image': image_data})
+        return self.storage_manager.face_object_name(customer_id)
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                drained = self._flush_batch()
+            except Exception as e:
+                if stopping:
+                    print(f"Write-behind queue stopped with writes pending: {e}")
+                    return
+                print(f"Write-behind flush failed, retrying in {delay:.0f}s: {e}")
+                self._stop.wait(delay)
+                delay = min(2 * delay, self.max_retry_delay)
+                continue
+
+            delay = self.retry_delay
+            if stopping and not drained:
+                return
+            if not drained:
+                # let writes pile up into the next batch
+                self._stop.wait(self.flush_interval)
+
+    def _flush_batch(self):
+        """Apply the oldest batch of writes; return how many were stored"""
+        fcntl.flock(self._drain_lock, fcntl.LOCK_EX)
+        try:
+            return self._flush_locked()
+        finally:
+            fcntl.flock(self._drain_lock, fcntl.LOCK_UN)
+
+    def _flush_locked(self):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, kind, payload, attempts FROM writes WHERE retry_at <= ? ORDER BY id LIMIT ?',
+                (time.time(), self.batch_size)
+            ).fetchall()
+        if not rows:
+            return 0
+
+        by_kind = {kind: [] for kind in WRITE_KINDS}
+        attempts = {}
+        for row_id, kind, payload, row_attempts in rows:
+            by_kind[kind].append((row_id, bson.decode(payload)))
+            attempts[row_id] = row_attempts
+
+        stored = 0
+        for kind in WRITE_KINDS:
+            writes = by_kind[kind]
+            if not writes:
+                continue
+            if kind == 'customer':
+                self._insert_ignoring_duplicates(self.db_manager.insert_customers, [w for _, w in writes])
+            elif kind == 'visit':
+                # visits journaled before they had ids fall back to their row id
+                self.db_manager.record_visits([
+                    (w['customer_id'], w.get('_id', f'journal-{row_id}'), w['visited_at'])
+                    for row_id, w in writes
+                ])
+            elif kind == 'order':
+                self._insert_ignoring_duplicates(self.db_manager.insert_orders, [w for _, w in writes])
+            else:
+                writes, failed = self._upload_images(writes)
+                self._defer([(row_id, attempts[row_id]) for row_id, _ in failed])
+            self._remove([row_id for row_id, _ in writes])
+            stored += len(writes)
+        return stored
+
+    def _defer(self, failed):
+        """Back off (row_id, attempts) writes that failed, dead-lettering the hopeless ones"""
+        if not failed:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            for row_id, row_attempts in failed:
+                row_attempts += 1
+                if row_attempts >= self.max_attempts:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO dead_letters (id, kind, payload, attempts, failed_at) '
+                        'SELECT id, kind, payload, ?, ? FROM writes WHERE id = ?',
+                        (row_attempts, now, row_id)
+                    )
+                    self._conn.execute('DELETE FROM writes WHERE id = ?', (row_id,))
+                    print(f"Write-behind queue: gave up on write {row_id} after {row_attempts} attempts")
+                else:
+                    delay = min(self.retry_delay * 2 ** row_attempts, self.max_retry_delay)
+                    self._conn.execute(
+                        'UPDATE writes SET attempts = ?, retry_at = ? WHERE id = ?',
+                        (row_attempts, now + delay, row_id)
+                    )
+            self._conn.execute('COMMIT')
+
+    def _insert_ignoring_duplicates(self, insert_many, documents):
+        try:
+            insert_many(documents)
+        except BulkWriteError as e:
+            # documents stored by an earlier, interrupted attempt
+            if any(error['code'] != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+                raise
+
+    def _upload_images(self, writes):
+        """Upload concurrently; return (stored writes, failed writes)"""
+        def upload(write):
+            _, image = write
+            try:
+                return self.storage_manager.upload_face_image(image['customer_id'], image['image']) is not None
+            except Exception as e:
+                print(f"Error uploading face image of {image['customer_id']}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as pool:
+            results = list(pool.map(upload, writes))
+        stored = [write for write, ok in zip(writes, results) if ok]
+        failed = [write for write, ok in zip(writes, results) if not ok]
+        if self.on_face_image_stored is not None:
+            for _, image in stored:
+                self.on_face_image_stored(image['customer_id'])
+        return stored, failed
+
+    def _remove(self, row_ids):
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('DELETE FROM writes WHERE id = ?', [(row_id,) for row_id in row_ids])
+            self._conn.execute('COMMIT')
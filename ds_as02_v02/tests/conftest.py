@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the app's modules import each other as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'app'))
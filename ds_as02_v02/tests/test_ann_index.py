@@ -0,0 +1,128 @@
+import threading
+import time
+import numpy as np
+import pytest
+from ann_index import IVFIndex, create_index, measure_recall, _nearest
+from face_gallery import FaceGallery
+
+
+def encodings(count, seed):
+    return np.random.default_rng(seed).normal(0.0, 0.1, (count, 128)).astype(np.float32)
+
+
+def wait_for_training(index, timeout=30):
+    deadline = time.monotonic() + timeout
+    while index.training:
+        assert time.monotonic() < deadline, 'index training did not finish'
+        time.sleep(0.01)
+
+
+def assert_bucketed(gallery, index):
+    """Every row sits in exactly one list, the one of its nearest centroid"""
+    rows = len(gallery)
+    expected = _nearest(gallery._matrix[:rows], index.centroids).tolist()
+    assert sorted(index._assignment) == list(range(rows))
+    assert [index._assignment[row] for row in range(rows)] == expected
+    assert sum(len(rows_in_list) for rows_in_list in index._lists) == rows
+
+
+class BlockedFit:
+    """Hold IVFIndex.fit until released, to change the gallery while it runs"""
+
+    def __init__(self, index):
+        self.fit = index.fit
+        self.started = threading.Event()
+        self.release = threading.Event()
+        index.fit = self
+
+    def __call__(self, matrix):
+        self.started.set()
+        assert self.release.wait(30)
+        return self.fit(matrix)
+
+
+def test_training_is_due_at_threshold_and_when_gallery_doubles():
+    index = IVFIndex(nlist=16, min_train_size=100)
+    assert not index.needs_training(99)
+    assert index.needs_training(100)
+
+    index.trained_size = 100
+    index.centroids = np.zeros((16, 128), dtype=np.float32)
+    assert not index.needs_training(199)
+    assert index.needs_training(200)
+
+    index.begin_training()
+    assert not index.needs_training(400)
+
+
+def test_exact_index_never_trains():
+    assert not create_index('exact').needs_training(10 ** 6)
+    with pytest.raises(ValueError):
+        create_index('hnsw')
+
+
+def test_gallery_trains_in_background_and_buckets_every_row():
+    index = IVFIndex(nlist=16, nprobe=16, min_train_size=200)
+    gallery = FaceGallery(index=index)
+    faces = encodings(300, 0)
+    gallery.add_many([f"c{i}" for i in range(300)], faces)
+    wait_for_training(index)
+
+    assert index.trained
+    assert index.trained_size == 300
+    assert_bucketed(gallery, index)
+    # probing every list is an exact search
+    assert measure_recall(gallery, faces[:50] + 0.001) == 1.0
+
+
+def test_rows_changed_during_retraining_are_rebucketed():
+    index = IVFIndex(nlist=16, min_train_size=100)
+    gallery = FaceGallery(index=index)
+    gallery.add_many([f"a{i}" for i in range(100)], encodings(100, 1))
+    wait_for_training(index)
+
+    blocked = BlockedFit(index)
+    # doubling the gallery starts a retrain on a snapshot of 200 rows
+    gallery.add_many([f"b{i}" for i in range(100)], encodings(100, 2))
+    assert blocked.started.wait(30)
+    assert index.training
+
+    # adds, overwrites and removes (which move the last row) while it runs
+    gallery.add_many([f"c{i}" for i in range(50)], encodings(50, 3))
+    for i, face in enumerate(encodings(30, 4)):
+        gallery.add(f"b{i}", face)
+        gallery.remove(f"a{i}")
+    blocked.release.set()
+    wait_for_training(index)
+
+    assert len(gallery) == 220
+    assert index.trained_size == 220
+    assert_bucketed(gallery, index)
+
+
+def test_failed_training_is_cancelled():
+    index = IVFIndex(nlist=16, min_train_size=100)
+    gallery = FaceGallery(index=index)
+
+    def fail(matrix):
+        raise MemoryError('no room for k-means')
+    index.fit = fail
+
+    faces = encodings(100, 5)
+    gallery.add_many([f"c{i}" for i in range(100)], faces)
+    wait_for_training(index)
+
+    assert not index.trained
+    assert gallery.best_match(faces[7])[0] == 'c7'
+
+
+def test_missed_candidate_falls_back_to_exact_scan():
+    index = IVFIndex(nlist=16, nprobe=1, min_train_size=100)
+    gallery = FaceGallery(index=index)
+    faces = encodings(200, 6)
+    gallery.add_many([f"c{i}" for i in range(200)], faces)
+    wait_for_training(index)
+
+    # every enrolled face is found within tolerance, whichever list it is in
+    for i in range(0, 200, 10):
+        assert gallery.best_match(faces[i] + 0.001, fallback_distance=0.6)[0] == f"c{i}"
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+import pytest
+import database_manager
+
+mongomock = pytest.importorskip('mongomock')
+
+
+def server_dates(update):
+    """$currentDate as MongoDB applies it, to the millisecond; mongomock keeps microseconds"""
+    if '$currentDate' not in update:
+        return update
+    now = datetime.now()
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    update = dict(update)
+    fields = update.pop('$currentDate')
+    update['$set'] = dict(update.get('$set', {}), **{field: now for field in fields})
+    return update
+
+
+@pytest.fixture
+def db_manager(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setenv('MONGO_DB', 'test')
+    monkeypatch.setattr(database_manager, 'get_mongo_client', lambda: client)
+    manager = database_manager.DatabaseManager()
+
+    # mongomock's bulk_write does not accept the UpdateOne arguments of
+    # current pymongo; apply the same updates one at a time
+    def bulk_write(requests, ordered=True):
+        for request in requests:
+            manager.customers.update_one(request._filter, server_dates(request._doc), upsert=bool(request._upsert))
+    monkeypatch.setattr(manager.customers, 'bulk_write', bulk_write, raising=False)
+    return manager
+
+
+def customer(customer_id, last_visit, **fields):
+    return dict({
+        'customer_id': customer_id,
+        'name': f"Customer_{customer_id}",
+        'created_at': last_visit,
+        'last_visit': last_visit,
+        'total_visits': 1
+    }, **fields)
+
+
+def test_replayed_visits_are_counted_once(db_manager):
+    start = datetime(2024, 1, 1, 9)
+    db_manager.insert_customers([customer('c1', start)])
+
+    visits = [('c1', 'v1', start + timedelta(hours=1)), ('c1', 'v2', start + timedelta(hours=2))]
+    db_manager.record_visits(visits)
+    db_manager.record_visits(visits)
+
+    stored = db_manager.customers.find_one({'customer_id': 'c1'})
+    assert stored['total_visits'] == 3
+    assert stored['last_visit'] == start + timedelta(hours=2)
+
+
+def test_visit_ids_are_bounded(db_manager, monkeypatch):
+    monkeypatch.setattr(database_manager, 'RECENT_VISIT_IDS', 3)
+    start = datetime(2024, 1, 1, 9)
+    db_manager.insert_customers([customer('c1', start)])
+
+    db_manager.record_visits([('c1', f"v{i}", start) for i in range(5)])
+
+    stored = db_manager.customers.find_one({'customer_id': 'c1'})
+    assert stored['visit_ids'] == ['v2', 'v3', 'v4']
+    assert stored['total_visits'] == 6
+
+
+def test_visit_invalidates_cached_customer(db_manager):
+    start = datetime(2024, 1, 1, 9)
+    db_manager.insert_customers([customer('c1', start)])
+    assert db_manager.get_customer('c1')['total_visits'] == 1
+
+    db_manager.record_visits([('c1', 'v1', start)])
+    assert db_manager.get_customer('c1')['total_visits'] == 2
+
+
+def test_insert_leaves_stored_customers_alone(db_manager):
+    start = datetime(2024, 1, 1, 9)
+    db_manager.insert_customers([customer('c1', start)])
+    db_manager.insert_customers([customer('c1', start, name='Replayed'), customer('c2', start)])
+
+    assert db_manager.customers.count_documents({}) == 2
+    assert db_manager.customers.find_one({'customer_id': 'c1'})['name'] == 'Customer_c1'
+    assert all('changed_at' in stored for stored in db_manager.customers.find())
+
+
+def test_customer_pages_continue_after_ties(db_manager):
+    start = datetime(2024, 1, 1, 9)
+    # several customers share a last_visit, so the cursor needs the id too
+    db_manager.insert_customers([
+        customer(f"c{i}", start + timedelta(minutes=i // 3)) for i in range(8)
+    ])
+
+    seen = []
+    before = None
+    for _ in range(10):
+        page = db_manager.get_customers_page(3, before)
+        seen.extend(stored['customer_id'] for stored in page)
+        if len(page) < 3:
+            break
+        before = (page[-1]['last_visit'], page[-1]['customer_id'])
+    else:
+        pytest.fail('paging did not reach the end')
+
+    expected = sorted(
+        db_manager.customers.find(),
+        key=lambda stored: (stored['last_visit'], stored['customer_id']),
+        reverse=True
+    )
+    assert seen == [stored['customer_id'] for stored in expected]
+
+
+def test_changed_since_sees_each_change_once(db_manager):
+    long_ago = datetime(2020, 1, 1)
+    db_manager.insert_customers([customer('c1', long_ago), customer('c2', long_ago)])
+    token = db_manager.get_latest_change()
+
+    # a customer queued long ago but stored now, and a visit to an old one
+    db_manager.insert_customers([customer('c3', long_ago)])
+    db_manager.record_visits([('c1', 'v1', long_ago)])
+
+    seen = []
+    for _ in range(10):
+        page = db_manager.get_customers_changed_since(token, 1)
+        if not page:
+            break
+        seen.extend(stored['customer_id'] for stored in page)
+        token = (page[-1]['changed_at'], page[-1]['customer_id'])
+    else:
+        pytest.fail('the delta kept returning changes')
+
+    assert sorted(seen) == ['c1', 'c3']
+    assert token == db_manager.get_latest_change()
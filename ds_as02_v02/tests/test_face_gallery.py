@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from face_gallery import DenseGallery, FaceGallery
+from quantized_gallery import QuantizedFaceGallery
+
+
+def encodings(count, seed):
+    return np.random.default_rng(seed).normal(0.0, 0.1, (count, 128)).astype(np.float32)
+
+
+@pytest.fixture(params=['float32', 'int8'])
+def gallery(request, tmp_path):
+    if request.param == 'int8':
+        return QuantizedFaceGallery(spill_dir=tmp_path, initial_capacity=4)
+    return FaceGallery(initial_capacity=4)
+
+
+def test_add_many_keeps_last_encoding_of_repeated_id(gallery):
+    first, other, last = encodings(3, 0)
+    gallery.add_many(['a', 'b', 'a'], [first, other, last])
+
+    assert len(gallery) == 2
+    assert gallery.ids() == ['a', 'b']
+    assert gallery.best_match(last) == ('a', pytest.approx(0.0, abs=0.05))
+
+    gallery.remove('a')
+    assert gallery.ids() == ['b']
+    assert gallery.best_match(last)[0] == 'b'
+
+
+def test_rows_stay_dense_through_growth_removes_and_overwrites(gallery):
+    faces = encodings(20, 1)
+    ids = [f"c{i}" for i in range(20)]
+    gallery.add_many(ids[:10], faces[:10])
+    for customer_id, face in zip(ids[10:], faces[10:]):
+        gallery.add(customer_id, face)
+    for customer_id in ids[:20:3]:
+        del gallery[customer_id]
+    replaced = encodings(1, 2)[0]
+    gallery['c1'] = replaced
+
+    kept = [i for i in range(20) if i % 3]
+    assert sorted(gallery.ids()) == sorted(ids[i] for i in kept)
+    for i in kept:
+        expected = replaced if i == 1 else faces[i]
+        assert gallery.best_match(expected)[0] == ids[i]
+    with pytest.raises(KeyError):
+        del gallery['c0']
+
+
+def test_dense_gallery_subclass_must_store_rows():
+    class Incomplete(DenseGallery):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
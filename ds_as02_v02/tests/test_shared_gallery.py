@@ -0,0 +1,105 @@
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pytest
+from gallery_shards import ShardedGallery, GalleryShard
+from shared_gallery import SharedFaceGallery
+
+
+def encodings(count, seed):
+    return np.random.default_rng(seed).normal(0.0, 0.1, (count, 128)).astype(np.float32)
+
+
+def enroll_in_process(path, worker, count):
+    gallery = SharedFaceGallery(path)
+    for row, encoding in enumerate(encodings(count, worker)):
+        gallery.add(f"w{worker}-{row}", encoding)
+
+
+def test_rows_appended_by_another_gallery_are_seen(tmp_path):
+    first = SharedFaceGallery(tmp_path / 'gallery')
+    second = SharedFaceGallery(tmp_path / 'gallery')
+    faces = encodings(3, 0)
+
+    first.add_many(['a', 'b'], faces[:2])
+    second.add('c', faces[2])
+
+    assert len(first) == len(second) == 3
+    assert first.best_match(faces[2])[0] == 'c'
+    assert second.best_match(faces[0])[0] == 'a'
+    np.testing.assert_array_equal(second['b'], faces[1])
+
+
+def test_reenrolled_customer_keeps_latest_encoding(tmp_path):
+    gallery = SharedFaceGallery(tmp_path / 'gallery')
+    old, new = encodings(2, 1)
+    near_old = old + 0.01
+    gallery.add_many(['a', 'b'], [old, near_old])
+    gallery.add('a', new)
+
+    assert len(gallery) == 2
+    assert sorted(gallery.ids()) == ['a', 'b']
+    np.testing.assert_array_equal(gallery['a'], new)
+    # the superseded row can no longer win a search
+    assert gallery.best_match(old)[0] == 'b'
+    assert gallery.best_match(new)[0] == 'a'
+
+
+def test_gallery_is_reopened_from_its_files(tmp_path):
+    faces = encodings(4, 2)
+    SharedFaceGallery(tmp_path / 'gallery').add_many(['a', 'b', 'c', 'd'], faces)
+
+    reopened = SharedFaceGallery(tmp_path / 'gallery')
+    assert len(reopened) == 4
+    assert [reopened.best_match(face)[0] for face in faces] == ['a', 'b', 'c', 'd']
+
+
+def test_processes_enrolling_concurrently(tmp_path):
+    path = tmp_path / 'gallery'
+    gallery = SharedFaceGallery(path)
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=enroll_in_process, args=(path, worker, 40)) for worker in range(3)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+
+    assert len(gallery) == 120
+    for worker in range(3):
+        faces = encodings(40, worker)
+        assert [customer_id for customer_id, _ in gallery.best_matches(faces)] == \
+            [f"w{worker}-{row}" for row in range(40)]
+
+
+def test_shard_imports_legacy_ids_file(tmp_path):
+    faces = encodings(3, 3)
+    Path(tmp_path, 'north.f32').write_bytes(faces.tobytes())
+    Path(tmp_path, 'north.ids').write_text('x1\nx2\nx3\n')
+
+    shard = GalleryShard(tmp_path, 'north')
+    assert not Path(tmp_path, 'north.ids').exists()
+    assert [shard.best_match(face)[0] for face in faces] == ['x1', 'x2', 'x3']
+
+
+def test_sharded_gallery_searches_other_branches_when_local_misses(tmp_path):
+    gallery = ShardedGallery(tmp_path, tolerance=0.6)
+    north, south = encodings(2, 4)
+    gallery.add('n1', north, 'North')
+    gallery.add('s1', south, 'South')
+
+    assert gallery.best_match(north, 'North')[::2] == ('n1', 'north')
+    # not in the South shard, found in North
+    assert gallery.best_match(north, 'South')[::2] == ('n1', 'north')
+    stranger = np.ones(128, dtype=np.float32)
+    assert gallery.best_match(stranger, 'North')[0] is None
+
+
+def test_sharded_gallery_keeps_customer_in_first_shard(tmp_path):
+    gallery = ShardedGallery(tmp_path)
+    first, second = encodings(2, 5)
+    gallery.add('c1', first, 'North')
+    gallery.add('c1', second, 'South')
+
+    assert gallery.shard_sizes() == {'north': 1}
+    assert gallery.best_match(second, 'South')[::2] == ('c1', 'north')
@@ -0,0 +1,41 @@
+import threading
+from ttl_cache import TTLCache
+
+
+def test_load_that_races_an_invalidation_is_not_cached():
+    cache = TTLCache()
+    loading = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def stale_loader():
+        loading.set()
+        release.wait(5)
+        return 'before the write'
+
+    reader = threading.Thread(target=lambda: results.append(cache.get_or_load('key', stale_loader)))
+    reader.start()
+    assert loading.wait(5)
+    cache.invalidate('key')
+    release.set()
+    reader.join(5)
+
+    # the caller still gets its value, but the next read loads again
+    assert results == ['before the write']
+    assert cache.get('key') is None
+    assert cache.get_or_load('key', lambda: 'after the write') == 'after the write'
+    assert cache.get('key') == 'after the write'
+
+
+def test_none_is_not_cached():
+    cache = TTLCache()
+    calls = []
+    for _ in range(2):
+        cache.get_or_load('key', lambda: calls.append(1))
+    assert len(calls) == 2
+
+
+def test_entries_expire():
+    cache = TTLCache(ttl=0)
+    cache.set('key', 'value')
+    assert cache.get('key') is None
@@ -0,0 +1,190 @@
+import time
+import pytest
+from pymongo.errors import BulkWriteError
+from ttl_cache import TTLCache
+from write_queue import WriteBehindQueue, DUPLICATE_KEY
+
+
+class FakeDatabase:
+    """Records what the queue stores, in place of DatabaseManager"""
+
+    def __init__(self):
+        self.customer_cache = TTLCache()
+        self.customers = {}
+        self.orders = {}
+        self.visits = []
+        self.fail = False
+
+    def insert_customers(self, customers):
+        self._check()
+        self._insert(self.customers, customers, 'customer_id')
+
+    def insert_orders(self, orders):
+        self._check()
+        self._insert(self.orders, orders, '_id')
+
+    def record_visits(self, visits):
+        self._check()
+        self.visits.extend(visits)
+
+    def _check(self):
+        if self.fail:
+            raise ConnectionError('database down')
+
+    def _insert(self, collection, documents, key):
+        errors = []
+        for index, document in enumerate(documents):
+            if document[key] in collection:
+                errors.append({'index': index, 'code': DUPLICATE_KEY})
+            else:
+                collection[document[key]] = document
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+
+class FakeStorage:
+    def __init__(self):
+        self.images = {}
+        self.failing = set()
+
+    def face_object_name(self, customer_id):
+        return f"{customer_id}.jpg"
+
+    def upload_face_image(self, customer_id, image_data):
+        if customer_id in self.failing:
+            raise ConnectionResetError('connection reset')
+        self.images[customer_id] = image_data
+        return self.face_object_name(customer_id)
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return tmp_path / 'write_queue.db'
+
+
+def make_queue(database, storage, path, **options):
+    # not started: tests drain the journal with _flush_batch()
+    options.setdefault('retry_delay', 0.01)
+    options.setdefault('max_retry_delay', 0.01)
+    return WriteBehindQueue(database, storage, path, **options)
+
+
+def drain(queue):
+    while queue._flush_batch():
+        pass
+
+
+def test_writes_are_stored_in_dependency_order(journal_path):
+    database, storage = FakeDatabase(), FakeStorage()
+    queue = make_queue(database, storage, journal_path)
+
+    queue.create_customer('c1', 'Ann', 'c1.jpg', b'\0' * 512, 'v1')
+    queue.record_visit('c1')
+    queue.add_order('c1', ['latte'], 4.5, 'North')
+    queue.upload_face_image('c1', b'jpeg')
+    assert queue.pending() == 4
+
+    drain(queue)
+    assert queue.pending() == 0
+    assert list(database.customers) == ['c1']
+    assert [customer_id for customer_id, _, _ in database.visits] == ['c1']
+    assert len(database.orders) == 1
+    assert storage.images == {'c1': b'jpeg'}
+
+
+def test_writes_survive_a_restart(journal_path):
+    database, storage = FakeDatabase(), FakeStorage()
+    queue = make_queue(database, storage, journal_path)
+    queue.create_customer('c1', 'Ann', 'c1.jpg', b'\0' * 512, 'v1')
+    queue.create_customer('c2', 'Bob', 'c2.jpg')
+
+    reopened = make_queue(database, storage, journal_path)
+    assert reopened.pending() == 2
+    assert reopened.pending_customers('v1') == [('c1', b'\0' * 512)]
+    drain(reopened)
+    assert set(database.customers) == {'c1', 'c2'}
+    assert reopened.pending_customers('v1') == []
+
+
+def test_failed_batch_stays_journaled(journal_path):
+    database, storage = FakeDatabase(), FakeStorage()
+    queue = make_queue(database, storage, journal_path)
+    queue.add_order('c1', ['latte'], 4.5, 'North')
+
+    database.fail = True
+    with pytest.raises(ConnectionError):
+        queue._flush_batch()
+    assert queue.pending() == 1
+
+    database.fail = False
+    drain(queue)
+    assert queue.pending() == 0
+    assert len(database.orders) == 1
+
+
+def test_replayed_writes_are_applied_once(journal_path):
+    database, storage = FakeDatabase(), FakeStorage()
+    queue = make_queue(database, storage, journal_path)
+    queue.create_customer('c1', 'Ann', 'c1.jpg')
+    queue.add_order('c1', ['latte'], 4.5, 'North')
+    queue.record_visit('c1')
+
+    # stored, but the journal was not cleared before a crash
+    rows = queue._conn.execute('SELECT kind, payload FROM writes ORDER BY id').fetchall()
+    drain(queue)
+    queue._conn.executemany('INSERT INTO writes (kind, payload) VALUES (?, ?)', rows)
+    drain(queue)
+
+    assert queue.pending() == 0
+    assert len(database.customers) == 1
+    assert len(database.orders) == 1
+    # the replayed visit carries the id of the first attempt, which
+    # DatabaseManager.record_visits counts only once
+    first, replayed = database.visits
+    assert first[1] == replayed[1]
+
+
+def test_failed_upload_does_not_hold_up_other_writes(journal_path):
+    database, storage = FakeDatabase(), FakeStorage()
+    storage.failing.add('c1')
+    queue = make_queue(database, storage, journal_path, retry_delay=60, max_retry_delay=60)
+
+    queue.upload_face_image('c1', b'one')
+    queue.upload_face_image('c2', b'two')
+    queue.add_order('c2', ['latte'], 4.5, 'North')
+    drain(queue)
+
+    assert storage.images == {'c2': b'two'}
+    assert len(database.orders) == 1
+    # backed off, so the next batch does not pick it up again yet
+    assert queue.pending() == 1
+    assert queue._flush_batch() == 0
+
+
+def test_upload_is_retried_then_dead_lettered(journal_path):
+    database, storage = FakeDatabase(), FakeStorage()
+    storage.failing.add('c1')
+    queue = make_queue(database, storage, journal_path, max_attempts=3)
+
+    queue.upload_face_image('c1', b'one')
+    for _ in range(3):
+        time.sleep(0.02)
+        queue._flush_batch()
+    assert queue.pending() == 0
+    assert queue.dead_letters() == 1
+
+    # dead letters are queued again on the next start
+    storage.failing.clear()
+    reopened = make_queue(database, storage, journal_path)
+    assert reopened._requeue_dead_letters() == 1
+    assert reopened.dead_letters() == 0
+    drain(reopened)
+    assert storage.images == {'c1': b'one'}
+
+
+def test_stored_images_are_reported(journal_path):
+    stored = []
+    queue = make_queue(FakeDatabase(), FakeStorage(), journal_path, on_face_image_stored=stored.append)
+    queue.upload_face_image('c1', b'one')
+    drain(queue)
+    assert stored == ['c1']